@@ -0,0 +1,176 @@
+import math
+import threading
+import time
+from datetime import datetime
+
+from alert_state import ALERT_GEOFENCE_DWELL_SEC, ALERT_ROOM_DWELL_SEC, ALERT_TEMP_DWELL_SEC, ALERT_TEMP_HYSTERESIS
+
+# segnale degli eventi a cui si applica ciascun tipo di regola
+RULE_KINDS = {
+    "temp_above": "temp",        # {"value": 30}
+    "temp_below": "temp",        # {"value": 10}
+    "outside_circle": "gps",     # {"lat": .., "lon": .., "radius": metri}
+    "room_forbidden": "room",    # {"rooms": ["Cucina"]} oppure senza rooms: stanze con allowed=False
+}
+DEFAULT_DWELL = {"temp": ALERT_TEMP_DWELL_SEC, "gps": ALERT_GEOFENCE_DWELL_SEC, "room": ALERT_ROOM_DWELL_SEC}
+
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin(math.radians(lat2 - lat1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 6371000 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def _minutes(hhmm):
+    h, m = str(hhmm).split(":")
+    return int(h) * 60 + int(m)
+
+
+class TimeWindow:
+    """Fascia oraria locale [start, end), anche a cavallo della mezzanotte (es. 22:00-07:00)."""
+
+    __slots__ = ("start", "end", "tz")
+
+    def __init__(self, start, end, tz):
+        self.start, self.end, self.tz = _minutes(start), _minutes(end), tz
+
+    def contains(self, ts):
+        local = datetime.fromtimestamp(ts, self.tz)
+        m = local.hour * 60 + local.minute
+        if self.start <= self.end:
+            return self.start <= m < self.end
+        return m >= self.start or m < self.end
+
+
+class Rule:
+    """Regola compilata: `matches(evento, ora, attiva)` ritorna True se la condizione d'allarme è vera."""
+
+    __slots__ = ("id", "kind", "signal", "params", "window", "dwell", "band")
+
+    def __init__(self, rule_id, kind, params, window=None, dwell=None, band=ALERT_TEMP_HYSTERESIS):
+        if kind not in RULE_KINDS:
+            raise ValueError(f"tipo di regola sconosciuto: {kind}")
+        self.id = rule_id
+        self.kind = kind
+        self.signal = RULE_KINDS[kind]
+        self.params = params
+        self.window = window
+        self.dwell = DEFAULT_DWELL[self.signal] if dwell is None else float(dwell)
+        self.band = band
+
+    def matches(self, event, now, active=False):
+        if self.window is not None and not self.window.contains(now):
+            return False
+        p = self.params
+        if self.kind == "temp_above":
+            # isteresi: per uscire dall'allarme la temperatura deve scendere di `band` sotto la soglia
+            return event["temp"] > p["value"] - (self.band if active else 0)
+        if self.kind == "temp_below":
+            return event["temp"] < p["value"] + (self.band if active else 0)
+        if self.kind == "outside_circle":
+            return _distance_m(event["lat"], event["lon"], p["lat"], p["lon"]) > p["radius"]
+        if self.kind == "room_forbidden":
+            rooms = p.get("rooms")
+            return event["room"] in rooms if rooms else not event.get("allowed", True)
+        return False
+
+
+def compile_rule(doc, tz):
+    """Documento regola ({"id", "kind", parametri, "window": {"start", "end"}, "dwell"}) -> Rule."""
+    kind = doc["kind"]
+    params = {k: v for k, v in doc.items() if k not in ("id", "_id", "kind", "pet_id", "window", "dwell", "enabled")}
+    if kind in ("temp_above", "temp_below"):
+        params["value"] = float(params["value"])
+    elif kind == "outside_circle":
+        params = {"lat": float(params["lat"]), "lon": float(params["lon"]), "radius": float(params["radius"])}
+    window = doc.get("window")
+    if window:
+        window = TimeWindow(window["start"], window["end"], tz)
+    return Rule(str(doc.get("id") or doc.get("_id")), kind, params, window, doc.get("dwell"))
+
+
+class AlertRuleEngine:
+    """
+    Regole d'allarme compilate e indicizzate per pet e segnale: un evento valuta solo le regole del suo
+    pet per quel segnale. `load_pet_rules(pet_id)` e `load_global_rules()` ritornano documenti regola;
+    le regole globali valgono per tutti i pet. L'indice si ricostruisce solo dopo un'invalidazione.
+    """
+
+    def __init__(self, load_pet_rules, load_global_rules, tz):
+        self._load_pet_rules = load_pet_rules
+        self._load_global_rules = load_global_rules
+        self.tz = tz
+        self._lock = threading.Lock()
+        self._global = None   # {segnale: [Rule]}
+        self._index = {}      # pet_id -> {segnale: [Rule]}
+
+    def _compile_all(self, docs):
+        by_signal = {}
+        for doc in docs:
+            if doc.get("enabled", True) is False:
+                continue
+            try:
+                rule = compile_rule(doc, self.tz)
+            except Exception as e:
+                print(f"[ALERT RULES] Regola non valida {doc.get('id') or doc.get('_id')}: {e}")
+                continue
+            by_signal.setdefault(rule.signal, []).append(rule)
+        return by_signal
+
+    def _pet_rules(self, pet_id):
+        """{segnale: [Rule]} del pet e True se l'indice del pet è stato appena ricostruito."""
+        with self._lock:
+            if self._global is None:
+                self._global = self._compile_all(self._load_global_rules())
+            rules = self._index.get(pet_id)
+            if rules is not None:
+                return rules, False
+            rules = self._compile_all(self._load_pet_rules(pet_id))
+            for sig, global_rules in self._global.items():
+                rules[sig] = rules.get(sig, []) + global_rules
+            self._index[pet_id] = rules
+            return rules, True
+
+    def rules_for(self, pet_id, signal):
+        return self._pet_rules(str(pet_id))[0].get(signal, [])
+
+    def invalidate(self, pet_id=None):
+        """
+        Senza pet_id invalida anche le regole globali (perimetro, stanze, regole per tutti i pet).
+        Gli stati delle regole eliminate vengono scartati alla ricostruzione dell'indice del pet,
+        alla prima valutazione successiva.
+        """
+        with self._lock:
+            if pet_id is None:
+                self._global = None
+                self._index.clear()
+            else:
+                self._index.pop(str(pet_id), None)
+
+    def evaluate(self, pet_id, signal, event, states, now=None):
+        """
+        Valuta le regole del pet per il segnale e aggiorna `states` (AlertStateStore).
+        Ritorna le regole appena entrate in allarme.
+        """
+        now = time.time() if now is None else now
+        rules, rebuilt = self._pet_rules(str(pet_id))
+        if rebuilt:
+            # regole eliminate: un loro allarme attivo non deve restare nello snapshot del pet
+            states.retain(pet_id, {rule.id for by_signal in rules.values() for rule in by_signal})
+        fired = []
+        for rule in rules.get(signal, []):
+            state_id = rule.id
+            if rule.signal == "room":
+                # uno stato per stanza: passare da una stanza vietata a un'altra genera un nuovo allarme,
+                # e lo stato della stanza lasciata rientra
+                state_id = f"{rule.id}:{event.get('room')}"
+                for other in states.state_ids(pet_id, rule.id):
+                    if other != state_id:
+                        states.update_rule(pet_id, rule, False, event, now, state_id=other)
+            active = states.is_active(pet_id, state_id)
+            matched = rule.matches(event, now, active)
+            transition = states.update_rule(pet_id, rule, matched, event, now, state_id=state_id)
+            if transition == (False, True):
+                fired.append(rule)
+        return fired
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+ALERT_TEMP_HYSTERESIS = float(os.getenv("ALERT_TEMP_HYSTERESIS", "0.5"))      # °C
+ALERT_TEMP_DWELL_SEC = float(os.getenv("ALERT_TEMP_DWELL_SEC", "0"))
+ALERT_GEOFENCE_DWELL_SEC = float(os.getenv("ALERT_GEOFENCE_DWELL_SEC", "10"))
+ALERT_ROOM_DWELL_SEC = float(os.getenv("ALERT_ROOM_DWELL_SEC", "5"))
+
+
+class _Dwell:
+    """Valore confermato solo dopo che il nuovo valore è rimasto stabile per `dwell` secondi."""
+
+    __slots__ = ("value", "candidate", "since")
+
+    def __init__(self, value=None):
+        self.value = value
+        self.candidate = value
+        self.since = None
+
+    def update(self, value, now, dwell):
+        """Ritorna (precedente, nuovo) se il valore confermato cambia, altrimenti None."""
+        if value == self.value:
+            self.candidate, self.since = value, None
+            return None
+        if value != self.candidate:
+            self.candidate, self.since = value, now
+        if now - self.since < dwell:
+            return None
+        old, self.value, self.since = self.value, value, None
+        return old, value
+
+
+class _RuleState:
+    __slots__ = ("dwell", "rule", "event")
+
+    def __init__(self):
+        self.dwell = _Dwell(False)
+        self.rule = None     # regola attiva (per i parametri usati nel messaggio)
+        self.event = None    # evento che l'ha attivata
+
+
+class AlertStateStore:
+    """
+    Stato degli allarmi per (pet, regola). update_rule ritorna la transizione (precedente, nuovo)
+    solo quando lo stato confermato cambia, dopo il tempo minimo di permanenza della regola.
+    Una regola può avere più stati, uno per valore osservato: lo stato "<id regola>:<stanza>"
+    per le stanze vietate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pets = {}   # pet_id -> {"rules": {rule_id: _RuleState}, "last": {segnale: evento}}
+
+    def _get(self, pet_id):
+        return self._pets.setdefault(str(pet_id), {"rules": {}, "last": {}})
+
+    def is_active(self, pet_id, state_id):
+        with self._lock:
+            st = self._get(pet_id)["rules"].get(state_id)
+            return bool(st and st.dwell.value)
+
+    def state_ids(self, pet_id, rule_id):
+        """Stati del pet che appartengono alla regola (lo stato `rule_id` e quelli "rule_id:...")."""
+        with self._lock:
+            return [s for s in self._get(pet_id)["rules"] if s.partition(":")[0] == rule_id]
+
+    def retain(self, pet_id, rule_ids):
+        """Scarta gli stati del pet di regole che non esistono più."""
+        with self._lock:
+            states = self._get(pet_id)["rules"]
+            for state_id in [s for s in states if s.partition(":")[0] not in rule_ids]:
+                del states[state_id]
+
+    def update_rule(self, pet_id, rule, matched, event, now=None, state_id=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            pet = self._get(pet_id)
+            pet["last"][rule.signal] = event
+            st = pet["rules"].setdefault(state_id or rule.id, _RuleState())
+            transition = st.dwell.update(bool(matched), now, rule.dwell)
+            if transition and transition[1]:
+                st.rule, st.event = rule, event
+            return transition
+
+    def snapshot(self, pet_id):
+        """Allarmi attivi del pet nei termini di notify_events."""
+        with self._lock:
+            pet = self._get(pet_id)
+            last_temp = pet["last"].get("temp") or {}
+            out = {
+                "is_outside": False, "temp_high": False, "temp_low": False,
+                "temp_value": last_temp.get("temp"),
+                "temp_min": last_temp.get("temp_min"), "temp_max": last_temp.get("temp_max"),
+                "restricted_room": None,
+            }
+            for st in pet["rules"].values():
+                if not st.dwell.value or st.rule is None:
+                    continue
+                kind = st.rule.kind
+                if kind == "outside_circle":
+                    out["is_outside"] = True
+                elif kind == "temp_above":
+                    out["temp_high"] = True
+                    out["temp_max"] = st.rule.params["value"]
+                elif kind == "temp_below":
+                    out["temp_low"] = True
+                    out["temp_min"] = st.rule.params["value"]
+                elif kind == "room_forbidden":
+                    out["restricted_room"] = st.event.get("room")
+            return out
+
+    def forget(self, pet_id):
+        with self._lock:
+            self._pets.pop(str(pet_id), None)
@@ -3,18 +3,32 @@ import json
 import threading
 import asyncio
 import math
-from flask import jsonify, request, render_template, redirect, url_for, session, flash, Flask
+import queue
+import base64
+from flask import jsonify, request, render_template, redirect, url_for, session, flash, Flask, make_response, stream_with_context
 import requests
 import websockets
-from pettracker_db import PetTrackerDB
-from auth import AuthManager, login_required, generate_secret_key
-from datetime import datetime, timedelta, UTC, timezone
+from storage import ENV_FIELDS, open_database, canonical_env_key, env_key_for_pet
+from auth import ADMIN_USERNAME, AuthManager, login_required, generate_secret_key
+from datetime import datetime, timedelta, UTC, timezone, date
 import time
 import paho.mqtt.client as mqtt
 from zoneinfo import ZoneInfo
-from dateutil.parser import isoparse
-
-from telegram_bot import notify_events, save_chat_id
+from bson import ObjectId
+
+from telegram_bot import get_dispatcher, load_chat_ids, notify_events, save_chat_id, send_telegram_message, set_outbox
+from notification_outbox import OutboxWorker
+from timeline import build_timeline, summarize_days, merge_summaries, timeline_days, normalize_timestamp
+from timeline_cache import DayTimelineCache, summaries_etag, summaries_last_modified
+from compaction import start_compaction_worker
+from downsample import lttb
+from live_state import LiveStateCache
+from live_feed import LiveFeed, sse_event
+from device_index import DeviceIndex
+from negotiation import ContentNegotiation
+from alert_state import AlertStateStore
+from alert_rules import AlertRuleEngine, compile_rule, RULE_KINDS
+from heatmap import HeatmapCache, HEATMAP_DEFAULT_PRECISION, HEATMAP_MIN_PRECISION, HEATMAP_MAX_PRECISION
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -31,11 +45,17 @@ ESP32_CONTROL_PATH = "/control"
 
 MQTT_ANCHORS_TOPIC = "tracker/anchors"
 
-db = PetTrackerDB()
+db = open_database()
 auth_manager = AuthManager(db)
 
 app = Flask(__name__)
 app.secret_key = generate_secret_key()
+# JSON o MessagePack secondo Accept, gzip/brotli secondo Accept-Encoding
+negotiation = ContentNegotiation(
+    app,
+    min_size=int(os.getenv("COMPRESS_MIN_SIZE", "1024")),
+    cache_entries=int(os.getenv("IMMUTABLE_RESPONSE_CACHE_SIZE", "512"))
+)
 
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371000
@@ -53,16 +73,22 @@ def is_inside_circle(lat_pet, lon_pet, lat_center, lon_center, radius):
 
 latest_gps = {"lat": None, "lon": None}
 latest_env = {}
+live_feed = LiveFeed(max_queue=int(os.getenv("LIVE_FEED_QUEUE", "256")))
+live_state = LiveStateCache()  # pet_id -> ultima stanza / GPS / env, aggiornato dall'ingest
+LIVE_FEED_TICK_SEC = float(os.getenv("LIVE_FEED_TICK_SEC", "5"))
+LIVE_FEED_HEARTBEAT_SEC = float(os.getenv("LIVE_FEED_HEARTBEAT_SEC", "20"))
+# granularità (dBm) dell'RSSI dei dispositivi rilevati inviato sul live feed
+LIVE_FEED_RSSI_STEP = int(os.getenv("LIVE_FEED_RSSI_STEP", "10"))
+LOCATIONS_MAX_PETS = int(os.getenv("LOCATIONS_MAX_PETS", "200"))
+DETECTED_MAX_AGE_SEC = 300  # mostra solo dispositivi visti negli ultimi 5 minuti
 mqtt_client = None
-seen_devices = {}
+device_index = DeviceIndex(db.get_registered_macs, max_age=DETECTED_MAX_AGE_SEC)
+seen_devices = device_index.devices  # mac -> ultima lettura, per la UI / registrazione
 
-# Stato globale per logica notifiche combinate
-current_is_outside = False
-current_temp_high = False
-current_temp_low = False
-current_temp_value = None
-current_temp_min = None
-current_temp_max = None
+# Stato degli allarmi per pet (perimetro, temperatura, stanza): notifiche solo sulle transizioni
+alert_states = AlertStateStore()
+# Outbox durevole delle notifiche: consegna a lotti, un messaggio per chat
+notification_outbox = OutboxWorker(db, get_dispatcher, load_chat_ids)
 
 # ===== BLE / ANCORE =====
 anchors_online = {}  # mac_address: {"anchor_id": ..., "timestamp": ...}
@@ -77,10 +103,6 @@ RSSI_THRESHOLD = float(os.getenv("BLE_RSSI_THRESHOLD", "-100"))   # calibra in c
 BLE_EVENT_COOLDOWN_SEC = int(os.getenv("BLE_EVENT_COOLDOWN_SEC", "5"))
 last_ble_state = {}  # pet_mac -> {"room": str, "t": float, "avg": float}
 
-# Stato per notifiche stanza non consentita 
-current_in_restricted_room = False
-current_restricted_room = None
-
 @app.route('/change_credentials', methods=['GET', 'POST'])
 @login_required
 def change_credentials():
@@ -99,16 +121,18 @@ def change_credentials():
             return redirect(url_for('dashboard'))
     return render_template('change_credentials.html')
 
-@app.route('/anchors_online')
-@login_required
-def anchors_online_view():
+def compute_anchors_online():
     cutoff = time.time() - ANCHORS_REFRESH_SEC
-    anchors = [
+    return [
         {"mac_address": mac, "anchor_id": info["anchor_id"]}
-        for mac, info in anchors_online.items()
+        for mac, info in list(anchors_online.items())
         if info["timestamp"] > cutoff
     ]
-    return jsonify({"anchors": anchors})
+
+@app.route('/anchors_online')
+@login_required
+def anchors_online_view():
+    return jsonify({"anchors": compute_anchors_online()})
 
 def update_rssi_window(anchor_id, pet_mac_norm, rssi, bt_name=None):
     """
@@ -243,10 +267,11 @@ def add_pet():
             mac_address=mac_norm,
             bt_name=bt_name
         )
+        device_index.invalidate_registered()
 
         if temp_min or temp_max:
             # cerchiamo il pet creato (per owner e MAC normalizzato)
-            pet = db.pets.find_one({"owner_id": str(user['_id']), "mac_address": mac_norm})
+            pet = db.get_pet_by_mac(mac_norm, owner_id=user['_id'])
             if pet:
                 db.update_pet(
                     str(pet["_id"]),
@@ -289,6 +314,9 @@ def edit_pet(pet_id):
             temp_min=float(temp_min) if temp_min else None,
             temp_max=float(temp_max) if temp_max else None
         )
+        live_state.invalidate(pet_id)
+        device_index.invalidate_registered()
+        alert_rules.invalidate(pet_id)
         flash("Pet modificato!", "success")
         return redirect(url_for('pets'))
     return render_template('edit_pet.html', pet=pet, user=user)
@@ -304,6 +332,13 @@ def pets():
 @login_required
 def delete_pet(pet_id):
     db.delete_pet(pet_id)
+    timeline_cache.invalidate(pet_id)
+    heatmap_cache.invalidate(pet_id)
+    live_state.invalidate(pet_id)
+    device_index.invalidate_registered()
+    negotiation.invalidate(f"/{pet_id}")
+    alert_states.forget(pet_id)
+    alert_rules.invalidate(pet_id)
     flash("Pet eliminato!", "info")
     return redirect(url_for('pets'))
 
@@ -341,6 +376,7 @@ def update_perimeter():
     lng = float(request.form['center_lng'])
     radius = int(request.form['radius'])
     db.save_perimeter(center=(lat, lng), radius=radius)
+    alert_rules.invalidate()
     flash("Perimetro aggiornato!", "success")
     return redirect(url_for('config_area_main'))
 
@@ -408,7 +444,7 @@ def resolve_room_name(anchor_id: str):
         return None
     try:
         # 1) prova a trovare una stanza il cui campo 'name' corrisponda ad anchor_id
-        room = db.rooms.find_one({"name": anchor_id})
+        room = db.get_room_by_name(anchor_id)
         if room and room.get("name"):
             return room.get("name")
         # 2) altrimenti prova a trovare la mac corrispondente in anchors_online
@@ -418,7 +454,7 @@ def resolve_room_name(anchor_id: str):
                 anchor_mac = mac
                 break
         if anchor_mac:
-            room2 = db.rooms.find_one({"mac_address": anchor_mac})
+            room2 = db.get_room_by_mac(anchor_mac)
             if room2 and room2.get("name"):
                 return room2.get("name")
     except Exception:
@@ -427,6 +463,45 @@ def resolve_room_name(anchor_id: str):
     return anchor_id
 
 
+timeline_cache = DayTimelineCache(
+    db,
+    ZoneInfo("Europe/Rome"),
+    resolve_room=resolve_room_name,
+    max_entries=int(os.getenv("TIMELINE_CACHE_SIZE", "2048"))
+)
+heatmap_cache = HeatmapCache(db, ZoneInfo("Europe/Rome"), max_entries=int(os.getenv("HEATMAP_CACHE_SIZE", "4096")))
+HEATMAP_MAX_DAYS = int(os.getenv("HEATMAP_MAX_DAYS", "92"))
+
+
+def invalidate_replayed_days(collection, docs):
+    """
+    Letture reinserite dallo spool dopo un'interruzione di Mongo: quelle di giorni già conclusi rendono
+    obsoleti riepiloghi timeline, heatmap e risposte immutabili messe in cache nel frattempo.
+    """
+    rome = ZoneInfo("Europe/Rome")
+    today = datetime.now(rome).date()
+    closed = {}
+    for doc in docs:
+        ts = normalize_timestamp(doc.get("timestamp"))
+        if ts is None or doc.get("pet_id") is None:
+            continue
+        day = ts.astimezone(rome).date()
+        if day < today:
+            closed.setdefault(str(doc["pet_id"]), set()).add(day)
+    if not closed:
+        return
+    if collection == "envdata":
+        # le serie env sono per chiave di sensore, le URL per pet: si scartano tutte
+        negotiation.invalidate("/history/env/")
+    else:
+        for pet_id, days in closed.items():
+            for day in days:
+                timeline_cache.invalidate(pet_id, day)
+            heatmap_cache.invalidate(pet_id, [day.isoformat() for day in days])
+            negotiation.invalidate(f"/{pet_id}")
+    print(f"[SPOOL] Cache invalidate per {sum(len(d) for d in closed.values())} giorni conclusi ({collection})")
+
+
 # helper per normalizzare MAC 
 def normalize_mac(mac: str):
     if not mac:
@@ -439,64 +514,142 @@ def normalize_mac(mac: str):
     return ':'.join(m[i:i+2] for i in range(0, 12, 2))
 
 
-@app.route('/get_pet_location/<pet_id>')
-@login_required
-def get_pet_location(pet_id):
-    pet = db.get_pet_by_id(pet_id)
-    if not pet:
-        return jsonify({"error": "Pet non trovato"}), 404
-
-    mac = pet.get("mac_address")
-    if not mac:
-        return jsonify({"error": "Nessun MAC associato"}), 404
+def _epoch(ts):
+    """Timestamp (datetime, stringa ISO o epoch) -> epoch in secondi."""
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    ts = normalize_timestamp(ts)
+    return ts.timestamp() if ts else None
 
-    now = time.time()
-    cutoff = now - 5 * 60  # 5 minuti
 
-    # --- CERCA BLE (per pet_id) ---
-    last_ble = db.positions.find_one(
-        {"pet_id": str(pet_id), "source": "ble"},
-        sort=[("timestamp", -1)]
-    )
-    if last_ble:
-        ts = last_ble.get("timestamp")
-        if isinstance(ts, str):
-            ts = isoparse(ts)
-        if ts and ts.tzinfo is None:
-            ts = ts.replace(tzinfo=timezone.utc)
-        if ts and ts.timestamp() >= cutoff:
+def load_live_states(pet_ids, pets=None):
+    """
+    Avvio a freddo: completa dal DB lo stato corrente dei pet (ultima stanza BLE, ultimo GPS,
+    ultima lettura ambientale) con un numero fisso di query, indipendente dal numero di pet.
+    Dopo il primo caricamento lo stato è mantenuto dall'ingest.
+    Ritorna {pet_id: documento pet} per i pet esistenti.
+    """
+    pet_ids = [str(p) for p in pet_ids]
+    if pets is None:
+        pets = db.get_pets_by_ids(pet_ids)
+    pets = {pid: pets[pid] for pid in pet_ids if pid in pets}
+    if not pets:
+        return {}
+
+    latest = db.latest_positions(list(pets))
+
+    # una sola chiave canonica per pet (MAC del collare o pet_id)
+    env_keys = {pid: env_key_for_pet(pid, pet) for pid, pet in pets.items()}
+    missing = [k for k in env_keys.values() if k not in latest_env]
+    stored_env = db.latest_env_many(missing) if missing else {}
+
+    for pid, pet in pets.items():
+        by_source = latest.get(pid, {})
+        last_ble = by_source.get("ble")
+        if last_ble:
             room_name = resolve_room_name(last_ble.get("room"))
-            return jsonify({
-                "room": room_name or last_ble.get("room"),
-                "room_last_seen": int(ts.timestamp())
-            })
-
-    # --- CERCA GPS COME FALLBACK ---
-    last_gps = db.positions.find_one(
-        {"pet_mac": normalize_mac(mac), "source": "gps"},
-        sort=[("timestamp", -1)]
-    )
-    if last_gps and last_gps.get("lat") and last_gps.get("lon"):
-        ts = last_gps.get("timestamp")
-        if isinstance(ts, str):
-            ts = isoparse(ts)
-        if ts and ts.tzinfo is None:
-            ts = ts.replace(tzinfo=timezone.utc)
-        if ts and ts.timestamp() >= cutoff:
-            gps_data = {"lat": float(last_gps["lat"]), "lon": float(last_gps["lon"])}
-            return jsonify({
-                "gps": gps_data,
-                "gps_last_seen": int(ts.timestamp())
-            })
+            live_state.update_room(pid, room_name or last_ble.get("room"), _epoch(last_ble.get("timestamp")))
+
+        mac = pet.get("mac_address")
+        last_gps = by_source.get("gps")
+        if mac and last_gps and last_gps.get("lat") and last_gps.get("lon"):
+            live_state.update_gps(pid, float(last_gps["lat"]), float(last_gps["lon"]), _epoch(last_gps.get("timestamp")))
+
+        env = latest_env.get(env_keys[pid]) or stored_env.get(env_keys[pid])
+        if env:
+            live_state.update_env(pid, env.get("temp"), env.get("hum"), _epoch(env.get("timestamp")), env.get("timestamp"))
+
+        live_state.mark_loaded(pid, has_mac=bool(mac))
+    return pets
+
+
+def live_states_for(pet_ids, pets=None):
+    """pet_id -> stato corrente; i pet non ancora caricati vengono completati dal DB in blocco."""
+    pet_ids = [str(p) for p in pet_ids]
+    states = {pid: live_state.get(pid) for pid in pet_ids}
+    cold = [pid for pid, st in states.items() if st is None or not st["loaded"]]
+    if cold:
+        load_live_states(cold, pets)
+        for pid in cold:
+            states[pid] = live_state.get(pid)
+    return {pid: st for pid, st in states.items() if st and st["loaded"]}
+
+
+def live_state_for(pet_id):
+    return live_states_for([pet_id]).get(str(pet_id))
+
+
+def global_env_state():
+    """Stato della lettura ambientale "global" (fallback per i pet senza sensore proprio)."""
+    state = live_state.get("global")
+    if state is None or not state["loaded"]:
+        g = latest_env.get("global") or db.get_latest_env("global")
+        if g:
+            live_state.update_env("global", g.get("temp"), g.get("hum"), _epoch(g.get("timestamp")), g.get("timestamp"))
+        live_state.mark_loaded("global")
+        state = live_state.get("global")
+    return state
+
+
+LOCATION_MAX_AGE_SEC = 5 * 60
+
+
+def location_from_state(state):
+    """Risposta di /get_pet_location a partire dallo stato corrente: (dizionario, status HTTP)."""
+    if not state:
+        return {"error": "Pet non trovato"}, 404
+    if not state.get("has_mac"):
+        return {"error": "Nessun MAC associato"}, 404
+
+    cutoff = time.time() - LOCATION_MAX_AGE_SEC
+
+    # --- BLE ---
+    if state["room"] and state["room_ts"] and state["room_ts"] >= cutoff:
+        return {
+            "room": state["room"],
+            "room_last_seen": int(state["room_ts"])
+        }, 200
+
+    # --- GPS COME FALLBACK ---
+    if state["gps"] and state["gps_ts"] and state["gps_ts"] >= cutoff:
+        return {
+            "gps": state["gps"],
+            "gps_last_seen": int(state["gps_ts"])
+        }, 200
 
     # --- SE NON TROVA NULLA ---
-    return jsonify({
+    return {
         "none": True,
         "message": "Nessuna posizione disponibile"
-    })
+    }, 200
+
+
+@app.route('/get_pet_location/<pet_id>')
+@login_required
+def get_pet_location(pet_id):
+    body, status = location_from_state(live_state_for(pet_id))
+    return jsonify(body), status
+
+
+@app.route('/get_pet_locations', methods=['GET', 'POST'])
+@login_required
+def get_pet_locations():
+    """
+    Posizione corrente di più pet in una sola richiesta: ?pet_ids=<id>,<id> oppure JSON {"pet_ids": [...]}.
+    Ritorna {"locations": {pet_id: <risposta di /get_pet_location>}}.
+    """
+    if request.method == 'POST':
+        pet_ids = (request.get_json(silent=True) or {}).get("pet_ids") or []
+    else:
+        pet_ids = [p for p in request.args.get("pet_ids", "").split(",") if p]
+    pet_ids = list(dict.fromkeys(str(p) for p in pet_ids))
+    if len(pet_ids) > LOCATIONS_MAX_PETS:
+        return jsonify({"error": f"Massimo {LOCATIONS_MAX_PETS} pet per richiesta"}), 400
+
+    states = live_states_for(pet_ids)
+    return jsonify({"locations": {pid: location_from_state(states.get(pid))[0] for pid in pet_ids}})
 
 
-    
 @app.route('/update_temp_thresholds/<pet_id>', methods=['POST'])
 @login_required
 def update_temp_thresholds(pet_id):
@@ -525,6 +678,7 @@ def update_temp_thresholds(pet_id):
 
     # salva le soglie nel documento pet (associato all'_id)
     db.update_pet(pet_id, temp_min=temp_min_f, temp_max=temp_max_f)
+    alert_rules.invalidate(pet_id)
     print(f"[DEBUG] saved thresholds temp_min={temp_min_f} temp_max={temp_max_f} for pet_id={pet_id}")
 
     # Verifica post-salvataggio
@@ -540,95 +694,11 @@ def update_temp_thresholds(pet_id):
 
 def build_timeline_segments(positions, period="day", start=None, end=None, max_gap_seconds=1800):
     # max_gap_seconds = 1800 -> 30 minuti
-    from datetime import timedelta
-
-    COLORS = {
-        "ble_allowed":  "#49c24b",
-        "ble_blocked":  "#e65c5c",
-        "gps_allowed":  "#53c7c3",
-        "gps_blocked":  "#ffa500",
-        "no_data":      "#e9ecef",
-    }
-
-    def state_of(p):
-        src = p.get("source")
-        et  = p.get("entry_type")
-        if src == "ble":
-            if et in ("stanza_accessibile", "normal"):
-                return "ble_allowed"
-            if et in ("stanza_non_accessibile", "restricted"):
-                return "ble_blocked"
-        if src == "gps":
-            if et == "zona_esterna_accessibile":
-                return "gps_allowed"
-            if et == "zona_esterna_non_accessibile":
-                return "gps_blocked"
-        return "no_data"
-
-    if period == "day":
-        days = [start]
-    elif period in ("week", "month"):
-        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
-    else:
-        days = [start]
-
-    timeline_by_day = {}
-    for day in days:
-        midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        next_midnight = midnight + timedelta(days=1)
-
-        day_positions = [p for p in positions
-                         if p.get("timestamp_rome") and midnight <= p["timestamp_rome"] < next_midnight]
-        day_positions.sort(key=lambda p: p["timestamp_rome"])
-
-        segments = []
-        cur_t = midnight
-        last_seg = None
-
-        def push_or_extend(state, start_dt, end_dt, label=""):
-            nonlocal last_seg
-            if last_seg and last_seg["state"] == state and (start_dt - last_seg["end_dt"]).total_seconds() <= 60:
-                last_seg["end_dt"] = end_dt
-            else:
-                last_seg = {"state": state, "start_dt": start_dt, "end_dt": end_dt, "label": label}
-                segments.append(last_seg)
-
-        for i, p in enumerate(day_positions):
-            start_dt = p["timestamp_rome"]
-            end_dt = day_positions[i + 1]["timestamp_rome"] if i + 1 < len(day_positions) else next_midnight
-            st = state_of(p)
-
-            # Se c'è un buco tra cur_t e start_dt, metti "nessun dato"
-            if start_dt > cur_t:
-                push_or_extend("no_data", cur_t, start_dt, "Nessun dato")
-
-            # FINE PATCH: se il gap al prossimo evento (o alla fine della giornata) è troppo grande, tronca lo stato dopo max_gap_seconds e poi "nessun dato"
-            gap_to_next = (end_dt - start_dt).total_seconds()
-            next_break = min(gap_to_next, max_gap_seconds)
-            # Segmento valido solo per max_gap_seconds
-            push_or_extend(st, start_dt, start_dt + timedelta(seconds=next_break), p.get("room") or p.get("entry_type") or "")
-            if gap_to_next > max_gap_seconds:
-                # Da qui in poi "nessun dato" fino al prossimo evento (o fine giornata)
-                nd_start = start_dt + timedelta(seconds=max_gap_seconds)
-                push_or_extend("no_data", nd_start, end_dt, "Nessun dato")
-            cur_t = end_dt
-
-        if cur_t < next_midnight:
-            push_or_extend("no_data", cur_t, next_midnight, "Nessun dato")
-
-        out = []
-        for s in segments:
-            dur_s = (s["end_dt"] - s["start_dt"]).total_seconds()
-            out.append({
-                "colore": COLORS[s["state"]],
-                "start": s["start_dt"].strftime("%H:%M"),
-                "end": s["end_dt"].strftime("%H:%M"),
-                "width_pct": (dur_s / 86400) * 100.0,
-                "label": s["label"],
-            })
-        timeline_by_day[day.strftime("%d/%m/%Y")] = out
-
-    return timeline_by_day, [f"{h:02d}" for h in range(25)]
+    # positions: iterabile ordinato per timestamp (lista o cursore), consumato in un solo passaggio
+    timeline_by_day, calendar_hours, _ = build_timeline(
+        positions, period, start, end, max_gap_seconds=max_gap_seconds
+    )
+    return timeline_by_day, calendar_hours
 
 @app.route('/stats/<pet_id>')
 @login_required
@@ -674,106 +744,34 @@ def stats(pet_id):
     start_utc = start_local.astimezone(timezone.utc)
     end_utc   = end_local.astimezone(timezone.utc)
 
-    positions = list(db.positions.find({
-        "pet_id": str(pet_id),
-        "timestamp": {"$gte": start_utc, "$lte": end_utc}
-    }).sort("timestamp", 1))
-
-    # Normalizza timestamp e risolvi eventuali nomi stanza leggibili (se p["room"] è un anchor_id)
-    for p in positions:
-        ts = p.get('timestamp')
-        if isinstance(ts, str):
-            ts = isoparse(ts)
-        if ts and ts.tzinfo is None:
-            ts = ts.replace(tzinfo=timezone.utc)
-        p['timestamp'] = ts
-        p['timestamp_rome'] = ts.astimezone(rome) if ts else None
-
-        # Risolvi room -> nome leggibile se presente
-        if p.get("room"):
-            try:
-                p["room"] = resolve_room_name(p.get("room"))
-            except Exception:
-                pass
-
-    last_mov = "-"
-    if positions and positions[-1].get('timestamp_rome'):
-        last_mov = positions[-1]['timestamp_rome'].strftime("%H:%M")
-
-    stats_obj = {
-        'n_points': len(positions),
-        'top_room': "None",
-        'last_movement': last_mov,
-        'restricted_entries': 0,
-    }
-
-    if positions:
-        # ----------- Total Movements -----------
-        total_movements = 1  # Primo movimento conta sempre
-        prev_state = None
-        for p in positions:
-            # Scegli una tupla che rappresenta la posizione logica (room oppure entry_type)
-            key = (p.get("room"), p.get("entry_type"))
-            if prev_state is not None and key != prev_state:
-                total_movements += 1
-            prev_state = key
-        stats_obj['n_points'] = total_movements
-
-        # ----------- Top Room -----------
-        # Somma il tempo in ogni stanza BLE (solo per eventi "ble_allowed" o "ble_blocked")
-        from collections import defaultdict
-        room_times = defaultdict(float)
-        for i in range(len(positions) - 1):
-            p = positions[i]
-            next_p = positions[i + 1]
-            if p.get("room"):
-                dt = (next_p["timestamp"] - p["timestamp"]).total_seconds()
-                room_times[p["room"]] += max(dt, 0)
-        if room_times:
-            # Trova la stanza (nome leggibile) con più tempo totale
-            top_room = max(room_times.items(), key=lambda x: x[1])[0]
-            stats_obj['top_room'] = top_room
-        else:
-            stats_obj['top_room'] = "None"
-
-        # ----------- Restricted Entries -----------
-        restricted_entries = 0
-        for p in positions:
-            et = p.get("entry_type", "")
-            if et in ["zona_esterna_non_accessibile", "restricted", "stanza_non_accessibile"]:
-                restricted_entries += 1
-        stats_obj['restricted_entries'] = restricted_entries
-
-    timeline_by_day, calendar_hours = build_timeline_segments(positions, period, start_local, end_local)
+    if period in ('day', 'week', 'month'):
+        # Giorni interi: i giorni conclusi arrivano dalla cache, solo oggi viene ricalcolato
+        summaries = timeline_cache.get_summaries(pet_id, timeline_days(period, start_local, end_local))
+        timeline_by_day = {s["date"]: s["segments"] for s in summaries}
+        calendar_hours = [f"{h:02d}" for h in range(25)]
+        stats_obj = merge_summaries(summaries, rome)
+    else:
+        # Record proiettati e ordinati: timeline e statistiche in un solo passaggio
+        cursor = db.iter_position_records(pet_id, start_utc, end_utc)
+        summaries, before, after = summarize_days(
+            cursor, timeline_days(period, start_local, end_local), rome, resolve_room_name
+        )
+        timeline_by_day = {s["date"]: s["segments"] for s in summaries}
+        calendar_hours = [f"{h:02d}" for h in range(25)]
+        stats_obj = merge_summaries([before] + summaries + [after], rome)
     current_date_iso = start_local.strftime("%Y-%m-%d")
 
-    # Costruisci tutte le 5 righe timeline per ogni giorno (per settimana/mese)
-    STATES = [
-        ("Zona Interna Consentita", "#49c24b"),
-        ("Zona Interna NON Consentita", "#e65c5c"),
-        ("Zona Esterna Consentita", "#53c7c3"),
-        ("Zona Esterna NON Consentita", "#ffa500"),
-        ("Nessun dato", "#e9ecef"),
-    ]
-
-    for day, segs in timeline_by_day.items():
-        day_rows = []
-        for label, colore in STATES:
-            riga = []
-            for s in segs:
-                if s["colore"] == colore:
-                    riga.append(s)
-                else:
-                    riga.append({
-                        "colore": "transparent",
-                        "start": s["start"],
-                        "end": s["end"],
-                        "width_pct": s["width_pct"],
-                        "label": ""
-                    })
-            day_rows.append({"label": label, "colore": colore, "segments": riga})
-    timeline_by_day, calendar_hours = build_timeline_segments(positions, period, start_local, end_local)
-    return render_template(
+    # Validatori HTTP: se il browser ha già questa versione rispondiamo 304 senza renderizzare
+    etag = summaries_etag(summaries, pet_id, period, start_local.isoformat(), end_local.isoformat(), granularity)
+    last_modified = summaries_last_modified(summaries, start_utc)
+    # confronto debole: con la compressione l'ETag inviato al browser è W/"..."
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        return resp
+
+    resp = make_response(render_template(
         'stats.html',
         pet=pet,
         stats=stats_obj,
@@ -782,7 +780,11 @@ def stats(pet_id):
         granularity=granularity,
         timeline_by_day=timeline_by_day,  # Questa variabile deve contenere i dati della timeline
         calendar_hours=calendar_hours
-    )
+    ))
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 def utc_to_rome(dt):
@@ -801,10 +803,7 @@ def telegram_webhook():
         if text == "/start":
             save_chat_id(chat_id)
             reply_text = "✅ Iscritto alle notifiche! Riceverai un avviso se il tuo pet esce dal perimetro oppure entra in una stanza NON consentita o se la temperatura è fuori soglia."
-            bot_token = os.environ.get("TELEGRAM_BOT_TOKEN", "")
-            if bot_token:
-                url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                requests.post(url, data={"chat_id": chat_id, "text": reply_text})
+            send_telegram_message(reply_text, chat_id, parse_mode=None)
     return "ok"
 
 connected_clients = set()
@@ -834,51 +833,48 @@ def resolve_pet_by_mac(pet_identifier: str):
     # prima come MAC normalizzato
     mac_cand = db._normalize_mac(pet_identifier) if hasattr(db, "_normalize_mac") else normalize_mac(pet_identifier)
     if mac_cand:
-        pet = db.pets.find_one({"mac_address": mac_cand})
+        pet = db.get_pet_by_mac(mac_cand)
         if pet:
             return (str(pet["_id"]), pet)
     # fallback bt_name case-insensitive
     try:
-        pet = db.pets.find_one({"bt_name": pet_identifier})
+        pet = db.get_pet_by_bt_name(pet_identifier)
         if pet:
             return (str(pet["_id"]), pet)
-        pet = db.pets.find_one({"bt_name": {"$regex": f'^{pet_identifier}$', "$options": "i"}})
+        pet = db.get_pet_by_bt_name(pet_identifier, ignore_case=True)
         if pet:
             return (str(pet["_id"]), pet)
     except Exception:
         pass
     return (None, None)
 
+def compute_detected_pets(limit=None):
+    # dispositivi non registrati visti di recente, già ordinati per RSSI dall'ingest
+    return device_index.unregistered(limit)
+
+def detected_feed_payload():
+    """
+    Dispositivi rilevati per il live feed: senza last_seen e con rssi arrotondato a LIVE_FEED_RSSI_STEP,
+    ordinati per rssi arrotondato e MAC. Ogni pacchetto BLE cambia last_seen e rssi: così publish scarta
+    le liste che non cambiano nulla di visibile.
+    """
+    out = []
+    for dev in compute_detected_pets():
+        rssi = dev.get("rssi")
+        out.append({
+            "mac_address": dev["mac_address"],
+            "bt_name": dev.get("bt_name", ""),
+            "anchor_id": dev.get("anchor_id"),
+            "rssi": round(rssi / LIVE_FEED_RSSI_STEP) * LIVE_FEED_RSSI_STEP if rssi is not None else None,
+        })
+    out.sort(key=lambda d: (d["rssi"] is None, -(d["rssi"] or 0), d["mac_address"]))
+    return out
+
 @app.route('/detected_pets')
 @login_required
 def detected_pets():
-    # Recupera tutti i MAC già associati a un pet (normalizzati)
-    registered_macs = set()
-    try:
-        for p in db.pets.find():
-            mac = p.get("mac_address")
-            if mac:
-                registered_macs.add(mac)
-    except Exception as e:
-        print("[DETECTED_PETS] Errore lettura pets dal DB:", e)
-
-    # Costruiamo lista mostrata in UI partendo da seen_devices per includere i non-registrati
-    pets = []
-    cutoff = time.time() - 300  # mostra solo dispositivi visti negli ultimi 5 minuti
-    for mac, info in seen_devices.items():
-        if mac in registered_macs:
-            continue  # escludi già registrati (non devono comparire nella lista "da registrare")
-        if info.get("last_seen", 0) < cutoff:
-            continue
-        pets.append({
-            "mac_address": mac,
-            "bt_name": info.get("bt_name", ""),
-            "rssi": info.get("last_rssi"),
-            "anchor_id": info.get("last_anchor"),
-            "last_seen": info.get("last_seen")
-        })
-    pets.sort(key=lambda p: p.get("rssi", -200), reverse=True)
-    return jsonify({"pets": pets})
+    limit = request.args.get("limit", type=int)
+    return jsonify({"pets": compute_detected_pets(limit)})
 
 
 @app.route('/localizza')
@@ -887,24 +883,22 @@ def localizza():
     user = auth_manager.get_user_info(session['username'])
     pets = db.get_pets_for_user(user['_id'])
 
-    simple_pets = []
-    for p in pets:
-        mac = p.get("mac_address")
-        gps_data = None
-        gps_available = False
+    # stato corrente di tutti i pet in blocco (nessuna query per singolo pet)
+    pets_by_id = {str(p.get("_id")): p for p in pets}
+    states = live_states_for(list(pets_by_id), pets_by_id)
 
-        if mac:
-            last_pos = db.positions.find_one({"pet_mac": mac}, sort=[("timestamp", -1)])
-            if last_pos and last_pos.get("lat") and last_pos.get("lon"):
-                gps_data = {"lat": float(last_pos["lat"]), "lon": float(last_pos["lon"])}
-                gps_available = True
+    simple_pets = []
+    for pet_id, p in pets_by_id.items():
+        state = states.get(pet_id) or {}
+        gps_data = state.get("gps") if p.get("mac_address") else None
 
         simple_pets.append({
-            "_id": str(p.get("_id")),
+            "_id": pet_id,
             "name": p.get("name", "Senza nome"),
-            "mac_address": mac,
-            "gps_available": gps_available,
-            "gps": gps_data
+            "mac_address": p.get("mac_address"),
+            "gps_available": gps_data is not None,
+            "gps": gps_data,
+            "location": location_from_state(state or None)[0],
         })
 
     return render_template('localizza.html', pets=simple_pets)
@@ -913,36 +907,16 @@ def localizza():
 @login_required
 def get_latest_env(pet_id):
     """
-    Restituisce l'ultima lettura ambientale cercando, nell'ordine:
-      1) MAC associato al pet (formato normalizzato con :)
-      2) pet_id (l'_id del documento pet)
-      3) fallback "global"
+    Restituisce l'ultima lettura ambientale dallo stato corrente del pet (chiave canonica: MAC del
+    collare o pet_id, letta una sola volta al primo caricamento), con fallback sulla lettura "global".
     """
     try:
-        # 1) prova per MAC associato al pet 
-        env = None
-        try:
-            pet = db.get_pet_by_id(pet_id)
-        except Exception:
-            pet = None
-
-        if pet and pet.get("mac_address"):
-            mac_norm = normalize_mac(pet.get("mac_address"))
-            if mac_norm:
-                env = latest_env.get(mac_norm) or db.get_latest_env(mac_norm)
-            # prova anche senza i due punti (AABBCC..), nel caso in cui in DB sia salvato così
-            if not env and mac_norm and ':' in mac_norm:
-                mac_nocolon = mac_norm.replace(":", "")
-                env = latest_env.get(mac_nocolon) or db.get_latest_env(mac_nocolon)
-
-        # 2) se non trovato tramite MAC, prova per pet_id (chiave dell'app)
-        if not env:
-            key_pet = str(pet_id)
-            env = latest_env.get(key_pet) or db.get_latest_env(key_pet)
+        state = live_state_for(pet_id)
+        env = state["env"] if state else None
 
-        # 3) fallback globale
+        # fallback globale
         if not env:
-            env = latest_env.get("global") or db.get_latest_env("global")
+            env = global_env_state()["env"]
 
         if not env:
             print(f"[GET_LATEST_ENV] Nessun env trovato (pet_id={pet_id})")
@@ -969,6 +943,455 @@ def get_latest_env(pet_id):
 
 
 
+# ===== ALLARMI =====
+def load_pet_alert_rules(pet_id):
+    """Regole del singolo pet: soglie di temperatura del documento pet + regole personalizzate."""
+    rules = []
+    try:
+        pet = db.get_pet_by_id(pet_id)
+    except Exception:
+        pet = None
+    if pet:
+        if pet.get("temp_max") is not None:
+            rules.append({"id": "temp_max", "kind": "temp_above", "value": pet["temp_max"]})
+        if pet.get("temp_min") is not None:
+            rules.append({"id": "temp_min", "kind": "temp_below", "value": pet["temp_min"]})
+    return rules + db.get_alert_rules(pet_id)
+
+
+def load_global_alert_rules():
+    """Regole valide per tutti i pet: perimetro globale, stanze non consentite, regole personalizzate "*"."""
+    center = db.get_perimeter_center() or (45.123456, 9.123456)
+    radius = db.get_perimeter_radius() or 50
+    rules = [
+        {"id": "perimeter", "kind": "outside_circle", "lat": center[0], "lon": center[1], "radius": radius},
+        {"id": "rooms", "kind": "room_forbidden"},
+    ]
+    return rules + db.get_alert_rules("*")
+
+
+alert_rules = AlertRuleEngine(load_pet_alert_rules, load_global_alert_rules, ZoneInfo("Europe/Rome"))
+
+
+def _rule_pet_ids():
+    """pet_id su cui l'utente può gestire regole: i suoi pet, più "*" (tutti i pet) per l'amministratore."""
+    user = auth_manager.get_user_info(session['username'])
+    pet_ids = {str(p["_id"]) for p in db.get_pets_for_user(user["_id"])} if user else set()
+    if session['username'] == ADMIN_USERNAME:
+        pet_ids.add("*")
+    return pet_ids
+
+
+@app.route('/alert_rules', methods=['GET', 'POST'])
+@login_required
+def alert_rules_view():
+    """
+    Regole d'allarme personalizzate. POST (JSON), es. cucina vietata di notte per tutti i pet:
+    {"pet_id": "*", "kind": "room_forbidden", "rooms": ["Cucina"], "window": {"start": "22:00", "end": "07:00"}}
+    """
+    allowed = _rule_pet_ids()
+    if request.method == 'GET':
+        return jsonify({"rules": [dict(r, _id=str(r["_id"])) for r in db.list_alert_rules()
+                                  if r.get("pet_id") in allowed]})
+
+    doc = request.get_json(silent=True) or {}
+    if doc.get("kind") not in RULE_KINDS or not doc.get("pet_id"):
+        return jsonify({"error": f"pet_id e kind ({', '.join(RULE_KINDS)}) sono obbligatori"}), 400
+    doc = {k: v for k, v in doc.items() if k not in ("_id", "id")}
+    doc["pet_id"] = str(doc["pet_id"])
+    if doc["pet_id"] not in allowed:
+        return jsonify({"error": "Pet non trovato o regola globale riservata all'amministratore"}), 403
+    try:
+        compile_rule(dict(doc, id="new"), alert_rules.tz)
+    except Exception as e:
+        return jsonify({"error": f"Regola non valida: {e}"}), 400
+    rule_id = db.add_alert_rule(doc)
+    alert_rules.invalidate(None if doc["pet_id"] == "*" else doc["pet_id"])
+    return jsonify({"_id": str(rule_id)}), 201
+
+
+@app.route('/alert_rules/<rule_id>', methods=['DELETE'])
+@login_required
+def delete_alert_rule(rule_id):
+    # solo tra le regole dei pet dell'utente (e quelle globali per l'amministratore)
+    owned = any(str(r["_id"]) == rule_id for pet_id in _rule_pet_ids() for r in db.get_alert_rules(pet_id))
+    try:
+        rule = db.delete_alert_rule(rule_id) if owned else None
+    except Exception:
+        rule = None
+    if not rule:
+        return jsonify({"error": "Regola non trovata"}), 404
+    alert_rules.invalidate(None if rule.get("pet_id") == "*" else rule.get("pet_id"))
+    return jsonify({"deleted": rule_id})
+
+
+def pet_gps_str(pet_id):
+    state = live_state.get(pet_id)
+    gps = state.get("gps") if state else None
+    return f"{gps['lat']:.6f}, {gps['lon']:.6f}" if gps else None
+
+
+def notify_pet_alert(pet_id, gps=None, rssi=None, pet_name=None, pet_mac=None):
+    """Passa a notify_events lo stato d'allarme confermato del pet (non quello degli altri pet)."""
+    st = alert_states.snapshot(pet_id)
+    notify_events(
+        is_outside=st["is_outside"],
+        temp_high=st["temp_high"],
+        temp_low=st["temp_low"],
+        gps=gps,
+        temp_value=st["temp_value"],
+        temp_min=st["temp_min"],
+        temp_max=st["temp_max"],
+        ble_restricted=st["restricted_room"] is not None,
+        room=st["restricted_room"],
+        rssi=rssi,
+        pet_name=pet_name,
+        pet_mac=pet_mac
+    )
+
+
+# ===== FEED LIVE (Server-Sent Events) =====
+def location_payload(pet_id, state):
+    return {
+        "pet_id": pet_id,
+        "room": state.get("room"),
+        "room_last_seen": int(state["room_ts"]) if state.get("room_ts") else None,
+        "gps": state.get("gps"),
+        "gps_last_seen": int(state["gps_ts"]) if state.get("gps_ts") else None,
+    }
+
+
+def env_payload(pet_id, state):
+    env = state.get("env") or {}
+    return {
+        "pet_id": pet_id,
+        "temp": env.get("temp"),
+        "hum": env.get("hum"),
+        "timestamp": int(state["env_ts"]) if state.get("env_ts") else None,
+    }
+
+
+def publish_live_state(pet_id, state):
+    # LiveFeed inoltra solo se il payload è cambiato; i gruppi ancora vuoti non si pubblicano
+    if state.get("room") or state.get("gps"):
+        live_feed.publish("location", pet_id, location_payload(pet_id, state))
+    if state.get("env"):
+        live_feed.publish("env", pet_id, env_payload(pet_id, state))
+
+live_state.on_change = publish_live_state
+
+
+def live_feed_ticker():
+    """Ricalcola dispositivi rilevati e ancore online (anche per le scadenze) solo se qualcuno è in ascolto."""
+    while True:
+        time.sleep(LIVE_FEED_TICK_SEC)
+        try:
+            if live_feed.has_subscribers("detected"):
+                live_feed.publish("detected", None, detected_feed_payload())
+            if live_feed.has_subscribers("anchors"):
+                live_feed.publish("anchors", None, compute_anchors_online())
+        except Exception as e:
+            print("[LIVE FEED] Errore aggiornamento periodico:", e)
+
+def start_live_feed_ticker():
+    t = threading.Thread(target=live_feed_ticker, daemon=True)
+    t.start()
+
+
+@app.route('/events')
+@login_required
+def events():
+    """
+    Canale push per le dashboard: ?topics=location,env,detected,anchors&pets=<id>,<id>
+    Alla connessione invia uno snapshot, poi solo i cambiamenti (più un commento di keep-alive).
+    """
+    topics = [t for t in request.args.get("topics", "location,env").split(",")
+              if t in ("location", "env", "detected", "anchors")]
+    pet_ids = [p for p in request.args.get("pets", "").split(",") if p]
+    # "global" = lettura ambientale di fallback per i pet senza sensore proprio
+    sub = live_feed.subscribe(topics, pet_ids + ["global"])
+
+    def snapshot():
+        for pet_id in pet_ids:
+            try:
+                state = live_state_for(pet_id)
+            except Exception:
+                state = None
+            if not state:
+                continue
+            if "location" in topics:
+                yield sse_event("location", location_payload(pet_id, state))
+            if "env" in topics:
+                if state.get("env"):
+                    yield sse_event("env", env_payload(pet_id, state))
+                else:
+                    yield sse_event("env", env_payload("global", global_env_state()))
+        if "detected" in topics:
+            yield sse_event("detected", detected_feed_payload())
+        if "anchors" in topics:
+            yield sse_event("anchors", compute_anchors_online())
+
+    def generate():
+        try:
+            yield from snapshot()
+            while True:
+                try:
+                    topic, _, payload = sub.queue.get(timeout=LIVE_FEED_HEARTBEAT_SEC)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if sub.overflow:
+                    # delta persi: svuota la coda e ricomincia da uno snapshot
+                    sub.overflow = False
+                    while not sub.queue.empty():
+                        sub.queue.get_nowait()
+                    yield from snapshot()
+                    continue
+                yield sse_event(topic, payload)
+        finally:
+            live_feed.unsubscribe(sub)
+
+    resp = app.response_class(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+# ===== STORICO JSON (paginazione keyset) =====
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "500"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "5000"))
+HISTORY_POSITION_FIELDS = ("timestamp", "source", "entry_type", "room", "lat", "lon", "rssi", "pet_mac", "pet_name")
+HISTORY_ENV_FIELDS = ENV_FIELDS
+
+
+def _parse_history_time(value, default):
+    """Accetta ISO 8601 o epoch in secondi; senza fuso orario si assume UTC."""
+    if not value:
+        return default
+    try:
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    except ValueError:
+        return normalize_timestamp(value)
+
+
+def _encode_history_cursor(after):
+    ts, rank, last_id = after
+    raw = f"{normalize_timestamp(ts).isoformat()}|{rank}|{last_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_history_cursor(token):
+    raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    ts, rank, last_id = raw.split("|", 2)
+    # id non valido -> InvalidId qui, cioè 400, invece di un errore nel backend
+    ObjectId(last_id)
+    return normalize_timestamp(ts), int(rank), last_id
+
+
+def _history_json_value(v):
+    if isinstance(v, datetime):
+        return normalize_timestamp(v).isoformat().replace("+00:00", "Z")
+    if isinstance(v, ObjectId):
+        return str(v)
+    return v
+
+
+def _history_item(rank, doc):
+    item = {"id": str(doc.get("_id"))}
+    if rank == 1:
+        item["kind"] = "segment"
+    for k, v in doc.items():
+        if k != "_id":
+            item[k] = _history_json_value(v)
+    return item
+
+
+def _history_response(fetch_page, allowed_fields):
+    """
+    Parametri comuni: from/to (ISO o epoch, default ultime 24h), limit, fields (lista separata da virgole),
+    cursor (dalla risposta precedente), format=ndjson per lo streaming dell'intero intervallo.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        start = _parse_history_time(request.args.get("from"), now - timedelta(days=1))
+        end = _parse_history_time(request.args.get("to"), now)
+        limit = min(max(int(request.args.get("limit", HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        after = _decode_history_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except Exception as e:
+        return jsonify({"error": f"Parametri non validi: {e}"}), 400
+
+    fields = None
+    if request.args.get("fields"):
+        fields = [f for f in request.args["fields"].split(",") if f in allowed_fields]
+
+    if request.args.get("format") == "ndjson":
+        def generate(after):
+            while True:
+                items, after = fetch_page(start, end, after, limit, fields)
+                for rank, doc in items:
+                    yield json.dumps(_history_item(rank, doc)) + "\n"
+                if not after:
+                    break
+        return app.response_class(stream_with_context(generate(after)), mimetype="application/x-ndjson")
+
+    items, next_after = fetch_page(start, end, after, limit, fields)
+    return jsonify({
+        "items": [_history_item(rank, doc) for rank, doc in items],
+        "next_cursor": _encode_history_cursor(next_after) if next_after else None
+    })
+
+
+@app.route('/history/positions/<pet_id>')
+@login_required
+def history_positions(pet_id):
+    try:
+        pet = db.get_pet_by_id(pet_id)
+    except Exception:
+        pet = None
+    if not pet:
+        return jsonify({"error": "Pet non trovato"}), 404
+
+    def fetch_page(start, end, after, limit, fields):
+        return db.page_positions(pet_id, start, end, after=after, limit=limit, fields=fields)
+    return _history_response(fetch_page, HISTORY_POSITION_FIELDS)
+
+
+@app.route('/history/env/<pet_id>')
+@login_required
+def history_env(pet_id):
+    try:
+        pet = db.get_pet_by_id(pet_id)
+    except Exception:
+        pet = None
+    if not pet:
+        return jsonify({"error": "Pet non trovato"}), 404
+    key = env_key_for_pet(pet_id, pet)
+
+    def fetch_page(start, end, after, limit, fields):
+        return db.page_env(key, start, end, after=after, limit=limit, fields=fields)
+    return _history_response(fetch_page, HISTORY_ENV_FIELDS)
+
+
+ENV_SERIES_DEFAULT_POINTS = int(os.getenv("ENV_SERIES_DEFAULT_POINTS", "500"))
+ENV_SERIES_MAX_POINTS = int(os.getenv("ENV_SERIES_MAX_POINTS", "5000"))
+
+
+def _rome_today_start():
+    return datetime.now(ZoneInfo("Europe/Rome")).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def env_range_closed(**_):
+    """Serie con `to` esplicito prima di oggi: i dati ambientali di giorni conclusi non cambiano più."""
+    try:
+        return bool(request.args.get("to")) and _parse_history_time(request.args["to"], None) < _rome_today_start()
+    except Exception:
+        return False
+
+
+def days_range_closed(**_):
+    """Intervallo di date locali con `to` esplicito prima di oggi."""
+    try:
+        return bool(request.args.get("to")) and date.fromisoformat(request.args["to"]) < _rome_today_start().date()
+    except ValueError:
+        return False
+
+
+@app.route('/history/env/<pet_id>/series')
+@login_required
+@negotiation.immutable(env_range_closed)
+def history_env_series(pet_id):
+    """
+    Serie temperatura/umidità ridotta lato server per i grafici.
+      mode=buckets (default): min/max/media per intervalli di `bucket` minuti (aggregazione Mongo);
+                              senza `bucket` l'intervallo è scelto per ottenere circa `points` bucket
+      mode=lttb: Largest-Triangle-Three-Buckets su `metric` (temp|hum) fino a `points` punti
+    """
+    try:
+        pet = db.get_pet_by_id(pet_id)
+    except Exception:
+        pet = None
+    if not pet:
+        return jsonify({"error": "Pet non trovato"}), 404
+
+    now = datetime.now(timezone.utc)
+    try:
+        start = _parse_history_time(request.args.get("from"), now - timedelta(days=1))
+        end = _parse_history_time(request.args.get("to"), now)
+        points = min(max(int(request.args.get("points", ENV_SERIES_DEFAULT_POINTS)), 3), ENV_SERIES_MAX_POINTS)
+        bucket_min = float(request.args["bucket"]) if request.args.get("bucket") else None
+    except Exception as e:
+        return jsonify({"error": f"Parametri non validi: {e}"}), 400
+    if bucket_min is not None and not math.isfinite(bucket_min):
+        return jsonify({"error": "bucket deve essere un numero finito"}), 400
+    if end <= start:
+        return jsonify({"error": "Intervallo non valido"}), 400
+
+    key = env_key_for_pet(pet_id, pet)
+    mode = request.args.get("mode", "buckets")
+
+    if mode == "lttb":
+        metric = request.args.get("metric", "temp")
+        if metric not in ("temp", "hum"):
+            return jsonify({"error": "metric deve essere temp o hum"}), 400
+        n, series = db.iter_env_series(key, start, end, metric)
+        sampled = lttb(series, points, n=n)
+        return jsonify({
+            "mode": "lttb",
+            "metric": metric,
+            "source_points": n,
+            "points": [[datetime.fromtimestamp(x, timezone.utc).isoformat().replace("+00:00", "Z"), y] for x, y in sampled]
+        })
+
+    range_sec = (end - start).total_seconds()
+    if bucket_min is not None and bucket_min > 0:
+        # un `bucket` piccolo su un intervallo lungo non deve produrre più di ENV_SERIES_MAX_POINTS bucket
+        bucket_sec = max(bucket_min * 60, 60, math.ceil(range_sec / ENV_SERIES_MAX_POINTS))
+    else:
+        # minuti interi, almeno uno
+        bucket_sec = max(60, math.ceil(range_sec / points / 60) * 60)
+    rows = db.env_buckets(key, start, end, bucket_sec)
+    return jsonify({
+        "mode": "buckets",
+        "bucket_sec": bucket_sec,
+        "buckets": [
+            {
+                "t": datetime.fromtimestamp(r["_id"] / 1000, timezone.utc).isoformat().replace("+00:00", "Z"),
+                "n": r["n"],
+                "temp": {"min": r.get("temp_min"), "max": r.get("temp_max"), "avg": r.get("temp_avg")},
+                "hum": {"min": r.get("hum_min"), "max": r.get("hum_max"), "avg": r.get("hum_avg")},
+            }
+            for r in rows
+        ]
+    })
+
+
+@app.route('/heatmap/<pet_id>')
+@login_required
+@negotiation.immutable(days_range_closed)
+def pet_heatmap(pet_id):
+    """
+    Heatmap delle posizioni GPS: from/to come date locali YYYY-MM-DD (default ultimi 7 giorni),
+    precision = cifre decimali della griglia in gradi.
+    """
+    today = datetime.now(ZoneInfo("Europe/Rome")).date()
+    try:
+        to_day = date.fromisoformat(request.args["to"]) if request.args.get("to") else today
+        from_day = date.fromisoformat(request.args["from"]) if request.args.get("from") else to_day - timedelta(days=6)
+        precision = int(request.args.get("precision", HEATMAP_DEFAULT_PRECISION))
+    except ValueError as e:
+        return jsonify({"error": f"Parametri non validi: {e}"}), 400
+    n_days = (to_day - from_day).days + 1
+    if n_days < 1 or n_days > HEATMAP_MAX_DAYS:
+        return jsonify({"error": f"Intervallo non valido (massimo {HEATMAP_MAX_DAYS} giorni)"}), 400
+    precision = min(max(precision, HEATMAP_MIN_PRECISION), HEATMAP_MAX_PRECISION)
+
+    days = [from_day + timedelta(days=i) for i in range(n_days)]
+    data = heatmap_cache.heatmap(pet_id, days, precision)
+    data["from"] = from_day.isoformat()
+    data["to"] = to_day.isoformat()
+    return jsonify(data)
+
+
 async def websocket_handler(websocket):
     """
     WebSocket handler :
@@ -979,7 +1402,6 @@ async def websocket_handler(websocket):
       - inoltra gps_update ai client SOLO se il messaggio contiene pet_id o pet_mac (evita gps anonimi che spostano marker)
     """
     global latest_gps
-    global current_is_outside, current_temp_high, current_temp_low, current_temp_value, current_temp_min, current_temp_max
     print(f"📡 Nuova connessione WebSocket da {websocket.remote_address}")
     connected_clients.add(websocket)
     try:
@@ -1115,6 +1537,7 @@ async def websocket_handler(websocket):
                                     db.save_position(pet_id=pet_id, entry_type=entry_type, **save_kwargs)
                                 except Exception as e:
                                     print("[WS-GPS] Errore salvataggio posizione:", e)
+                                live_state.update_gps(pet_id, lat_f, lon_f, time.time())
                             else:
                                 # diagnostico: fix GPS anonimo -> non salvo
                                 print("[WS-GPS] Fix GPS ricevuto ma nessuna associazione pet (no pet_id): non salvo in DB.")
@@ -1131,32 +1554,13 @@ async def websocket_handler(websocket):
                                 # non inoltrare gps anonimo ai client
                                 print("[WS-GPS] GPS anonimo ricevuto: non inoltrato ai client per evitare sovrascritture globali.")
 
-                            # NOTIFICA SOLO SU TRANSIZIONE per evitare spam ripetuto 
+                            # NOTIFICA SOLO SU TRANSIZIONE (confermata dopo ALERT_GEOFENCE_DWELL_SEC) per evitare spam ripetuto
                             try:
                                 if pet_id:
-                                    prev_outside = current_is_outside
-                                    # aggiorna stato globale (utile ma notifiche per pet vanno legate a pet_id)
-                                    current_is_outside = not inside
-                                    gps_str = f"{lat_f:.6f}, {lon_f:.6f}"
-
-                                    # aggiorna soglie temperatura pet-specifiche se abbiamo il documento
-                                    if pet_doc:
-                                        current_temp_min = pet_doc.get("temp_min")
-                                        current_temp_max = pet_doc.get("temp_max")
-
-                                    if current_is_outside != prev_outside:
-                                        print(f"[WS-GPS] Transizione perimetro (prev={prev_outside} now={current_is_outside}), invio notify_events")
-                                        notify_events(
-                                            is_outside=current_is_outside,
-                                            temp_high=current_temp_high,
-                                            temp_low=current_temp_low,
-                                            gps=gps_str,
-                                            temp_value=current_temp_value,
-                                            temp_min=current_temp_min,
-                                            temp_max=current_temp_max,
-                                            pet_mac=pet_mac,
-                                            pet_name=pet_name
-                                        )
+                                    fired = alert_rules.evaluate(pet_id, "gps", {"lat": lat_f, "lon": lon_f}, alert_states)
+                                    if fired:
+                                        print(f"[WS-GPS] Allarme per {pet_id}: {[r.id for r in fired]}, invio notify_events")
+                                        notify_pet_alert(pet_id, gps=f"{lat_f:.6f}, {lon_f:.6f}", pet_mac=pet_mac, pet_name=pet_name)
                             except Exception as e:
                                 print("[WS-GPS] Errore notify_events:", e)
 
@@ -1196,7 +1600,7 @@ async def websocket_handler(websocket):
                         pet_doc_env = None
                         pet_id_env = None
                         if mac_norm:
-                            pet_doc_env = db.pets.find_one({"mac_address": mac_norm})
+                            pet_doc_env = db.get_pet_by_mac(mac_norm)
                             if pet_doc_env:
                                 pet_id_env = str(pet_doc_env["_id"])
                         if not pet_doc_env and data.get("pet_id"):
@@ -1209,14 +1613,14 @@ async def websocket_handler(websocket):
                             except Exception:
                                 pet_doc_env = None
 
-                        if mac_norm:
-                            target_key = mac_norm
-                        elif pet_id_env:
-                            target_key = pet_id_env
-                        else:
-                            target_key = "global"
+                        # chiave canonica: MAC del collare, altrimenti pet_id, altrimenti global
+                        target_key = canonical_env_key(mac_norm or pet_id_env)
 
                         latest_env[target_key] = {"temp": temp_f, "hum": hum_f, "timestamp": timestamp}
+                        if pet_id_env:
+                            live_state.update_env(pet_id_env, temp_f, hum_f, _epoch(timestamp), timestamp)
+                        elif target_key == "global":
+                            live_state.update_env("global", temp_f, hum_f, _epoch(timestamp), timestamp)
                         try:
                             db.save_env_data(target_key, temp_f, hum_f, datetime.fromtimestamp(timestamp, timezone.utc))
                         except Exception as e:
@@ -1241,36 +1645,16 @@ async def websocket_handler(websocket):
                         except Exception as e:
                             print("[WS-ENV] Errore broadcast env_update:", e)
 
-                        # Valuta soglie se pet_doc_env presente
+                        # Valuta soglie se pet_doc_env presente: notifica solo all'ingresso in allarme (con isteresi)
                         try:
                             if pet_doc_env:
                                 p_name = pet_doc_env.get("name")
-                                p_min = pet_doc_env.get("temp_min")
-                                p_max = pet_doc_env.get("temp_max")
-                                if temp_f is not None and (p_min is not None or p_max is not None):
-                                    over_high = (p_max is not None and temp_f > float(p_max))
-                                    under_low = (p_min is not None and temp_f < float(p_min))
-                                    if over_high or under_low:
+                                if temp_f is not None:
+                                    event = {"temp": temp_f, "temp_min": pet_doc_env.get("temp_min"), "temp_max": pet_doc_env.get("temp_max")}
+                                    fired = alert_rules.evaluate(pet_id_env, "temp", event, alert_states)
+                                    if fired:
                                         print(f"[WS-ENV] Soglia superata per pet {p_name or mac_norm}: temp={temp_f} - invio notify")
-                                        gps_str = None
-                                        if latest_gps.get("lat") and latest_gps.get("lon"):
-                                            try:
-                                                gps_str = f"{float(latest_gps['lat']):.6f}, {float(latest_gps['lon']):.6f}"
-                                            except Exception:
-                                                gps_str = f"{latest_gps.get('lat')}, {latest_gps.get('lon')}"
-                                        notify_events(
-                                            is_outside=current_is_outside,
-                                            temp_high=over_high,
-                                            temp_low=under_low,
-                                            gps=gps_str,
-                                            temp_value=temp_f,
-                                            temp_min=p_min,
-                                            temp_max=p_max,
-                                            pet_mac=mac_norm,
-                                            pet_name=p_name
-                                        )
-                                    else:
-                                        print(f"[WS-ENV] Temperatura per {p_name or mac_norm} OK: {temp_f}°C (min={p_min} max={p_max})")
+                                        notify_pet_alert(pet_id_env, gps=pet_gps_str(pet_id_env), pet_mac=mac_norm, pet_name=p_name)
                             else:
                                 print("[WS-ENV] Nessun pet trovato per il MAC ricevuto; nessuna soglia valutata.")
                         except Exception as e:
@@ -1311,7 +1695,7 @@ def room_allowed_for_anchor(anchor_id: str):
     - in alternativa, match per mac_address usando anchors_online
     Ritorna (allowed_bool, room_doc or None).
     """
-    room = db.rooms.find_one({"name": anchor_id})
+    room = db.get_room_by_name(anchor_id)
     if room:
         return bool(room.get("allowed", True)), room
 
@@ -1321,7 +1705,7 @@ def room_allowed_for_anchor(anchor_id: str):
             anchor_mac = mac
             break
     if anchor_mac:
-        room = db.rooms.find_one({"mac_address": anchor_mac})
+        room = db.get_room_by_mac(anchor_mac)
         if room:
             return bool(room.get("allowed", True)), room
 
@@ -1334,8 +1718,7 @@ def on_mqtt_connect(client, userdata, flags, rc):
 
 def on_mqtt_message(client, userdata, msg):
     global main_asyncio_loop, latest_env
-    global current_is_outside, current_temp_high, current_temp_low, current_temp_value, current_temp_min, current_temp_max, latest_gps
-    global current_in_restricted_room, current_restricted_room, last_ble_state
+    global latest_gps, last_ble_state
 
     try:
         payload = msg.payload.decode()
@@ -1371,15 +1754,10 @@ def on_mqtt_message(client, userdata, msg):
                     pet_mac = normalize_mac(pet_mac_raw)
 
                     # Aggiorna la mappa di tutti i dispositivi visti (per la UI / registrazione)
-                    seen_devices[pet_mac] = {
-                        "bt_name": bt_name,
-                        "last_seen": time.time(),
-                        "last_anchor": anchor_id,
-                        "last_rssi": rssi
-                    }
+                    registered = device_index.seen(pet_mac, bt_name, anchor_id, rssi)
 
-                    # Verifica se il MAC è registrato nel DB: SOLO IN TAL CASO costruiamo/aggiorniamo la finestra a 3 campioni
-                    pet_doc = db.pets.find_one({"mac_address": pet_mac})
+                    # Verifica se il MAC è registrato: SOLO IN TAL CASO costruiamo/aggiorniamo la finestra a 3 campioni
+                    pet_doc = db.get_pet_by_mac(pet_mac) if registered else None
                     if not pet_doc:
                         # Non registrato: non creare la rolling window, skip della logica di localizzazione/storico
                         #print(f"[MQTT] dispositivo non registrato: {pet_mac} (skip window).")
@@ -1412,7 +1790,7 @@ def on_mqtt_message(client, userdata, msg):
 
                                     # se trovato, cerca nella collezione rooms
                                     if anchor_mac:
-                                        room_doc = db.rooms.find_one({"mac_address": anchor_mac})
+                                        room_doc = db.get_room_by_mac(anchor_mac)
                                         if room_doc and room_doc.get("name"):
                                             room_name = room_doc["name"]
                                 except Exception as e:
@@ -1421,7 +1799,7 @@ def on_mqtt_message(client, userdata, msg):
                                 # --- risolvi il nome del pet partendo da bt_name ---
                                 pet_name_final = bt_name
                                 try:
-                                    pet_doc = db.pets.find_one({"bt_name": bt_name})
+                                    pet_doc = db.get_pet_by_bt_name(bt_name)
                                     if pet_doc and pet_doc.get("name"):
                                         pet_name_final = pet_doc["name"]
                                 except Exception as e:
@@ -1440,31 +1818,18 @@ def on_mqtt_message(client, userdata, msg):
                                     print(f"[BLE SAVE] OK: stanza={room_name}, pet={pet_name_final}, rssi={avg:.1f}")
                                 except Exception as e:
                                     print("[BLE SAVE] ERRORE durante save_position:", e)
-
-                                # Notifica se stanza NON accessibile
-                                if not allowed:
-                                    current_in_restricted_room = True
-                                    current_restricted_room = room_doc["name"] if room_doc else anchor_id
-                                    pet_name = pet_doc.get("name", "")
-                                    gps_str = f"{latest_gps['lat']}, {latest_gps['lon']}" if latest_gps.get("lat") and latest_gps.get("lon") else None
-
-                                    notify_events(
-                                        is_outside=current_is_outside,
-                                        temp_high=current_temp_high,
-                                        temp_low=current_temp_low,
-                                        gps=gps_str,
-                                        temp_value=current_temp_value,
-                                        temp_min=current_temp_min,
-                                        temp_max=current_temp_max,
-                                        ble_restricted=True,
-                                        room=current_restricted_room,
+                                live_state.update_room(pet_id, room_name, now_t)
+
+                                # Notifica solo all'ingresso (confermato dopo il tempo di permanenza) in una stanza vietata
+                                fired = alert_rules.evaluate(pet_id, "room", {"room": room_name, "allowed": allowed}, alert_states, now=now_t)
+                                if fired:
+                                    notify_pet_alert(
+                                        pet_id,
+                                        gps=pet_gps_str(pet_id),
                                         rssi=round(avg, 1),
-                                        pet_name=pet_name,
+                                        pet_name=pet_doc.get("name", "") if pet_doc else "",
                                         pet_mac=pet_mac
                                     )
-                                else:
-                                    current_in_restricted_room = False
-                                    current_restricted_room = None
 
                                 last_ble_state[pet_mac] = {"room": anchor_id, "t": now_t, "avg": avg}
             except Exception as e:
@@ -1486,7 +1851,11 @@ def start_mqtt_bridge():
     t.start()
 
 if __name__ == '__main__':
+    db.start_ingest_spool(on_replay=invalidate_replayed_days)
     ws_thread = threading.Thread(target=start_websocket_server, daemon=True)
     ws_thread.start()
     start_mqtt_bridge()
+    start_compaction_worker(db)
+    start_live_feed_ticker()
+    set_outbox(notification_outbox.start())
     app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
\ No newline at end of file
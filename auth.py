@@ -4,19 +4,21 @@ import bcrypt
 from datetime import datetime
 import secrets
 
+# account creato al primo avvio: l'unico che può gestire impostazioni valide per tutti i pet
+ADMIN_USERNAME = "admin"
+
 class AuthManager:
     def __init__(self, db):
         self.db = db
-        self.users_collection = db.db['users']
         self._ensure_admin_user()
 
     def _ensure_admin_user(self):
         """Crea utente admin di default SOLO se nessun utente esiste"""
-        if self.users_collection.count_documents({}) == 0:
+        if self.db.count_users() == 0:
             default_password = "admin123"
             password_hash = bcrypt.hashpw(default_password.encode('utf-8'), bcrypt.gensalt(rounds=12))
-            self.users_collection.insert_one({
-                "username": "admin",
+            self.db.insert_user({
+                "username": ADMIN_USERNAME,
                 "password_hash": password_hash,
                 "created_at": datetime.now(),
                 "last_login": None,
@@ -26,24 +28,21 @@ class AuthManager:
             print("⚠️  Cambia la password dopo il primo accesso!")
             
     def verify_password(self, username, password):
-        user = self.users_collection.find_one({"username": username, "is_active": True})
+        user = self.db.get_user(username, active_only=True)
         is_first_login = user and (user.get('last_login') is None)
         if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash']):
-            self.users_collection.update_one(
-                {"_id": user["_id"]},
-                {"$set": {"last_login": datetime.now()}}
-            )
+            self.db.update_user(user["_id"], {"last_login": datetime.now()})
             user['is_first_login'] = is_first_login  
             return user
         return None
     
     def register_user(self, username, password):
-        if self.users_collection.find_one({"username": username}):
+        if self.db.get_user(username):
             return {"success": False, "message": "Username già esistente"}
         if len(password) < 6:
             return {"success": False, "message": "La password deve essere almeno 6 caratteri"}
         password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
-        self.users_collection.insert_one({
+        self.db.insert_user({
             "username": username,
             "password_hash": password_hash,
             "created_at": datetime.now(),
@@ -53,8 +52,7 @@ class AuthManager:
         return {"success": True, "message": "Registrazione completata"}
     
     def delete_account(self, username):
-        result = self.users_collection.delete_one({"username": username})
-        return result.deleted_count == 1
+        return self.db.delete_user(username)
     
     def change_credentials(self, current_username, current_password, new_username=None, new_password=None):
         user = self.verify_password(current_username, current_password)
@@ -63,7 +61,7 @@ class AuthManager:
 
         updates = {}
         if new_username and new_username != current_username:
-            existing = self.users_collection.find_one({"username": new_username})
+            existing = self.db.get_user(new_username)
             if existing:
                 return {"success": False, "message": "Username già esistente"}
             updates["username"] = new_username
@@ -74,20 +72,15 @@ class AuthManager:
             updates["password_hash"] = password_hash
         if not updates:
             return {"success": False, "message": "Nessuna modifica fornita"}
-        self.users_collection.update_one(
-            {"_id": user["_id"]},
-            {"$set": updates}
-        )
+        self.db.update_user(user["_id"], updates)
         if "username" in updates:
             session['username'] = new_username
         return {"success": True, "message": "Credenziali aggiornate con successo"}
 
     def get_user_info(self, username):
-        user = self.users_collection.find_one(
-            {"username": username, "is_active": True},
-            {"password_hash": 0}
-        )
-        return user
+        # letto a ogni pagina: passa dalla cache di lettura di PetTrackerDB (se abilitata)
+        return self.db.cached(("user", username),
+                              lambda: self.db.get_user(username, active_only=True, include_hash=False))
 
 def login_required(f):
     @wraps(f)
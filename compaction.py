@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from timeline import normalize_timestamp, state_of
+
+# Le posizioni BLE più vecchie di questa età vengono compattate in segmenti
+COMPACT_AFTER_DAYS = float(os.getenv("POSITIONS_COMPACT_AFTER_DAYS", "7"))
+COMPACT_INTERVAL_SEC = int(os.getenv("POSITIONS_COMPACT_INTERVAL_SEC", "3600"))
+COMPACT_BATCH_SIZE = int(os.getenv("POSITIONS_COMPACT_BATCH_SIZE", "5000"))
+# Deve coincidere con il max_gap_seconds della timeline: oltre questo buco il segmento si spezza
+COMPACT_MAX_GAP_SEC = 1800
+
+ROME = ZoneInfo("Europe/Rome")
+
+
+class _Run:
+    """Sequenza di posizioni BLE consecutive con stesso stato e stessa stanza."""
+
+    def __init__(self, pet_id, doc, ts, tz):
+        self.pet_id = pet_id
+        self.entry_type = doc.get("entry_type")
+        self.room = doc.get("room")
+        self.state = state_of(doc)
+        self.first_id = doc["_id"]
+        self.start = doc["timestamp"]
+        self.start_aware = ts
+        self.end = doc["timestamp"]
+        self.end_aware = ts
+        self.local_date = ts.astimezone(tz).date()
+        self.ids = [doc["_id"]]
+        self.rssi_min = None
+        self.rssi_max = None
+        self._add_rssi(doc.get("rssi"))
+
+    def _add_rssi(self, rssi):
+        if rssi is None:
+            return
+        try:
+            rssi = float(rssi)
+        except (TypeError, ValueError):
+            return
+        self.rssi_min = rssi if self.rssi_min is None else min(self.rssi_min, rssi)
+        self.rssi_max = rssi if self.rssi_max is None else max(self.rssi_max, rssi)
+
+    def accepts(self, doc, ts, tz):
+        return (
+            doc.get("entry_type") == self.entry_type
+            and doc.get("room") == self.room
+            and (ts - self.end_aware).total_seconds() <= COMPACT_MAX_GAP_SEC
+            and ts.astimezone(tz).date() == self.local_date
+        )
+
+    def add(self, doc, ts):
+        self.end = doc["timestamp"]
+        self.end_aware = ts
+        self.ids.append(doc["_id"])
+        self._add_rssi(doc.get("rssi"))
+
+    def to_segment(self):
+        return {
+            # _id deterministico: rieseguire la compattazione dopo un crash sovrascrive, non duplica
+            "_id": f"{self.pet_id}:{self.first_id}",
+            "pet_id": self.pet_id,
+            "state": self.state,
+            "source": "ble",
+            "entry_type": self.entry_type,
+            "room": self.room,
+            "start": self.start,
+            "end": self.end,
+            "count": len(self.ids),
+            "rssi_min": self.rssi_min,
+            "rssi_max": self.rssi_max,
+        }
+
+
+def _compactable(doc):
+    # Solo BLE: le posizioni GPS hanno coordinate che un segmento non può rappresentare
+    return doc.get("source") == "ble" and not isinstance(doc.get("timestamp"), str)
+
+
+def _flush(db, runs):
+    """Scrive i segmenti, verifica che coprano tutti i campioni e solo allora elimina le posizioni grezze."""
+    if not runs:
+        return 0
+    if not db.store_segments([r.to_segment() for r in runs]):
+        return 0
+    return db.delete_positions([i for r in runs for i in r.ids])
+
+
+def compact_pet_positions(db, pet_id, cutoff, tz=ROME, batch_size=COMPACT_BATCH_SIZE):
+    """Compatta le posizioni di un pet con timestamp < cutoff. Ritorna il numero di posizioni rimosse."""
+    cursor = db.iter_compactable_positions(pet_id, cutoff)
+
+    removed = 0
+    runs = []
+    pending_samples = 0
+    cur = None
+    for doc in cursor:
+        ts = normalize_timestamp(doc.get("timestamp"))
+        if ts is None or not _compactable(doc):
+            # una posizione non compattabile interrompe la sequenza (resta nella collezione grezza)
+            cur = None
+            continue
+        if cur and cur.accepts(doc, ts, tz):
+            cur.add(doc, ts)
+            pending_samples += 1
+            continue
+        # nuova sequenza: è il momento giusto per scaricare un batch completo
+        if pending_samples >= batch_size:
+            removed += _flush(db, runs)
+            runs = []
+            pending_samples = 0
+        cur = _Run(pet_id, doc, ts, tz)
+        runs.append(cur)
+        pending_samples += 1
+    removed += _flush(db, runs)
+    return removed
+
+
+def compact_positions(db, older_than_days=COMPACT_AFTER_DAYS, tz=ROME):
+    """Un giro di compattazione su tutti i pet con posizioni BLE più vecchie di `older_than_days`."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    total = 0
+    for pet_id in db.compaction_pet_ids(cutoff):
+        if not pet_id:
+            continue
+        try:
+            removed = compact_pet_positions(db, pet_id, cutoff, tz)
+            total += removed
+            if removed:
+                print(f"[COMPACT] Pet {pet_id}: {removed} posizioni compattate")
+        except Exception as e:
+            print(f"[COMPACT] Errore compattazione pet {pet_id}: {e}")
+    return total
+
+
+def _compaction_loop(db, interval):
+    while True:
+        try:
+            compact_positions(db)
+        except Exception as e:
+            print("[COMPACT] Errore:", e)
+        time.sleep(interval)
+
+
+def start_compaction_worker(db, interval=COMPACT_INTERVAL_SEC):
+    t = threading.Thread(target=_compaction_loop, args=(db, interval), daemon=True)
+    t.start()
+    return t
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from storage import open_database
+
+    load_dotenv()
+    n = compact_positions(open_database())
+    print(f"[COMPACT] Totale posizioni compattate: {n}")
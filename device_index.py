@@ -0,0 +1,95 @@
+import bisect
+import threading
+import time
+
+
+class DeviceIndex:
+    """
+    Dispositivi BLE visti dalle ancore. Tiene in memoria l'insieme dei MAC registrati (caricato dal DB
+    alla prima richiesta e invalidato a ogni scrittura sui pet) e la lista dei dispositivi non registrati
+    ordinata per RSSI decrescente, aggiornata dall'ingest: la lettura è una scansione della lista già pronta.
+    """
+
+    def __init__(self, load_registered, max_age=300):
+        self._load_registered = load_registered
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.devices = {}       # mac -> {"bt_name", "last_seen", "last_anchor", "last_rssi"}
+        self._registered = None
+        self._order = []        # [(-rssi, mac)] ordinata, solo non registrati
+        self._keys = {}         # mac -> chiave in _order
+
+    def _registered_macs(self):
+        # chiamata con il lock acquisito
+        if self._registered is None:
+            try:
+                self._registered = set(self._load_registered())
+            except Exception as e:
+                print("[DEVICE INDEX] Errore lettura MAC registrati:", e)
+                return set()
+            self._rebuild()
+        return self._registered
+
+    def _rebuild(self):
+        self._order = sorted((-info["last_rssi"], mac) for mac, info in self.devices.items()
+                             if mac not in self._registered)
+        self._keys = {entry[1]: entry for entry in self._order}
+
+    def _unindex(self, mac):
+        key = self._keys.pop(mac, None)
+        if key is not None:
+            i = bisect.bisect_left(self._order, key)
+            if i < len(self._order) and self._order[i] == key:
+                del self._order[i]
+
+    def is_registered(self, mac):
+        with self._lock:
+            return mac in self._registered_macs()
+
+    def seen(self, mac, bt_name, anchor_id, rssi, ts=None):
+        """Aggiorna il dispositivo dopo una lettura RSSI; ritorna True se il MAC è registrato."""
+        with self._lock:
+            self.devices[mac] = {
+                "bt_name": bt_name,
+                "last_seen": ts if ts is not None else time.time(),
+                "last_anchor": anchor_id,
+                "last_rssi": rssi
+            }
+            registered = mac in self._registered_macs()
+            if not registered:
+                self._unindex(mac)
+                key = (-rssi, mac)
+                bisect.insort(self._order, key)
+                self._keys[mac] = key
+            return registered
+
+    def invalidate_registered(self):
+        """Da chiamare dopo ogni inserimento, modifica o cancellazione di pet."""
+        with self._lock:
+            self._registered = None
+
+    def unregistered(self, limit=None):
+        """Dispositivi non registrati visti negli ultimi `max_age` secondi, per RSSI decrescente."""
+        cutoff = time.time() - self.max_age
+        out = []
+        with self._lock:
+            self._registered_macs()
+            expired = []
+            for _, mac in self._order:
+                info = self.devices[mac]
+                if info["last_seen"] < cutoff:
+                    expired.append(mac)
+                    continue
+                out.append({
+                    "mac_address": mac,
+                    "bt_name": info.get("bt_name", ""),
+                    "rssi": info.get("last_rssi"),
+                    "anchor_id": info.get("last_anchor"),
+                    "last_seen": info.get("last_seen")
+                })
+                if limit is not None and len(out) >= limit:
+                    break
+            # i dispositivi scaduti escono dall'indice; restano in `devices` finché non tornano visibili
+            for mac in expired:
+                self._unindex(mac)
+        return out
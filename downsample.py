@@ -0,0 +1,49 @@
+def _avg(bucket):
+    return (sum(p[0] for p in bucket) / len(bucket), sum(p[1] for p in bucket) / len(bucket))
+
+
+def lttb(points, threshold, n=None):
+    """
+    Largest-Triangle-Three-Buckets: riduce una serie di punti (x, y) ordinata per x a `threshold` punti
+    mantenendone la forma visiva. Se `n` (numero di punti) è noto, `points` può essere un cursore:
+    viene consumato in streaming tenendo in memoria solo due bucket alla volta.
+    """
+    if n is None:
+        points = list(points)
+        n = len(points)
+    if threshold < 3 or n <= threshold:
+        return list(points)
+
+    # confini dei bucket in aritmetica intera: floor(i * (n-2) / (threshold-2)) senza errori di arrotondamento
+    span, parts = n - 2, threshold - 2
+    out = []
+    prev = None  # bucket completo, in attesa della media del bucket successivo
+    cur = []
+    cur_idx = 0
+    next_start = span // parts + 1
+
+    def select(bucket, next_avg):
+        ax, ay = out[-1][0], out[-1][1]
+        cx, cy = next_avg
+        out.append(max(bucket, key=lambda p: abs((ax - cx) * (p[1] - ay) - (ax - p[0]) * (cy - ay))))
+
+    for j, p in enumerate(points):
+        if j == 0:
+            out.append(p)
+            continue
+        if j >= n - 1:
+            if prev:
+                select(prev, _avg(cur))
+            select(cur, (p[0], p[1]))
+            out.append(p)
+            return out
+        if j >= next_start:
+            if prev:
+                select(prev, _avg(cur))
+            prev = cur
+            cur = []
+            cur_idx += 1
+            next_start = (cur_idx + 1) * span // parts + 1
+        cur.append(p)
+    # la sorgente ha fornito meno di n punti (dati cambiati tra conteggio e lettura): coda non ridotta
+    return out + (prev or []) + cur
@@ -0,0 +1,97 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from lru import LRUCache
+
+# precisione = cifre decimali della griglia in gradi (3 ≈ 110 m, 4 ≈ 11 m)
+HEATMAP_MIN_PRECISION = 2
+HEATMAP_MAX_PRECISION = 5
+HEATMAP_DEFAULT_PRECISION = 4
+
+
+class HeatmapCache:
+    """
+    Celle GPS per (pet, giorno locale, precisione). I giorni conclusi sono immutabili: restano in memoria
+    (LRU) e su Mongo; il giorno corrente viene sempre ricalcolato. Più giorni si uniscono sommando le celle.
+    """
+
+    def __init__(self, db, tz, max_entries=4096):
+        self.db = db
+        self.tz = tz
+        self._entries = LRUCache(max_entries)
+
+    def invalidate(self, pet_id, dates=None):
+        """Scarta le celle di un pet (tutti i giorni o solo `dates`, date ISO) da memoria e DB."""
+        pet_id = str(pet_id)
+        dates = set(dates) if dates else None
+        self._entries.discard_where(lambda key: key[0] == pet_id and (dates is None or key[1] in dates))
+        try:
+            self.db.delete_heatmap_days(pet_id, sorted(dates) if dates else None)
+        except Exception as e:
+            print("[HEATMAP] Errore invalidazione:", e)
+
+    def day_cells(self, pet_id, days, precision):
+        """Ritorna le celle ([[y, x, conteggio], ...]) di ciascun giorno di `days` (date locali consecutive)."""
+        pet_id = str(pet_id)
+        today = datetime.now(self.tz).date()
+        keys = [d.isoformat() for d in days]
+        result = {}
+
+        missing = []
+        for d, key in zip(days, keys):
+            if d < today:
+                cells = self._entries.get((pet_id, key, precision))
+                if cells is not None:
+                    result[key] = cells
+                    continue
+            missing.append(key)
+
+        past_missing = [k for k in missing if k < today.isoformat()]
+        if past_missing:
+            try:
+                stored = self.db.get_heatmap_days(pet_id, past_missing, precision)
+            except Exception as e:
+                print("[HEATMAP] Errore lettura cache:", e)
+                stored = {}
+            for key, cells in stored.items():
+                result[key] = cells
+                self._entries.put((pet_id, key, precision), cells)
+            missing = [k for k in missing if k not in result]
+
+        if missing:
+            # una sola aggregazione per tutto l'intervallo dei giorni mancanti
+            first = datetime.fromisoformat(missing[0]).replace(tzinfo=self.tz)
+            last = datetime.fromisoformat(missing[-1]).replace(tzinfo=self.tz) + timedelta(days=1)
+            by_day = self.db.aggregate_gps_cells(
+                pet_id, first.astimezone(timezone.utc), last.astimezone(timezone.utc), precision, self.tz.key
+            )
+            for key in missing:
+                cells = by_day.get(key, [])
+                result[key] = cells
+                if key < today.isoformat():
+                    self._entries.put((pet_id, key, precision), cells)
+                    try:
+                        self.db.save_heatmap_day(pet_id, key, precision, cells)
+                    except Exception as e:
+                        print("[HEATMAP] Errore salvataggio cache:", e)
+
+        return [result[k] for k in keys]
+
+    def heatmap(self, pet_id, days, precision):
+        totals = Counter()
+        for cells in self.day_cells(pet_id, days, precision):
+            for y, x, n in cells:
+                totals[(y, x)] += n
+        scale = 10 ** precision
+        out = [
+            {"lat": (y + 0.5) / scale, "lon": (x + 0.5) / scale, "count": n}
+            for (y, x), n in totals.items()
+        ]
+        out.sort(key=lambda c: c["count"], reverse=True)
+        return {
+            "precision": precision,
+            "cell_deg": 1 / scale,
+            "cells": out,
+            "max": out[0]["count"] if out else 0,
+            "total": sum(totals.values()),
+        }
@@ -0,0 +1,165 @@
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING
+
+# Valori d'esempio per le forme delle query: all'explain interessa solo la forma, non il risultato
+_PET = "manifest-check"
+_MAC = "AA:BB:CC:DD:EE:FF"
+_T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_T1 = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+# Indici del database e query frequenti che ciascuno deve servire. `collection` è l'attributo di
+# PetTrackerDB (positions/envdata puntano alle collezioni time-series con MONGODB_TIMESERIES=1).
+# Una query è {"name", "filter", "sort", "projection", "limit"} per find oppure {"name", "pipeline"}.
+INDEX_MANIFEST = [
+    {"collection": "users", "keys": [("username", ASCENDING)], "options": {"unique": True}, "queries": [
+        {"name": "login / utente per username", "filter": {"username": "admin"}},
+    ]},
+    {"collection": "pets", "keys": [("owner_id", ASCENDING)], "queries": [
+        {"name": "pet dell'utente", "filter": {"owner_id": _PET}},
+    ]},
+    # Consigliato: evitare duplicati MAC
+    {"collection": "pets", "keys": [("mac_address", ASCENDING)],
+     "options": {"unique": True, "name": "uniq_mac_address"}, "queries": [
+        {"name": "pet per MAC (ingest env/RSSI)", "filter": {"mac_address": _MAC}},
+        {"name": "MAC registrati", "filter": {"mac_address": {"$nin": [None, ""]}},
+         "projection": {"mac_address": 1, "_id": 0}},
+    ]},
+    {"collection": "pets", "keys": [("bt_name", ASCENDING)], "queries": [
+        {"name": "pet per nome BLE", "filter": {"bt_name": "collare"}},
+    ]},
+    {"collection": "positions", "keys": [("pet_id", ASCENDING), ("timestamp", DESCENDING)], "queries": [
+        {"name": "ultima posizione del pet", "filter": {"pet_id": _PET},
+         "sort": [("timestamp", DESCENDING)], "limit": 1},
+        {"name": "posizioni recenti del pet", "filter": {"pet_id": _PET},
+         "sort": [("timestamp", DESCENDING)], "limit": 50},
+    ]},
+    # ultima posizione per (pet, sorgente) in blocco: $sort + $group/$first sul prefisso dell'indice
+    {"collection": "positions", "keys": [("pet_id", ASCENDING), ("source", ASCENDING), ("timestamp", DESCENDING)],
+     "queries": [
+        {"name": "ultime posizioni per pet e sorgente", "pipeline": [
+            {"$match": {"pet_id": {"$in": [_PET, "altro"]}, "source": {"$in": ["ble", "gps"]}}},
+            {"$sort": {"pet_id": ASCENDING, "source": ASCENDING, "timestamp": DESCENDING}},
+            {"$group": {"_id": {"pet_id": "$pet_id", "source": "$source"}, "timestamp": {"$first": "$timestamp"}}},
+        ]},
+    ]},
+    {"collection": "envdata", "keys": [("pet_id", ASCENDING), ("timestamp", DESCENDING)], "queries": [
+        {"name": "ultima lettura ambientale", "filter": {"pet_id": _MAC},
+         "sort": [("timestamp", DESCENDING)], "limit": 1},
+        {"name": "ultime letture per chiave", "pipeline": [
+            {"$match": {"pet_id": {"$in": [_MAC, "global"]}}},
+            {"$sort": {"pet_id": ASCENDING, "timestamp": DESCENDING}},
+            {"$group": {"_id": "$pet_id", "timestamp": {"$first": "$timestamp"}}},
+        ]},
+    ]},
+    # paginazione keyset dello storico
+    {"collection": "positions", "keys": [("pet_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+     "queries": [
+        {"name": "pagina storico posizioni", "filter": {"$and": [{"pet_id": _PET, "timestamp": {"$gte": _T0, "$lte": _T1}}]},
+         "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)], "limit": 500},
+        {"name": "posizioni da compattare", "filter": {"pet_id": _PET, "timestamp": {"$lt": _T0}},
+         "sort": [("timestamp", ASCENDING)]},
+    ]},
+    {"collection": "envdata", "keys": [("pet_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+     "queries": [
+        {"name": "pagina storico ambientale", "filter": {"$and": [{"pet_id": _MAC, "timestamp": {"$gte": _T0, "$lte": _T1}}]},
+         "sort": [("timestamp", ASCENDING), ("_id", ASCENDING)], "limit": 500},
+    ]},
+    {"collection": "rooms", "keys": [("owner_id", ASCENDING)], "queries": []},
+    {"collection": "rooms", "keys": [("name", ASCENDING)], "queries": [
+        {"name": "stanza per anchor_id", "filter": {"name": "Cucina"}},
+    ]},
+    {"collection": "rooms", "keys": [("mac_address", ASCENDING)], "queries": [
+        {"name": "stanza per MAC ancora", "filter": {"mac_address": _MAC}},
+    ]},
+    {"collection": "perimeters", "keys": [("pet_id", ASCENDING)], "queries": []},
+    {"collection": "perimeters", "keys": [("key", ASCENDING)], "queries": [
+        {"name": "perimetro globale", "filter": {"key": "global"}},
+    ]},
+    {"collection": "alert_rules", "keys": [("pet_id", ASCENDING)], "queries": [
+        {"name": "regole d'allarme del pet", "filter": {"pet_id": _PET}},
+        {"name": "elenco regole", "filter": {}, "sort": [("pet_id", ASCENDING)]},
+    ]},
+    {"collection": "notification_outbox", "keys": [("dedupe_key", ASCENDING)],
+     "options": {"unique": True, "name": "uniq_dedupe_key"}, "queries": []},
+    {"collection": "notification_outbox", "keys": [("status", ASCENDING), ("available_at", ASCENDING)], "queries": [
+        {"name": "notifiche da prendere in carico",
+         "filter": {"status": {"$in": ["pending", "claimed"]}, "available_at": {"$lte": _T1}},
+         "sort": [("available_at", ASCENDING)], "limit": 50},
+    ]},
+    {"collection": "notification_outbox", "keys": [("claim", ASCENDING)], "options": {"sparse": True}, "queries": [
+        {"name": "notifiche di un lotto", "filter": {"claim": "worker:lotto"}},
+    ]},
+    {"collection": "position_segments", "keys": [("pet_id", ASCENDING), ("start", ASCENDING), ("_id", ASCENDING)],
+     "queries": [
+        {"name": "segmenti compattati nell'intervallo", "filter": {"pet_id": _PET, "start": {"$gte": _T0, "$lte": _T1}},
+         "sort": [("start", ASCENDING)]},
+    ]},
+    {"collection": "timeline_days", "keys": [("pet_id", ASCENDING), ("date", ASCENDING), ("version", ASCENDING)],
+     "options": {"unique": True, "name": "uniq_pet_date_version"}, "queries": [
+        {"name": "riepiloghi timeline salvati", "filter": {"pet_id": _PET, "date": {"$in": ["2024-01-01"]}, "version": 1},
+         "projection": {"_id": 0, "date": 1, "summary": 1}},
+    ]},
+    {"collection": "heatmap_days", "keys": [("pet_id", ASCENDING), ("date", ASCENDING), ("precision", ASCENDING)],
+     "options": {"unique": True, "name": "uniq_pet_date_precision"}, "queries": [
+        {"name": "celle heatmap salvate", "filter": {"pet_id": _PET, "date": {"$in": ["2024-01-01"]}, "precision": 4},
+         "projection": {"_id": 0, "date": 1, "cells": 1}},
+    ]},
+]
+
+# stadi del piano vincente che indicano un indice mancante o inadatto
+FORBIDDEN_STAGES = {
+    "COLLSCAN": "scansione completa della collezione",
+    "SORT": "ordinamento in memoria",
+    "$sort": "ordinamento in memoria nella pipeline",
+}
+
+
+def ensure_indexes(db):
+    """Crea gli indici del manifest sulle collezioni di PetTrackerDB."""
+    for spec in INDEX_MANIFEST:
+        getattr(db, spec["collection"]).create_index(spec["keys"], **spec.get("options", {}))
+
+
+def plan_stages(node):
+    """Stadi del piano d'esecuzione (anche annidati), esclusi i piani scartati dal planner."""
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == "rejectedPlans":
+                continue
+            if k == "stage" and isinstance(v, str):
+                yield v
+            elif k == "$sort":
+                yield k
+            else:
+                yield from plan_stages(v)
+    elif isinstance(node, list):
+        for item in node:
+            yield from plan_stages(item)
+
+
+def explain_query(db, collection_name, query):
+    collection = getattr(db, collection_name)
+    if "pipeline" in query:
+        return db.db.command("aggregate", collection.name, pipeline=query["pipeline"], explain=True)
+    cursor = collection.find(query.get("filter", {}), query.get("projection"))
+    if query.get("sort"):
+        cursor = cursor.sort(query["sort"])
+    if query.get("limit"):
+        cursor = cursor.limit(query["limit"])
+    return cursor.explain()
+
+
+def check_indexes(db):
+    """
+    Esegue explain() su ogni query del manifest. Ritorna [(collezione, query, [problemi])] per le query
+    il cui piano contiene una scansione completa o un ordinamento in memoria.
+    """
+    failures = []
+    for spec in INDEX_MANIFEST:
+        for query in spec["queries"]:
+            stages = set(plan_stages(explain_query(db, spec["collection"], query)))
+            problems = [FORBIDDEN_STAGES[s] for s in sorted(stages) if s in FORBIDDEN_STAGES]
+            if problems:
+                failures.append((spec["collection"], query["name"], problems))
+    return failures
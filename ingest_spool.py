@@ -0,0 +1,225 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+import bson
+
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "ingest_spool")
+INGEST_SPOOL_SEGMENT_BYTES = int(os.getenv("INGEST_SPOOL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+INGEST_SPOOL_FSYNC_SEC = float(os.getenv("INGEST_SPOOL_FSYNC_SEC", "0.2"))
+INGEST_SPOOL_REPLAY_BATCH = int(os.getenv("INGEST_SPOOL_REPLAY_BATCH", "1000"))
+INGEST_SPOOL_RETRY_SEC = float(os.getenv("INGEST_SPOOL_RETRY_SEC", "2"))
+
+# record: lunghezza e crc32 del payload (little endian), poi il payload BSON {"c": collezione, "d": documento}
+_HEADER = struct.Struct("<II")
+_SEGMENT_PREFIX = "seg-"
+_SEGMENT_SUFFIX = ".spool"
+
+
+def encode_record(collection, doc):
+    payload = bson.encode({"c": collection, "d": doc})
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path, offset=0):
+    """
+    Itera (offset_successivo, collezione, documento) dal file a partire da `offset`. Si ferma al primo
+    record troncato o corrotto (scrittura interrotta da un crash).
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                print(f"[SPOOL] Record incompleto in {os.path.basename(path)} all'offset {offset}, ignorato")
+                return
+            offset += _HEADER.size + length
+            record = bson.decode(payload)
+            yield offset, record["c"], record["d"]
+
+
+class IngestSpool:
+    """
+    Spool su disco per la telemetria quando Mongo non è raggiungibile o è in ritardo: file a segmenti in sola
+    aggiunta, record binari BSON con crc, fsync a lotti da un thread dedicato (append non tocca il disco e non
+    blocca i loop MQTT/WebSocket). Il replayer reinserisce i record in ordine, segmento per segmento, quando
+    Mongo torna disponibile; finché lo spool non è vuoto anche le nuove letture passano da qui, così
+    l'ordine di inserimento resta quello di arrivo.
+
+    `insert_many(collezione, documenti)` e `is_available()` sono forniti da PetTrackerDB.
+    """
+
+    def __init__(self, insert_many, is_available, directory=INGEST_SPOOL_DIR,
+                 segment_bytes=INGEST_SPOOL_SEGMENT_BYTES, fsync_sec=INGEST_SPOOL_FSYNC_SEC,
+                 replay_batch=INGEST_SPOOL_REPLAY_BATCH, retry_sec=INGEST_SPOOL_RETRY_SEC):
+        self.insert_many = insert_many
+        self.is_available = is_available
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_sec = fsync_sec
+        self.replay_batch = replay_batch
+        self.retry_sec = retry_sec
+
+        self._lock = threading.Lock()          # coda in memoria e stato
+        self._queued = threading.Condition(self._lock)
+        self._file_lock = threading.Lock()     # segmento corrente
+        self._queue = []
+        self._writing = 0                      # record presi dal writer e non ancora su disco
+        self._active = False
+        self._wake_replay = threading.Event()
+        self._file = None
+        self._file_path = None
+        self._seq = 0
+        self.spooled = 0
+        self.replayed = 0
+
+    # --- API ---
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        if segments:
+            self._seq = self._segment_seq(segments[-1])
+            self._active = True
+            print(f"[SPOOL] {len(segments)} segmenti da reinserire in {self.directory}")
+        threading.Thread(target=self._write_loop, name="spool-writer", daemon=True).start()
+        threading.Thread(target=self._replay_loop, name="spool-replay", daemon=True).start()
+        return self
+
+    @property
+    def active(self):
+        """True se ci sono record non ancora reinseriti (o Mongo è stato segnalato lento)."""
+        return self._active
+
+    def append(self, collection, doc):
+        with self._lock:
+            self._queue.append((collection, doc))
+            self._active = True
+            self.spooled += 1
+            self._queued.notify()
+
+    def mark_backlogged(self):
+        """Mongo risponde ma lentamente: le prossime letture passano dallo spool finché il replayer non lo svuota."""
+        with self._lock:
+            self._active = True
+        self._wake_replay.set()
+
+    # --- scrittura ---
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                while not self._queue:
+                    self._queued.wait()
+                batch, self._queue = self._queue, []
+                self._writing = len(batch)
+            try:
+                with self._file_lock:
+                    for collection, doc in batch:
+                        if self._file is None or self._file.tell() >= self.segment_bytes:
+                            self._open_segment()
+                        self._file.write(encode_record(collection, doc))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+            except Exception as e:
+                print(f"[SPOOL] Errore scrittura spool: {e}")
+                with self._lock:
+                    self._queue[:0] = batch  # riprova al prossimo giro, nello stesso ordine
+                time.sleep(self.retry_sec)
+            finally:
+                with self._lock:
+                    self._writing = 0
+            self._wake_replay.set()
+            # raccoglie altri record prima del prossimo fsync
+            time.sleep(self.fsync_sec)
+
+    def _open_segment(self):
+        self._close_segment()
+        self._seq += 1
+        self._file_path = os.path.join(self.directory, f"{_SEGMENT_PREFIX}{self._seq:012d}{_SEGMENT_SUFFIX}")
+        self._file = open(self._file_path, "ab")
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._file_path = None
+
+    # --- replay ---
+    def _segments(self):
+        names = [n for n in os.listdir(self.directory) if n.startswith(_SEGMENT_PREFIX) and n.endswith(_SEGMENT_SUFFIX)]
+        return sorted(names)
+
+    @staticmethod
+    def _segment_seq(name):
+        return int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)])
+
+    def _replay_loop(self):
+        while True:
+            self._wake_replay.wait(self.retry_sec)
+            self._wake_replay.clear()
+            if not self._active:
+                continue
+            try:
+                if not self.is_available():
+                    continue
+                self._replay_all()
+            except Exception as e:
+                print(f"[SPOOL] Reinserimento sospeso: {e}")
+
+    def _replay_all(self):
+        while True:
+            # il segmento in scrittura viene chiuso e l'elenco preso sotto lo stesso lock: un segmento aperto
+            # dal writer subito dopo non è nell'elenco, e quello aperto non viene mai reinserito né rimosso
+            with self._file_lock:
+                self._close_segment()
+                segments = self._segments()
+            for name in segments:
+                path = os.path.join(self.directory, name)
+                with self._file_lock:
+                    if path == self._file_path:
+                        continue
+                self._replay_segment(path)
+            with self._lock:
+                if not self._queue and not self._writing and not self._segments():
+                    self._active = False
+                    if segments:
+                        print(f"[SPOOL] Spool svuotato ({self.replayed} record reinseriti in totale)")
+                    return
+
+    def _replay_segment(self, path):
+        checkpoint = path + ".ckpt"
+        offset = 0
+        try:
+            with open(checkpoint, "r") as f:
+                offset = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            pass
+
+        batch, last_offset = [], offset
+        for next_offset, collection, doc in read_records(path, offset):
+            # record consecutivi della stessa collezione vanno in un solo insert_many, nell'ordine del file
+            if batch and (batch[-1][0] != collection or len(batch) >= self.replay_batch):
+                self._flush_replay(batch, checkpoint, last_offset)
+                batch = []
+            batch.append((collection, doc))
+            last_offset = next_offset
+        if batch:
+            self._flush_replay(batch, checkpoint, last_offset)
+        os.remove(path)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def _flush_replay(self, batch, checkpoint, offset):
+        self.insert_many(batch[0][0], [doc for _, doc in batch])
+        self.replayed += len(batch)
+        # dopo un crash si riparte da qui; un lotto reinserito due volte non duplica: stessi _id, scartati da
+        # insert_many (errore di chiave duplicata o, per le collezioni time-series, ricerca degli _id presenti)
+        tmp = checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, checkpoint)
@@ -0,0 +1,73 @@
+import json
+import queue
+import threading
+
+# topic senza chiave per pet: arrivano a tutti gli iscritti al topic
+GLOBAL_TOPICS = ("detected", "anchors")
+
+
+class Subscription:
+    def __init__(self, topics, keys, max_queue):
+        self.topics = set(topics)
+        self.keys = set(keys) if keys is not None else None
+        self.queue = queue.Queue(maxsize=max_queue)
+        # coda piena: il client riceverà un nuovo snapshot invece dei delta persi
+        self.overflow = False
+
+    def wants(self, topic, key):
+        if topic not in self.topics:
+            return False
+        return topic in GLOBAL_TOPICS or self.keys is None or key in self.keys
+
+    def offer(self, event):
+        if not self.wants(event[0], event[1]):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflow = True
+
+
+class LiveFeed:
+    """
+    Pub/sub in memoria per il canale Server-Sent Events. Ricorda l'ultimo valore pubblicato per
+    (topic, chiave) e inoltra un evento agli iscritti solo quando il valore cambia.
+    """
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._last = {}
+        self._subscribers = set()
+
+    def publish(self, topic, key, payload):
+        with self._lock:
+            if self._last.get((topic, key)) == payload:
+                return False
+            self._last[(topic, key)] = payload
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.offer((topic, key, payload))
+        return True
+
+    def last(self, topic, key=None):
+        with self._lock:
+            return self._last.get((topic, key))
+
+    def subscribe(self, topics, keys=None):
+        sub = Subscription(topics, keys, self.max_queue)
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def has_subscribers(self, topic=None):
+        with self._lock:
+            return any(topic is None or topic in s.topics for s in self._subscribers)
+
+
+def sse_event(topic, payload):
+    return f"event: {topic}\ndata: {json.dumps(payload, default=str)}\n\n"
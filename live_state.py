@@ -0,0 +1,64 @@
+import threading
+
+
+def _empty_state():
+    return {
+        "room": None, "room_ts": None,
+        "gps": None, "gps_ts": None,
+        "env": None, "env_ts": None,
+        "loaded": False,
+    }
+
+
+class LiveStateCache:
+    """
+    Stato corrente per pet (ultima stanza, ultimo GPS, ultima lettura ambientale), aggiornato
+    dall'ingest MQTT/WebSocket a ogni evento accettato. I timestamp sono epoch in secondi.
+    `loaded` indica che lo stato è stato completato dal DB almeno una volta (avvio a freddo).
+    """
+
+    def __init__(self, on_change=None):
+        self._lock = threading.Lock()
+        self._states = {}
+        # on_change(pet_id, stato) viene chiamata fuori dal lock dopo ogni aggiornamento accettato
+        self.on_change = on_change
+
+    def get(self, pet_id):
+        with self._lock:
+            state = self._states.get(str(pet_id))
+            return dict(state) if state else None
+
+    def _update(self, pet_id, field, value, ts):
+        with self._lock:
+            state = self._states.setdefault(str(pet_id), _empty_state())
+            # non sovrascrivere con eventi più vecchi (es. dati caricati dal DB dopo l'ingest)
+            if state[field + "_ts"] is not None and ts is not None and ts < state[field + "_ts"]:
+                return
+            state[field] = value
+            state[field + "_ts"] = ts
+            snapshot = dict(state)
+        if self.on_change:
+            try:
+                self.on_change(str(pet_id), snapshot)
+            except Exception as e:
+                print("[LIVE STATE] Errore notifica cambiamento:", e)
+
+    def update_room(self, pet_id, room, ts):
+        self._update(pet_id, "room", room, ts)
+
+    def update_gps(self, pet_id, lat, lon, ts):
+        self._update(pet_id, "gps", {"lat": lat, "lon": lon}, ts)
+
+    def update_env(self, pet_id, temp, hum, ts, raw_timestamp=None):
+        self._update(pet_id, "env", {"temp": temp, "hum": hum, "timestamp": raw_timestamp if raw_timestamp is not None else ts}, ts)
+
+    def mark_loaded(self, pet_id, **info):
+        """Segna lo stato come completo; `info` conserva dati del pet utili alle risposte (es. has_mac)."""
+        with self._lock:
+            state = self._states.setdefault(str(pet_id), _empty_state())
+            state.update(info)
+            state["loaded"] = True
+
+    def invalidate(self, pet_id):
+        with self._lock:
+            self._states.pop(str(pet_id), None)
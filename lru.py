@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Dizionario thread-safe limitato in dimensione (eviction LRU), con scadenza opzionale in secondi."""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (scadenza o None, valore)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def discard_where(self, predicate):
+        """Rimuove tutte le chiavi per cui predicate(key) è vero."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_MISSING = object()
+
+
+class ReadThroughCache:
+    """
+    LRUCache con caricamento sul miss. Un'invalidazione avvenuta mentre un valore veniva letto dal database
+    impedisce di salvarlo: una lettura concorrente a una scrittura non rimette in cache il dato vecchio.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.entries = LRUCache(max_entries, ttl)
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get_or_load(self, key, load):
+        value = self.entries.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self._generation
+        value = load()
+        with self._lock:
+            if generation == self._generation:
+                self.entries.put(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self.entries.pop(key)
+
+    def stats(self):
+        return {"hits": self.entries.hits, "misses": self.entries.misses, "size": len(self.entries)}
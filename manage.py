@@ -0,0 +1,51 @@
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+from index_manifest import INDEX_MANIFEST, check_indexes
+from pettracker_db import PetTrackerDB
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comandi di manutenzione del database Pet Tracker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_ts = sub.add_parser("migrate-timeseries", help="copia positions/envdata nelle collezioni time-series")
+    p_ts.add_argument("--batch-size", type=int, default=5000)
+
+    sub.add_parser("migrate-env-keys", help="riscrive le chiavi di envdata nella forma canonica (MAC AA:BB:..., pet_id, global)")
+
+    sub.add_parser("check-indexes",
+                   help="explain() delle query frequenti: errore se usano COLLSCAN o un ordinamento in memoria")
+
+    args = parser.parse_args()
+    load_dotenv()
+
+    if args.command == "migrate-timeseries":
+        # la sorgente sono sempre le collezioni classiche
+        db = PetTrackerDB(timeseries=False)
+        totals = db.migrate_to_timeseries(batch_size=args.batch_size)
+        print(f"[MIGRAZIONE] Completata: {totals}")
+
+    elif args.command == "migrate-env-keys":
+        db = PetTrackerDB()
+        report = db.migrate_env_keys()
+        total = sum(n for changes in report.values() for _, n in changes.values())
+        print(f"[MIGRAZIONE] Chiavi env aggiornate: {total} documenti")
+
+    elif args.command == "check-indexes":
+        # PetTrackerDB crea gli indici del manifest all'avvio: va eseguito su un Mongo locale/di staging
+        db = PetTrackerDB()
+        failures = check_indexes(db)
+        total = sum(len(spec["queries"]) for spec in INDEX_MANIFEST)
+        for collection, name, problems in failures:
+            print(f"[INDICI] ❌ {collection}: {name} -> {', '.join(problems)}")
+        if failures:
+            print(f"[INDICI] {len(failures)}/{total} query senza un indice adeguato")
+            sys.exit(1)
+        print(f"[INDICI] ✅ {total} query servite da indici")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,728 @@
+import copy
+import math
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from heapq import merge
+from operator import attrgetter
+from zoneinfo import ZoneInfo
+
+import bcrypt
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from storage import ENV_FIELDS, StorageBackend, canonical_env_key, segment_as_position
+from timeline import PositionRecord, normalize_timestamp
+
+
+def _project(doc, fields, with_id=True):
+    """Copia del documento con i soli `fields` (più timestamp e, se with_id, _id), come una proiezione Mongo."""
+    if not fields:
+        return dict(doc)
+    keep = set(fields) | {"timestamp"}
+    if with_id:
+        keep.add("_id")
+    return {k: v for k, v in doc.items() if k in keep}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Series:
+    """Documenti di una chiave (pet_id o chiave ambientale) ordinati per (timestamp, _id)."""
+
+    __slots__ = ("keys", "times", "docs")
+
+    def __init__(self):
+        self.keys = []     # (timestamp, _id)
+        self.times = []    # timestamp, per le ricerche per intervallo
+        self.docs = []
+
+    def insert(self, doc):
+        key = (doc["timestamp"], doc["_id"])
+        if not self.keys or key > self.keys[-1]:
+            # caso comune: la telemetria arriva in ordine
+            i = len(self.keys)
+        else:
+            i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.times.insert(i, key[0])
+        self.docs.insert(i, doc)
+
+    def span(self, start, end):
+        """Indici [lo, hi) dei documenti con start <= timestamp <= end."""
+        return bisect_left(self.times, start), bisect_right(self.times, end)
+
+    def after(self, ts, last_id=None):
+        """Primo indice dopo (ts, last_id); senza last_id il primo con timestamp > ts."""
+        if last_id is None:
+            return bisect_right(self.times, ts)
+        return bisect_right(self.keys, (ts, last_id))
+
+    def remove(self, ids):
+        kept = [i for i, d in enumerate(self.docs) if d["_id"] not in ids]
+        self.keys = [self.keys[i] for i in kept]
+        self.times = [self.times[i] for i in kept]
+        self.docs = [self.docs[i] for i in kept]
+
+
+class MemoryDB(StorageBackend):
+    """
+    Livello dati in memoria con la stessa interfaccia di PetTrackerDB, per benchmark e prove locali senza
+    Mongo (PETTRACKER_DB_BACKEND=memory). Posizioni e letture ambientali stanno in array per chiave ordinati
+    per (timestamp, _id) con ricerca binaria; pet per _id e MAC in dizionari; stanze, regole e notifiche
+    sono poche e vengono scorse. Gli indici di pet e stanze si ricostruiscono a ogni modifica (rare) e
+    restituiscono il primo documento inserito, come find_one. I timestamp sono salvati come datetime UTC aware; i documenti restituiti
+    sono copie. Nessuna persistenza: i dati si perdono alla chiusura del processo.
+    """
+
+    def __init__(self, read_cache=None):
+        super().__init__(read_cache)
+        self._lock = threading.RLock()
+        self.users = {}               # _id -> documento
+        self._users_by_name = {}      # username -> _id
+        self.pets = {}
+        self._pets_by_mac = {}        # MAC -> _id (unico, come uniq_mac_address)
+        self._pets_by_bt_name = {}    # bt_name -> _id del primo pet inserito
+        self.rooms = {}
+        self._rooms_by_name = {}      # nome / MAC ancora -> _id della prima stanza inserita
+        self._rooms_by_mac = {}
+        self.perimeter = None
+        self.alert_rules = {}
+        self.notification_outbox = {}
+        self._outbox_keys = set()     # dedupe_key registrate
+        self.positions = {}           # pet_id -> _Series
+        self._position_keys = {}      # _id posizione -> pet_id
+        self.position_segments = {}   # pet_id -> {_id: segmento}
+        self.envdata = {}             # chiave -> _Series
+        self.timeline_days = {}       # (pet_id, data, versione) -> riepilogo
+        self.heatmap_days = {}        # (pet_id, data, precisione) -> celle
+        print("✅ Database in memoria pronto")
+
+    @staticmethod
+    def _ts(value):
+        return normalize_timestamp(value) if value is not None else None
+
+    @staticmethod
+    def _copy(doc):
+        return copy.deepcopy(doc) if doc is not None else None
+
+    # --- UTENTI ---
+    def create_user(self, username, password):
+        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
+        return self.insert_user({
+            "username": username,
+            "password_hash": password_hash,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    def get_user_by_username(self, username):
+        return self.get_user(username)
+
+    def get_user_by_id(self, user_id):
+        with self._lock:
+            return self._copy(self.users.get(self._ensure_oid(user_id)))
+
+    def get_user(self, username, active_only=False, include_hash=True):
+        with self._lock:
+            user = self.users.get(self._users_by_name.get(username))
+            if user is None or (active_only and user.get("is_active") is not True):
+                return None
+            user = self._copy(user)
+        if not include_hash:
+            user.pop("password_hash", None)
+        return user
+
+    def count_users(self):
+        with self._lock:
+            return len(self.users)
+
+    def insert_user(self, doc):
+        doc = self._copy(doc)
+        doc.setdefault("_id", ObjectId())
+        with self._lock:
+            if doc.get("username") in self._users_by_name:
+                raise DuplicateKeyError(f"username duplicato: {doc.get('username')}")
+            self.users[doc["_id"]] = doc
+            self._users_by_name[doc.get("username")] = doc["_id"]
+        self.invalidate_cache(("user", doc.get("username")))
+        return doc["_id"]
+
+    def update_user(self, user_id, fields):
+        with self._lock:
+            user = self.users.get(self._ensure_oid(user_id))
+            if user is None:
+                return
+            old_name = user.get("username")
+            new_name = fields.get("username", old_name)
+            if new_name != old_name:
+                if new_name in self._users_by_name:
+                    raise DuplicateKeyError(f"username duplicato: {new_name}")
+                del self._users_by_name[old_name]
+                self._users_by_name[new_name] = user["_id"]
+            user.update(self._copy(fields))
+        self.invalidate_cache(("user", old_name), ("user", new_name))
+
+    def delete_user(self, username):
+        with self._lock:
+            user_id = self._users_by_name.pop(username, None)
+            if user_id is not None:
+                del self.users[user_id]
+        self.invalidate_cache(("user", username))
+        return user_id is not None
+
+    # --- PETS ---
+    def _index_pets(self):
+        self._pets_by_mac, self._pets_by_bt_name = {}, {}
+        for oid, pet in self.pets.items():
+            if pet.get("mac_address"):
+                self._pets_by_mac.setdefault(pet["mac_address"], oid)
+            if pet.get("bt_name"):
+                self._pets_by_bt_name.setdefault(pet["bt_name"], oid)
+
+    def _check_mac(self, mac_address, pet_id=None):
+        owner = self._pets_by_mac.get(mac_address)
+        if mac_address and owner is not None and owner != pet_id:
+            raise DuplicateKeyError(f"mac_address duplicato: {mac_address}")
+
+    def add_pet(self, name, owner_id, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        pet_data = {
+            "_id": ObjectId(),
+            "name": name,
+            "owner_id": str(owner_id),
+            "created_at": datetime.now(timezone.utc),
+        }
+        if mac_address:
+            pet_data["mac_address"] = mac_address
+        if bt_name:
+            pet_data["bt_name"] = bt_name
+        if temp_min is not None:
+            pet_data["temp_min"] = temp_min
+        if temp_max is not None:
+            pet_data["temp_max"] = temp_max
+        with self._lock:
+            self._check_mac(mac_address)
+            self.pets[pet_data["_id"]] = pet_data
+            self._index_pets()
+        return pet_data["_id"]
+
+    def get_registered_macs(self):
+        with self._lock:
+            return [m for m in self._pets_by_mac if m]
+
+    def get_pets_for_user(self, user_id):
+        with self._lock:
+            return [self._copy(p) for p in self.pets.values() if p.get("owner_id") == str(user_id)]
+
+    def get_pet_by_id(self, pet_id):
+        oid = self._ensure_oid(pet_id)
+        return self.cached(("pet", str(oid)), lambda: self._copy(self.pets.get(oid)))
+
+    def get_pets_by_ids(self, pet_ids):
+        out = {}
+        with self._lock:
+            for pet_id in pet_ids:
+                try:
+                    pet = self.pets.get(self._ensure_oid(pet_id))
+                except Exception:
+                    continue
+                if pet is not None:
+                    out[str(pet["_id"])] = self._copy(pet)
+        return out
+
+    def get_pet_by_mac(self, mac_address, owner_id=None):
+        with self._lock:
+            pet = self.pets.get(self._pets_by_mac.get(mac_address))
+            if pet is None or (owner_id is not None and pet.get("owner_id") != str(owner_id)):
+                return None
+            return self._copy(pet)
+
+    def get_pet_by_bt_name(self, bt_name, ignore_case=False):
+        with self._lock:
+            if not ignore_case:
+                return self._copy(self.pets.get(self._pets_by_bt_name.get(bt_name)))
+            wanted = bt_name.casefold()
+            for pet in self.pets.values():
+                name = pet.get("bt_name")
+                if isinstance(name, str) and name.casefold() == wanted:
+                    return self._copy(pet)
+        return None
+
+    def update_pet(self, pet_id, name=None, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        update_fields = {}
+        if name is not None:
+            update_fields["name"] = name
+        if mac_address is not None:
+            update_fields["mac_address"] = mac_address
+        if bt_name is not None:
+            update_fields["bt_name"] = bt_name
+        if temp_min is not None:
+            update_fields["temp_min"] = temp_min
+        if temp_max is not None:
+            update_fields["temp_max"] = temp_max
+        if not update_fields:
+            return
+        oid = self._ensure_oid(pet_id)
+        with self._lock:
+            pet = self.pets.get(oid)
+            if pet is None:
+                return
+            if "mac_address" in update_fields:
+                self._check_mac(mac_address, oid)
+            pet.update(update_fields)
+            self._index_pets()
+        self.invalidate_cache(("pet", str(oid)))
+
+    def delete_pet(self, pet_id):
+        oid = self._ensure_oid(pet_id)
+        with self._lock:
+            self.pets.pop(oid, None)
+            self._index_pets()
+        self.invalidate_cache(("pet", str(oid)))
+
+    def set_pet_allowed_rooms(self, pet_id, room_ids):
+        oid = self._ensure_oid(pet_id)
+        with self._lock:
+            if oid in self.pets:
+                self.pets[oid]["allowed_rooms"] = [str(r) for r in room_ids]
+        self.invalidate_cache(("pet", str(oid)))
+
+    # --- ROOMS ---
+    def _index_rooms(self):
+        self._rooms_by_name, self._rooms_by_mac = {}, {}
+        for oid, room in self.rooms.items():
+            self._rooms_by_name.setdefault(room.get("name"), oid)
+            self._rooms_by_mac.setdefault(room.get("mac_address"), oid)
+
+    def get_rooms(self):
+        return self.cached(("rooms",), lambda: [self._copy(r) for r in self.rooms.values()])
+
+    def add_room(self, name, mac_address, allowed):
+        room_id = ObjectId()
+        with self._lock:
+            self.rooms[room_id] = {"_id": room_id, "name": name, "mac_address": mac_address, "allowed": allowed}
+            self._index_rooms()
+        self.invalidate_cache(("rooms",))
+        return room_id
+
+    def get_room_by_id(self, room_id):
+        oid = self._ensure_oid(room_id)
+        return self.cached(("room", str(oid)), lambda: self._copy(self.rooms.get(oid)))
+
+    def get_room_by_name(self, name):
+        with self._lock:
+            return self._copy(self.rooms.get(self._rooms_by_name.get(name)))
+
+    def get_room_by_mac(self, mac_address):
+        with self._lock:
+            return self._copy(self.rooms.get(self._rooms_by_mac.get(mac_address)))
+
+    def update_room(self, room_id, name, mac_address, allowed):
+        oid = self._ensure_oid(room_id)
+        with self._lock:
+            if oid in self.rooms:
+                self.rooms[oid].update({"name": name, "mac_address": mac_address, "allowed": allowed})
+                self._index_rooms()
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    def delete_room(self, room_id):
+        oid = self._ensure_oid(room_id)
+        with self._lock:
+            self.rooms.pop(oid, None)
+            self._index_rooms()
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    def update_room_access(self, room_id, allowed):
+        oid = self._ensure_oid(room_id)
+        with self._lock:
+            if oid in self.rooms:
+                self.rooms[oid]["allowed"] = allowed
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    # --- PERIMETRO ---
+    def _global_perimeter(self):
+        return self.cached(("perimeter",), lambda: self._copy(self.perimeter))
+
+    def save_perimeter(self, center, radius):
+        with self._lock:
+            self.perimeter = {"key": "global", "center": center, "radius": radius}
+        self.invalidate_cache(("perimeter",))
+
+    # --- REGOLE D'ALLARME ---
+    def get_alert_rules(self, pet_id):
+        with self._lock:
+            return [self._copy(r) for r in self.alert_rules.values() if r.get("pet_id") == str(pet_id)]
+
+    def list_alert_rules(self):
+        with self._lock:
+            return sorted((self._copy(r) for r in self.alert_rules.values()), key=lambda r: str(r.get("pet_id")))
+
+    def add_alert_rule(self, rule):
+        rule = self._copy(rule)
+        rule.setdefault("_id", ObjectId())
+        with self._lock:
+            self.alert_rules[rule["_id"]] = rule
+        return rule["_id"]
+
+    def delete_alert_rule(self, rule_id):
+        with self._lock:
+            return self.alert_rules.pop(self._ensure_oid(rule_id), None)
+
+    # --- OUTBOX NOTIFICHE ---
+    def enqueue_notification(self, dedupe_key, text, chat_ids=None, key=None):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            if dedupe_key in self._outbox_keys:
+                return False
+            self._outbox_keys.add(dedupe_key)
+            entry_id = ObjectId()
+            self.notification_outbox[entry_id] = {
+                "_id": entry_id,
+                "dedupe_key": dedupe_key,
+                "key": key,
+                "text": text,
+                "chat_ids": [str(c) for c in chat_ids] if chat_ids is not None else None,
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+                "available_at": now,
+            }
+        return True
+
+    def claim_notifications(self, worker_id, limit=50, lease_sec=300, exclude=()):
+        now = datetime.now(timezone.utc)
+        exclude = set(exclude)
+        lease_until = datetime.fromtimestamp(now.timestamp() + lease_sec, timezone.utc)
+        token = f"{worker_id}:{ObjectId()}"
+        with self._lock:
+            ready = sorted(
+                (e for e in self.notification_outbox.values()
+                 if e["status"] in ("pending", "claimed") and e["available_at"] <= now and e["_id"] not in exclude),
+                key=lambda e: e["available_at"]
+            )[:limit]
+            for e in ready:
+                e.update({"status": "claimed", "claim": token, "available_at": lease_until})
+                e["attempts"] += 1
+            claimed = [self._copy(e) for e in ready]
+        claimed.sort(key=lambda d: d["created_at"])
+        return claimed
+
+    def renew_notification_leases(self, worker_id, ids, lease_sec=300):
+        lease_until = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() + lease_sec, timezone.utc)
+        n = 0
+        with self._lock:
+            for entry_id in ids:
+                entry = self.notification_outbox.get(entry_id)
+                if entry is not None and entry["status"] == "claimed" and entry["claim"].startswith(f"{worker_id}:"):
+                    entry["available_at"] = lease_until
+                    n += 1
+        return n
+
+    def mark_notifications_delivered(self, ids, failed_chats=None):
+        update = {"status": "delivered", "delivered_at": datetime.now(timezone.utc)}
+        if failed_chats:
+            update["failed_chats"] = sorted(failed_chats)
+        n = 0
+        with self._lock:
+            for entry_id in ids:
+                entry = self.notification_outbox.get(entry_id)
+                if entry is not None:
+                    entry.update(update)
+                    entry.pop("claim", None)
+                    n += 1
+        return n
+
+    def release_notifications(self, ids, retry_in_sec=0):
+        available = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() + retry_in_sec, timezone.utc)
+        n = 0
+        with self._lock:
+            for entry_id in ids:
+                entry = self.notification_outbox.get(entry_id)
+                if entry is not None and entry["status"] == "claimed":
+                    entry.update({"status": "pending", "available_at": available})
+                    entry.pop("claim", None)
+                    n += 1
+        return n
+
+    # --- POSIZIONI ---
+    def _insert_position(self, record):
+        record["_id"] = record.get("_id") or ObjectId()
+        record["timestamp"] = self._ts(record["timestamp"])
+        with self._lock:
+            self.positions.setdefault(record["pet_id"], _Series()).insert(record)
+            self._position_keys[record["_id"]] = record["pet_id"]
+
+    def save_pet_position(self, pet_id, lat, lon, timestamp=None):
+        self._insert_position({
+            "pet_id": str(pet_id),
+            "lat": lat,
+            "lon": lon,
+            "timestamp": timestamp or datetime.now(timezone.utc),
+        })
+
+    def save_position(self, pet_id, entry_type, timestamp=None, **kwargs):
+        record = {
+            "pet_id": str(pet_id) if pet_id is not None else None,
+            "entry_type": entry_type,
+            "timestamp": timestamp or datetime.now(timezone.utc),
+        }
+        record.update(kwargs)
+        try:
+            self._insert_position(record)
+        except Exception as e:
+            print("ERRORE SALVATAGGIO:", e)
+
+    def get_last_position(self, pet_id):
+        with self._lock:
+            series = self.positions.get(str(pet_id))
+            return dict(series.docs[-1]) if series and series.docs else None
+
+    def latest_positions(self, pet_ids, sources=("ble", "gps")):
+        result = {}
+        with self._lock:
+            for pet_id in (str(p) for p in pet_ids):
+                series = self.positions.get(pet_id)
+                if not series:
+                    continue
+                missing = set(sources)
+                for doc in reversed(series.docs):
+                    source = doc.get("source")
+                    if source in missing:
+                        missing.discard(source)
+                        result.setdefault(pet_id, {})[source] = {
+                            k: doc.get(k) for k in ("timestamp", "room", "lat", "lon")
+                        }
+                        if not missing:
+                            break
+        return result
+
+    def get_positions(self, pet_id, limit=50, fields=None):
+        with self._lock:
+            series = self.positions.get(str(pet_id))
+            docs = series.docs[-limit:] if series and limit else []
+            return [_project(d, fields) for d in reversed(docs)]
+
+    def _range(self, pet_id, start, end):
+        """Copie (posizioni grezze, segmenti per start) del pet nell'intervallo [start, end]."""
+        start, end = self._ts(start), self._ts(end)
+        with self._lock:
+            series = self.positions.get(str(pet_id))
+            raw = []
+            if series:
+                lo, hi = series.span(start, end)
+                raw = series.docs[lo:hi]
+            segments = sorted(
+                (s for s in self.position_segments.get(str(pet_id), {}).values() if start <= s["start"] <= end),
+                key=lambda s: (s["start"], s["_id"])
+            )
+        return raw, segments
+
+    def iter_positions(self, pet_id, start, end, fields=None, batch_size=1000):
+        raw, segments = self._range(pet_id, start, end)
+        return merge((_project(d, fields, with_id=False) for d in raw),
+                     (segment_as_position(s, fields) for s in segments),
+                     key=lambda p: p["timestamp"])
+
+    def iter_position_records(self, pet_id, start, end, batch_size=1000):
+        raw, segments = self._range(pet_id, start, end)
+        return merge(map(PositionRecord.from_doc, raw), map(PositionRecord.from_segment, segments),
+                     key=attrgetter("timestamp"))
+
+    def page_positions(self, pet_id, start, end, after=None, limit=500, fields=None):
+        start, end = self._ts(start), self._ts(end)
+        with self._lock:
+            series = self.positions.get(str(pet_id)) or _Series()
+            lo, hi = series.span(start, end)
+            segments = sorted(
+                (s for s in self.position_segments.get(str(pet_id), {}).values() if start <= s["start"] <= end),
+                key=lambda s: (s["start"], s["_id"])
+            )
+            if after:
+                ts, rank, last_id = after
+                ts = self._ts(ts)
+                if rank == 0:
+                    lo = max(lo, series.after(ts, self._ensure_oid(last_id)))
+                    segments = [s for s in segments if s["start"] >= ts]
+                else:
+                    lo = max(lo, series.after(ts))
+                    segments = [s for s in segments if (s["start"], s["_id"]) > (ts, str(last_id))]
+            raw = [_project(d, fields) for d in series.docs[lo:min(hi, lo + limit)]]
+
+        def with_seg_id(seg):
+            doc = segment_as_position(seg, fields)
+            doc["_id"] = seg["_id"]
+            return doc
+
+        merged = merge(
+            ((0, d) for d in raw),
+            ((1, with_seg_id(s)) for s in segments[:limit]),
+            key=lambda item: (item[1]["timestamp"], item[0], str(item[1]["_id"]))
+        )
+        items = [item for _, item in zip(range(limit), merged)]
+        next_after = None
+        if len(items) == limit:
+            rank, doc = items[-1]
+            next_after = (doc["timestamp"], rank, str(doc["_id"]))
+        return items, next_after
+
+    # --- COMPATTAZIONE ---
+    def compaction_pet_ids(self, cutoff):
+        cutoff = self._ts(cutoff)
+        with self._lock:
+            return [
+                pet_id for pet_id, series in self.positions.items()
+                if any(d.get("source") == "ble" for d in series.docs[:bisect_left(series.times, cutoff)])
+            ]
+
+    def iter_compactable_positions(self, pet_id, cutoff):
+        cutoff = self._ts(cutoff)
+        fields = ("_id", "timestamp", "source", "entry_type", "room", "rssi")
+        with self._lock:
+            series = self.positions.get(pet_id)
+            docs = series.docs[:bisect_left(series.times, cutoff)] if series else []
+            return [{k: d[k] for k in fields if k in d} for d in docs]
+
+    def store_segments(self, segments):
+        with self._lock:
+            for seg in segments:
+                seg = dict(seg)
+                seg["start"], seg["end"] = self._ts(seg["start"]), self._ts(seg["end"])
+                self.position_segments.setdefault(seg["pet_id"], {})[seg["_id"]] = seg
+        return True
+
+    def delete_positions(self, ids):
+        ids = set(ids)
+        with self._lock:
+            by_pet = {}
+            for position_id in ids:
+                if position_id in self._position_keys:
+                    by_pet.setdefault(self._position_keys.pop(position_id), set()).add(position_id)
+            for pet_id, position_ids in by_pet.items():
+                self.positions[pet_id].remove(position_ids)
+        return sum(len(p) for p in by_pet.values())
+
+    # --- STORICO E SERIE AMBIENTALI ---
+    def page_env(self, key, start, end, after=None, limit=500, fields=None):
+        with self._lock:
+            series = self.envdata.get(key) or _Series()
+            lo, hi = series.span(self._ts(start), self._ts(end))
+            if after:
+                ts, _, last_id = after
+                lo = max(lo, series.after(self._ts(ts), self._ensure_oid(last_id)))
+            docs = [_project(d, fields or ENV_FIELDS) for d in series.docs[lo:min(hi, lo + limit)]]
+        next_after = None
+        if len(docs) == limit:
+            next_after = (docs[-1]["timestamp"], 0, str(docs[-1]["_id"]))
+        return [(0, d) for d in docs], next_after
+
+    def _env_range(self, key, start, end):
+        with self._lock:
+            series = self.envdata.get(key)
+            if not series:
+                return []
+            lo, hi = series.span(self._ts(start), self._ts(end))
+            return series.docs[lo:hi]
+
+    def env_buckets(self, key, start, end, bucket_sec):
+        bucket_ms = int(bucket_sec * 1000)
+        buckets = {}
+        for d in self._env_range(key, start, end):
+            ts_ms = int(d["timestamp"].timestamp() * 1000)
+            b = buckets.setdefault(ts_ms - ts_ms % bucket_ms, {"temp": [], "hum": [], "n": 0})
+            b["n"] += 1
+            for metric in ("temp", "hum"):
+                if _is_number(d.get(metric)):
+                    b[metric].append(d[metric])
+        out = []
+        for bucket_start in sorted(buckets):
+            b = buckets[bucket_start]
+            row = {"_id": bucket_start, "n": b["n"]}
+            for metric in ("temp", "hum"):
+                values = b[metric]
+                row[f"{metric}_min"] = min(values) if values else None
+                row[f"{metric}_max"] = max(values) if values else None
+                row[f"{metric}_avg"] = sum(values) / len(values) if values else None
+            out.append(row)
+        return out
+
+    def iter_env_series(self, key, start, end, metric):
+        points = [(d["timestamp"].timestamp(), d[metric])
+                  for d in self._env_range(key, start, end) if _is_number(d.get(metric))]
+        return len(points), iter(points)
+
+    # --- RIEPILOGHI TIMELINE E HEATMAP ---
+    def get_timeline_days(self, pet_id, dates, version):
+        with self._lock:
+            return {d: self._copy(self.timeline_days[(str(pet_id), d, version)])
+                    for d in dates if (str(pet_id), d, version) in self.timeline_days}
+
+    def save_timeline_day(self, pet_id, date, version, summary):
+        with self._lock:
+            self.timeline_days[(str(pet_id), date, version)] = self._copy(summary)
+
+    def delete_timeline_days(self, pet_id, dates=None):
+        with self._lock:
+            for key in [k for k in self.timeline_days if k[0] == str(pet_id) and (not dates or k[1] in dates)]:
+                del self.timeline_days[key]
+
+    def aggregate_gps_cells(self, pet_id, start, end, precision, tz_name):
+        scale = 10 ** precision
+        tz = ZoneInfo(tz_name)
+        start, end = self._ts(start), self._ts(end)
+        with self._lock:
+            series = self.positions.get(str(pet_id))
+            docs = series.docs[bisect_left(series.times, start):bisect_left(series.times, end)] if series else []
+        counts = {}
+        for d in docs:
+            lat, lon = d.get("lat"), d.get("lon")
+            if not (_is_number(lat) and _is_number(lon)):
+                continue
+            key = (d["timestamp"].astimezone(tz).strftime("%Y-%m-%d"),
+                   math.floor(lat * scale), math.floor(lon * scale))
+            counts[key] = counts.get(key, 0) + 1
+        by_day = {}
+        for (day, y, x), n in counts.items():
+            by_day.setdefault(day, []).append([y, x, n])
+        return by_day
+
+    def get_heatmap_days(self, pet_id, dates, precision):
+        with self._lock:
+            return {d: self._copy(self.heatmap_days[(str(pet_id), d, precision)])
+                    for d in dates if (str(pet_id), d, precision) in self.heatmap_days}
+
+    def save_heatmap_day(self, pet_id, date, precision, cells):
+        with self._lock:
+            self.heatmap_days[(str(pet_id), date, precision)] = self._copy(cells)
+
+    def delete_heatmap_days(self, pet_id, dates=None):
+        with self._lock:
+            for key in [k for k in self.heatmap_days if k[0] == str(pet_id) and (not dates or k[1] in dates)]:
+                del self.heatmap_days[key]
+
+    # --- ENV DATA ---
+    def save_env_data(self, pet_id, temp, hum, timestamp):
+        doc = {
+            "_id": ObjectId(),
+            "pet_id": canonical_env_key(pet_id),
+            "temp": temp,
+            "hum": hum,
+            "timestamp": self._ts(timestamp or datetime.now(timezone.utc)),
+        }
+        with self._lock:
+            self.envdata.setdefault(doc["pet_id"], _Series()).insert(doc)
+
+    def get_latest_env(self, pet_id=None):
+        with self._lock:
+            series = self.envdata.get(canonical_env_key(pet_id))
+            return dict(series.docs[-1]) if series and series.docs else None
+
+    def latest_env_many(self, keys):
+        out = {}
+        with self._lock:
+            for key in (str(k) for k in keys):
+                series = self.envdata.get(key)
+                if series and series.docs:
+                    d = series.docs[-1]
+                    out[key] = {"temp": d.get("temp"), "hum": d.get("hum"), "timestamp": d["timestamp"]}
+        return out
@@ -0,0 +1,166 @@
+import gzip
+import zlib
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask.json.provider import DefaultJSONProvider
+
+from lru import LRUCache
+
+# msgpack e brotli sono in requirements.txt; se mancano si risponde comunque in JSON / gzip
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+    print("[NEGOTIATION] msgpack non installato: risposte application/msgpack disabilitate")
+try:
+    import brotli
+except ImportError:
+    brotli = None
+    print("[NEGOTIATION] brotli non installato: compressione br disabilitata")
+
+MSGPACK_MIMETYPE = "application/msgpack"
+# intestazioni conservate con il corpo nella cache delle risposte immutabili (mai Set-Cookie)
+CACHED_HEADERS = ("Content-Type", "Content-Encoding", "Vary", "ETag", "Last-Modified", "Cache-Control")
+COMPRESSIBLE_TYPES = {
+    "application/json", MSGPACK_MIMETYPE, "application/x-ndjson",
+    "text/html", "text/css", "text/plain", "application/javascript",
+}
+
+
+def wants_msgpack():
+    if msgpack is None or not has_request_context():
+        return False
+    accept = request.accept_mimetypes
+    return accept[MSGPACK_MIMETYPE] > accept["application/json"] or \
+        accept["application/x-msgpack"] > accept["application/json"]
+
+
+def choose_encoding():
+    """Codifica preferita dal client tra quelle disponibili (br, gzip) o None."""
+    accept = request.accept_encodings
+    options = [("br", accept["br"])] if brotli is not None else []
+    options.append(("gzip", accept["gzip"]))
+    enc, q = max(options, key=lambda o: o[1])
+    return enc if q > 0 else None
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _stream_compressor(encoding):
+    if encoding == "br":
+        c = brotli.Compressor(quality=5)
+        return c.process, c.finish
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> formato gzip
+    return c.compress, c.flush
+
+
+def compress_stream(chunks, encoding):
+    process, finish = _stream_compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        out = process(chunk)
+        if out:
+            yield out
+    yield finish()
+
+
+def _add_vary(resp, header):
+    if header not in resp.vary:
+        resp.vary.add(header)
+
+
+class NegotiatingJSONProvider(DefaultJSONProvider):
+    """jsonify() risponde in MessagePack se il client lo preferisce (Accept: application/msgpack)."""
+
+    def response(self, *args, **kwargs):
+        if not wants_msgpack():
+            resp = super().response(*args, **kwargs)
+            _add_vary(resp, "Accept")
+            return resp
+        obj = self._prepare_response_obj(args, kwargs)
+        body = msgpack.packb(obj, default=self.default, use_bin_type=True)
+        resp = self._app.response_class(body, mimetype=MSGPACK_MIMETYPE)
+        _add_vary(resp, "Accept")
+        return resp
+
+
+class ContentNegotiation:
+    """
+    Compressione gzip/brotli delle risposte (anche in streaming, tranne Server-Sent Events) sopra `min_size`
+    byte e cache delle risposte immutabili già compresse, per formato e codifica.
+    """
+
+    def __init__(self, app=None, min_size=1024, cache_entries=512):
+        self.min_size = min_size
+        self.cache = LRUCache(cache_entries)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.json = NegotiatingJSONProvider(app)
+        app.after_request(self.after_request)
+
+    def after_request(self, resp):
+        if resp.direct_passthrough or resp.status_code < 200 or resp.status_code in (204, 304) \
+                or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESSIBLE_TYPES:
+            return resp
+        encoding = choose_encoding()
+        _add_vary(resp, "Accept-Encoding")
+
+        if resp.is_streamed:
+            if encoding:
+                resp.response = compress_stream(resp.response, encoding)
+                resp.headers["Content-Encoding"] = encoding
+                resp.headers.pop("Content-Length", None)
+            return resp
+
+        data = resp.get_data()
+        if encoding and len(data) >= self.min_size:
+            resp.set_data(compress(data, encoding))
+            resp.headers["Content-Encoding"] = encoding
+            # rappresentazioni diverse: l'ETag forte del corpo non compresso diventa debole
+            etag, weak = resp.get_etag()
+            if etag and not weak:
+                resp.set_etag(etag, weak=True)
+        else:
+            encoding = None
+
+        key = g.pop("immutable_cache_key", None)
+        if key is not None and resp.status_code == 200:
+            headers = {h: resp.headers[h] for h in CACHED_HEADERS if h in resp.headers}
+            self.cache.put(key + (resp.mimetype, encoding), (resp.get_data(), headers))
+        return resp
+
+    def invalidate(self, path_fragment):
+        """Rimuove dalla cache le risposte la cui URL contiene `path_fragment` (es. "/<pet_id>")."""
+        self.cache.discard_where(lambda key: path_fragment in key[1])
+
+    def immutable(self, is_immutable):
+        """
+        Decoratore per view la cui risposta, per la stessa URL, non cambia più quando is_immutable(**view_args)
+        è vero (es. intervalli di giorni conclusi): la risposta compressa viene servita dalla cache.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not is_immutable(**kwargs):
+                    return view(*args, **kwargs)
+                key = (session.get("username"), request.full_path)
+                mimetype = MSGPACK_MIMETYPE if wants_msgpack() else "application/json"
+                cached = self.cache.get(key + (mimetype, choose_encoding()))
+                if cached is None:
+                    # la risposta può non raggiungere la soglia di compressione: prova anche la versione non compressa
+                    cached = self.cache.get(key + (mimetype, None))
+                if cached is not None:
+                    body, headers = cached
+                    return current_app.response_class(body, headers=headers)
+                g.immutable_cache_key = key
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
@@ -0,0 +1,201 @@
+import os
+import socket
+import threading
+import time
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_LEASE_SEC = float(os.getenv("OUTBOX_LEASE_SEC", "300"))
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "5"))
+OUTBOX_NO_TOKEN_RETRY_SEC = float(os.getenv("OUTBOX_NO_TOKEN_RETRY_SEC", "60"))
+TELEGRAM_MAX_MESSAGE_LEN = 4096
+SEPARATOR = "\n\n"
+
+
+def coalesce_texts(texts, max_len=TELEGRAM_MAX_MESSAGE_LEN):
+    """Unisce i testi in meno messaggi possibili, ciascuno entro il limite di lunghezza di Telegram."""
+    out, current = [], ""
+    for text in texts:
+        while len(text) > max_len:
+            if current:
+                out.append(current)
+                current = ""
+            out.append(text[:max_len])
+            text = text[max_len:]
+        if current and len(current) + len(SEPARATOR) + len(text) > max_len:
+            out.append(current)
+            current = ""
+        current = f"{current}{SEPARATOR}{text}" if current else text
+    if current:
+        out.append(current)
+    return out
+
+
+class _Batch:
+    """Consegna in corso di un lotto: una notifica è consegnata quando tutte le sue chat hanno un esito."""
+
+    def __init__(self, on_complete):
+        self.on_complete = on_complete
+        self.lock = threading.Lock()
+        self.remaining = {}    # _id notifica -> chat ancora da completare
+        self.by_chat = {}      # chat_id -> _id notifiche incluse nei suoi messaggi
+        self.parts = {}        # chat_id -> messaggi non ancora conclusi
+        self.failed = {}       # _id notifica -> chat con invio fallito
+
+    def chat_done(self, chat_id, ok):
+        done = []
+        with self.lock:
+            self.parts[chat_id] -= 1
+            for entry_id in self.by_chat[chat_id]:
+                if not ok:
+                    self.failed.setdefault(entry_id, set()).add(chat_id)
+                if self.parts[chat_id] == 0:
+                    left = self.remaining[entry_id]
+                    left.discard(chat_id)
+                    if not left:
+                        del self.remaining[entry_id]
+                        done.append(entry_id)
+        if done:
+            self.on_complete(done, self.failed)
+
+
+class OutboxWorker:
+    """
+    Consegna delle notifiche registrate nella collezione outbox di PetTrackerDB: le prende in carico a
+    lotti, unisce le notifiche destinate alla stessa chat in un solo messaggio e le segna consegnate solo
+    quando il dispatcher Telegram conferma l'esito di ogni chat. Una notifica presa in carico da un
+    processo terminato a metà torna disponibile alla scadenza della lease; finché il dispatcher la sta
+    ancora consegnando (ritentativi con backoff, limiti Telegram) il worker rinnova la lease e non la
+    riprende in carico.
+    """
+
+    def __init__(self, db, get_dispatcher, get_chat_ids, batch_size=OUTBOX_BATCH_SIZE,
+                 lease_sec=OUTBOX_LEASE_SEC, poll_sec=OUTBOX_POLL_SEC):
+        self.db = db
+        self.get_dispatcher = get_dispatcher
+        self.get_chat_ids = get_chat_ids
+        self.batch_size = batch_size
+        self.lease_sec = lease_sec
+        self.poll_sec = poll_sec
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._cond = threading.Condition()
+        self._inflight = set()     # _id delle notifiche prese in carico e non ancora concluse
+        self._renewed_at = 0.0
+        self._thread = None
+        self.delivered = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="notify-outbox", daemon=True)
+            self._thread.start()
+        return self
+
+    def enqueue(self, dedupe_key, text, chat_ids=None, key=None):
+        """Registra la notifica (una sola volta per dedupe_key) e sveglia il worker."""
+        inserted = self.db.enqueue_notification(dedupe_key, text, chat_ids=chat_ids, key=key)
+        if inserted:
+            self._wake.set()
+        return inserted
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_sec)
+            self._wake.clear()
+            try:
+                self._renew_leases()
+                self._drain()
+            except Exception as e:
+                print(f"[OUTBOX] Errore consegna notifiche: {e}")
+
+    def _drain(self):
+        while True:
+            # non prendere in carico più di un lotto alla volta oltre quelli ancora in consegna:
+            # con il dispatcher saturo (limiti Telegram) le lease scadrebbero prima dell'invio
+            with self._cond:
+                while len(self._inflight) >= self.batch_size:
+                    self._cond.wait(self.poll_sec)
+                    if len(self._inflight) >= self.batch_size:
+                        self._renew_leases()
+                limit = self.batch_size - len(self._inflight)
+                inflight = list(self._inflight)
+            entries = self.db.claim_notifications(self.worker_id, limit=limit, lease_sec=self.lease_sec,
+                                                  exclude=inflight)
+            if not entries:
+                return
+            self._deliver(entries)
+            if len(entries) < limit:
+                return
+
+    def _renew_leases(self):
+        """Rinnova le lease delle notifiche in consegna quando ne è trascorso un terzo."""
+        now = time.monotonic()
+        with self._cond:
+            if not self._inflight or now - self._renewed_at < self.lease_sec / 3:
+                return
+            ids = list(self._inflight)
+        try:
+            self.db.renew_notification_leases(self.worker_id, ids, lease_sec=self.lease_sec)
+            self._renewed_at = now
+        except Exception as e:
+            print(f"[OUTBOX] Errore rinnovo lease notifiche: {e}")
+
+    def _deliver(self, entries):
+        ids = [e["_id"] for e in entries]
+        dispatcher = self.get_dispatcher()
+        if dispatcher is None:
+            print("[OUTBOX] TELEGRAM_BOT_TOKEN non configurato, notifiche rimandate")
+            self.db.release_notifications(ids, retry_in_sec=OUTBOX_NO_TOKEN_RETRY_SEC)
+            return
+
+        all_chats = None
+        batch = _Batch(self._complete)
+        texts = {}   # chat_id -> testi in ordine di creazione
+        empty = []
+        for e in entries:
+            if e.get("chat_ids") is not None:
+                chats = set(e["chat_ids"])
+            else:
+                if all_chats is None:
+                    all_chats = set(str(c) for c in self.get_chat_ids())
+                chats = all_chats
+            if not chats:
+                empty.append(e["_id"])
+                continue
+            batch.remaining[e["_id"]] = set(chats)
+            for chat_id in chats:
+                batch.by_chat.setdefault(chat_id, []).append(e["_id"])
+                texts.setdefault(chat_id, []).append(e["text"])
+
+        if empty:
+            print(f"[OUTBOX] {len(empty)} notifiche senza chat_id registrati, skip invio")
+            self.db.mark_notifications_delivered(empty)
+        if not texts:
+            return
+
+        messages = {chat_id: coalesce_texts(t) for chat_id, t in texts.items()}
+        for chat_id, parts in messages.items():
+            batch.parts[chat_id] = len(parts)
+        with self._cond:
+            if not self._inflight:
+                # la lease appena presa vale per lease_sec: il primo rinnovo a un terzo da adesso
+                self._renewed_at = time.monotonic()
+            self._inflight.update(batch.remaining)
+        print(f"[OUTBOX] Consegna di {len(batch.remaining)} notifiche a {len(messages)} chat")
+        for chat_id, parts in messages.items():
+            for text in parts:
+                dispatcher.send(text, [chat_id], on_done=batch.chat_done, persist=False)
+
+    def _complete(self, entry_ids, failed):
+        by_failure = {}
+        for entry_id in entry_ids:
+            by_failure.setdefault(frozenset(failed.get(entry_id, ())), []).append(entry_id)
+        try:
+            for failed_chats, group in by_failure.items():
+                self.db.mark_notifications_delivered(group, failed_chats=failed_chats)
+        except Exception as e:
+            # restano prese in carico: verranno riconsegnate alla scadenza della lease
+            print(f"[OUTBOX] Errore aggiornamento notifiche consegnate: {e}")
+        self.delivered += len(entry_ids)
+        with self._cond:
+            self._inflight.difference_update(entry_ids)
+            self._cond.notify_all()
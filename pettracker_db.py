@@ -1,26 +1,135 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+import pymongo
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, PyMongoError, WTimeoutError
+from pymongo.write_concern import WriteConcern
 from gridfs import GridFS
+import heapq
+import importlib.util
 from datetime import datetime, timezone
 from bson import ObjectId
+from bson.codec_options import CodecOptions
+from operator import attrgetter
 import bcrypt
 import os
-
-
-class PetTrackerDB:
-    def __init__(self, connection_string=None):
+import queue
+import re
+import threading
+import time
+
+from index_manifest import ensure_indexes
+from ingest_spool import IngestSpool
+from storage import ENV_FIELDS, StorageBackend, canonical_env_key, env_key_for_pet, segment_as_position  # noqa: F401
+from timeline import PositionRecord, TIMELINE_FIELDS, normalize_timestamp
+
+# Collezioni time-series (MongoDB >= 7.0) usate al posto di positions/envdata con MONGODB_TIMESERIES=1
+TIMESERIES_COLLECTIONS = {"positions": "positions_ts", "envdata": "envdata_ts"}
+TIMESERIES_OPTIONS = {"timeField": "timestamp", "metaField": "pet_id", "granularity": "seconds"}
+
+# Profili di write concern. Utenti, pet, stanze e regole usano quello del client (acknowledged);
+# le scritture di telemetria ad alta frequenza non attendono il commit del journal.
+WRITE_CONCERN_PROFILES = {
+    "acknowledged": WriteConcern(),
+    "unjournaled": WriteConcern(w=1, j=False),
+    "unacknowledged": WriteConcern(w=0),
+}
+TELEMETRY_WRITE_CONCERN = os.getenv("MONGODB_TELEMETRY_WRITE_CONCERN", "unjournaled")   # GPS e dati ambientali
+RSSI_WRITE_CONCERN = os.getenv("MONGODB_RSSI_WRITE_CONCERN", "unacknowledged")          # posizioni BLE da RSSI
+
+# compressione del protocollo: zstd richiede `zstandard`, snappy `python-snappy`; zlib è sempre disponibile
+_COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+
+# Errori per cui una lettura di telemetria finisce nello spool su disco invece di andare persa
+UNAVAILABLE_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+# un insert più lento di così indica un Mongo in ritardo: le letture successive passano dallo spool
+INGEST_SLOW_WRITE_SEC = float(os.getenv("INGEST_SPOOL_SLOW_WRITE_MS", "500")) / 1000
+# tempo massimo di un insert (o del ping del replayer) prima di considerare Mongo non disponibile
+INGEST_WRITE_TIMEOUT_SEC = float(os.getenv("INGEST_WRITE_TIMEOUT_MS", "2000")) / 1000
+# letture in attesa dell'inserter; oltre, vanno direttamente nello spool
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+
+
+def _env_int(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def available_compressors(names):
+    """Compressori richiesti (es. "zstd,snappy,zlib") per cui è installato il modulo, nell'ordine di preferenza."""
+    out, skipped = [], []
+    for name in (n.strip() for n in names.split(",")):
+        module = _COMPRESSOR_MODULES.get(name)
+        if module and importlib.util.find_spec(module) is not None:
+            out.append(name)
+        elif name:
+            skipped.append(f"{name} ({module or 'sconosciuto'})")
+    if skipped:
+        print(f"⚠️  Compressori MongoDB ignorati, modulo non installato: {', '.join(skipped)}")
+    return out
+
+
+def client_options():
+    """Pool di connessioni, timeout e compressione del MongoClient, configurabili da variabili d'ambiente."""
+    options = {
+        "maxPoolSize": _env_int("MONGODB_MAX_POOL_SIZE", 50),
+        "minPoolSize": _env_int("MONGODB_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _env_int("MONGODB_MAX_IDLE_TIME_MS", 300000),
+        "waitQueueTimeoutMS": _env_int("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": _env_int("MONGODB_CONNECT_TIMEOUT_MS", 5000),
+        "serverSelectionTimeoutMS": _env_int("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        # senza valore nessun timeout sul socket (migrazioni e aggregazioni lunghe)
+        "socketTimeoutMS": _env_int("MONGODB_SOCKET_TIMEOUT_MS"),
+    }
+    options = {k: v for k, v in options.items() if v is not None}
+    compressors = available_compressors(os.getenv("MONGODB_COMPRESSORS", "zstd,snappy,zlib"))
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    return options
+
+
+class PetTrackerDB(StorageBackend):
+    """Livello dati su MongoDB (vedi StorageBackend per l'interfaccia comune agli altri motori)."""
+
+    def __init__(self, connection_string=None, timeseries=None, read_cache=None):
         if connection_string is None:
             connection_string = os.getenv("MONGODB_CONN_STRING")
+        if timeseries is None:
+            timeseries = os.getenv("MONGODB_TIMESERIES", "0") == "1"
+        super().__init__(read_cache)
+        self.timeseries = timeseries
         try:
-            self.client = MongoClient(connection_string, serverSelectionTimeoutMS=5000)
+            self.client = MongoClient(connection_string, **client_options())
             self.client.admin.command('ping')
             print("✅ Connessione a MongoDB riuscita!")
 
             self.db = self.client.PetTracker
             self.users = self.db.users
             self.pets = self.db.pets
-            self.positions = self.db.positions
+            if self.timeseries:
+                for name in TIMESERIES_COLLECTIONS.values():
+                    self._ensure_timeseries_collection(name)
+                self.positions = self.db[TIMESERIES_COLLECTIONS["positions"]]
+                self.envdata = self.db[TIMESERIES_COLLECTIONS["envdata"]]
+            else:
+                self.positions = self.db.positions
+                self.envdata = self.db.envdata
             self.rooms = self.db.rooms
             self.perimeters = self.db.perimeters
+            self.position_segments = self.db.position_segments
+            self.timeline_days = self.db.timeline_days
+            self.heatmap_days = self.db.heatmap_days
+            self.alert_rules = self.db.alert_rules
+            # stesse collezioni, con il write concern dei profili di telemetria (solo per gli insert di ingest)
+            telemetry_wc = WRITE_CONCERN_PROFILES[TELEMETRY_WRITE_CONCERN]
+            self._positions_ingest = self.positions.with_options(write_concern=telemetry_wc)
+            self._envdata_ingest = self.envdata.with_options(write_concern=telemetry_wc)
+            self._positions_rssi = self.positions.with_options(write_concern=WRITE_CONCERN_PROFILES[RSSI_WRITE_CONCERN])
+            # letture dello storico in record: il driver restituisce già datetime UTC aware
+            aware = CodecOptions(tz_aware=True)
+            self._positions_aware = self.positions.with_options(codec_options=aware)
+            self._segments_aware = self.position_segments.with_options(codec_options=aware)
+            self._envdata_aware = self.envdata.with_options(codec_options=aware)
+            self.notification_outbox = self.db.notification_outbox
             self.gridfs_images = GridFS(self.db, collection="pet_images")
 
             self._setup_indexes()
@@ -29,24 +138,114 @@ class PetTrackerDB:
             print(f"❌ Connessione a MongoDB fallita: {e}")
             raise
 
-    # --- Utils ---
-    @staticmethod
-    def _ensure_oid(value):
-        """Restituisce un ObjectId a partire da una stringa o passa attraverso se è già ObjectId."""
-        if isinstance(value, ObjectId):
-            return value
-        return ObjectId(value)
+    # --- Spool di ingest ---
+    def start_ingest_spool(self, on_replay=None, **options):
+        """
+        Attiva lo spool su disco per positions/envdata e riprende i segmenti lasciati da un'esecuzione
+        precedente. Da chiamare una sola volta, nel processo che riceve la telemetria.
+
+        Da qui in poi gli insert di telemetria non bloccano il chiamante: finiscono in una coda limitata
+        svuotata da un thread inserter, che li scrive su Mongo o, se Mongo non risponde o è indietro, nello spool.
+        `on_replay(collezione, documenti)` viene chiamata dopo ogni lotto reinserito dallo spool: i record
+        arrivati in ritardo possono cadere in giorni già conclusi e messi in cache.
+        """
+        if self.spool is None:
+            self._on_replay = on_replay
+            self._ingest_queue = queue.Queue(INGEST_QUEUE_SIZE)
+            self.spool = IngestSpool(self._replay_insert, self._is_available, **options).start()
+            threading.Thread(target=self._ingest_loop, name="ingest-writer", daemon=True).start()
+        return self.spool
+
+    def _is_available(self):
+        try:
+            with pymongo.timeout(INGEST_WRITE_TIMEOUT_SEC):
+                self.client.admin.command("ping")
+            return True
+        except Exception:
+            return False
+
+    def _replay_insert(self, name, docs):
+        collection = getattr(self, name)
+        missing = docs
+        if self.timeseries:
+            # le collezioni time-series non hanno un _id univoco: un lotto reinserito due volte (crash prima del
+            # checkpoint, insert andato a buon fine oltre il timeout) si scarta qui cercando gli _id già presenti
+            times = [d["timestamp"] for d in docs]
+            present = {d["_id"] for d in collection.find(
+                {"timestamp": {"$gte": min(times), "$lte": max(times)}, "_id": {"$in": [d["_id"] for d in docs]}},
+                {"_id": 1}
+            )}
+            missing = [d for d in docs if d["_id"] not in present]
+        if missing:
+            try:
+                collection.insert_many(missing, ordered=False)
+            except BulkWriteError as e:
+                # documenti già inseriti prima di un crash del replayer (stessi _id): ignorati
+                errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if errors or e.details.get("writeConcernErrors"):
+                    raise
+        if self._on_replay is not None:
+            try:
+                self._on_replay(name, docs)
+            except Exception as e:
+                print(f"[SPOOL] Errore invalidazione dopo il reinserimento: {e}")
+
+    def _insert_telemetry(self, name, collection, doc):
+        """Insert di ingest: con lo spool attivo il record passa dalla coda dell'inserter e non blocca il chiamante."""
+        spool = self.spool
+        if spool is None:
+            collection.insert_one(doc)
+            return
+        doc.setdefault("_id", ObjectId())
+        try:
+            self._ingest_queue.put_nowait((name, collection, doc))
+        except queue.Full:
+            # l'inserter non tiene il passo: il record va su disco e le letture successive seguono lo spool
+            spool.append(name, doc)
+
+    def _ingest_loop(self):
+        while True:
+            name, collection, doc = self._ingest_queue.get()
+            try:
+                self._write_telemetry(name, collection, doc)
+            except Exception as e:
+                print(f"[SPOOL] Errore inserimento {name}: {e}, lettura salvata nello spool")
+                self.spool.append(name, doc)
+
+    def _write_telemetry(self, name, collection, doc):
+        spool = self.spool
+        # interruttore: dopo un errore o un insert lento lo spool resta attivo finché il replayer non lo
+        # svuota (e il replayer riparte solo quando il ping risponde), quindi le letture vanno dritte su disco
+        if spool.active:
+            spool.append(name, doc)
+            return
+        start = time.monotonic()
+        try:
+            with pymongo.timeout(INGEST_WRITE_TIMEOUT_SEC):
+                collection.insert_one(doc)
+        except PyMongoError as e:
+            if not (isinstance(e, UNAVAILABLE_ERRORS) or e.timeout):
+                raise
+            print(f"[SPOOL] Mongo non disponibile ({e}), lettura salvata nello spool")
+            spool.append(name, doc)
+            return
+        if time.monotonic() - start > INGEST_SLOW_WRITE_SEC:
+            spool.mark_backlogged()
+
+    def _ensure_timeseries_collection(self, name):
+        """Crea la collezione time-series (pet_id come metaField, timestamp come timeField) se manca."""
+        info = next(iter(self.db.list_collections(filter={"name": name})), None)
+        if info is None:
+            self.db.create_collection(name, timeseries=TIMESERIES_OPTIONS)
+            print(f"✅ Collezione time-series '{name}' creata")
+        elif info.get("type") != "timeseries":
+            print(f"⚠️ La collezione '{name}' esiste ma non è time-series")
 
     def _setup_indexes(self):
+        # indici dichiarati in index_manifest.py insieme alle query frequenti che servono
+        # (verifica con: python manage.py check-indexes)
         try:
-            self.users.create_index([("username", ASCENDING)], unique=True)
-            self.pets.create_index([("owner_id", ASCENDING)])
-            # Consigliato: evitare duplicati MAC
-            self.pets.create_index([("mac_address", ASCENDING)], unique=True, name="uniq_mac_address")
-            self.positions.create_index([("pet_id", ASCENDING), ("timestamp", DESCENDING)])
-            self.rooms.create_index([("owner_id", ASCENDING)])
-            self.perimeters.create_index([("pet_id", ASCENDING)])
-            self.perimeters.create_index([("key", ASCENDING)])
+            ensure_indexes(self)
         except Exception as e:
             print(f"⚠️ Errore nella creazione degli indici: {e}")
 
@@ -57,11 +256,13 @@ class PetTrackerDB:
         Usa bcrypt con costo rounds=12 per coerenza con il resto dell'app.
         """
         password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
-        return self.users.insert_one({
+        user_id = self.users.insert_one({
             "username": username,
             "password_hash": password_hash,
             "created_at": datetime.now(timezone.utc)
         }).inserted_id
+        self.invalidate_cache(("user", username))
+        return user_id
 
     def get_user_by_username(self, username):
         return self.users.find_one({"username": username})
@@ -70,35 +271,31 @@ class PetTrackerDB:
         oid = self._ensure_oid(user_id)
         return self.users.find_one({"_id": oid})
 
-    def authenticate_user(self, username, password):
-        """
-        Autenticazione utente:
-        - legge preferibilmente 'password_hash'
-        - mantiene retrocompatibilità se dovesse esistere ancora il campo 'password'
-        - accetta sia valori bytes che string memorizzati (se necessario)
-        """
-        user = self.get_user_by_username(username)
-        if not user:
-            return None
+    def get_user(self, username, active_only=False, include_hash=True):
+        query = {"username": username}
+        if active_only:
+            query["is_active"] = True
+        return self.users.find_one(query, None if include_hash else {"password_hash": 0})
 
-        # preferisci 'password_hash', fallback a 'password' (per retrocompatibilità)
-        stored = user.get('password_hash') if 'password_hash' in user else user.get('password')
-        if not stored:
-            return None
+    def count_users(self):
+        return self.users.count_documents({})
 
-        # stored può essere bytes oppure string; assicurati di avere bytes per bcrypt
-        if isinstance(stored, str):
-            stored_bytes = stored.encode('utf-8')
-        else:
-            stored_bytes = stored
+    def insert_user(self, doc):
+        user_id = self.users.insert_one(dict(doc)).inserted_id
+        self.invalidate_cache(("user", doc.get("username")))
+        return user_id
 
-        try:
-            if bcrypt.checkpw(password.encode('utf-8'), stored_bytes):
-                return user
-        except Exception as e:
-            # in caso di valore non valido per bcrypt, falliamo l'autenticazione
-            print(f"[AUTH] errore verifica password per {username}: {e}")
-        return None
+    def update_user(self, user_id, fields):
+        # documento precedente: serve il vecchio username per invalidare la cache anche dopo un rinomino
+        before = self.users.find_one_and_update({"_id": self._ensure_oid(user_id)}, {"$set": fields},
+                                                projection={"username": 1})
+        if before is not None:
+            self.invalidate_cache(("user", before.get("username")), ("user", fields.get("username")))
+
+    def delete_user(self, username):
+        deleted = self.users.delete_one({"username": username}).deleted_count == 1
+        self.invalidate_cache(("user", username))
+        return deleted
 
     # --- PETS ---
     def add_pet(self, name, owner_id, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
@@ -117,13 +314,40 @@ class PetTrackerDB:
             pet_data["temp_max"] = temp_max
         return self.pets.insert_one(pet_data).inserted_id
 
+    def get_registered_macs(self):
+        """MAC di tutti i pet registrati (solo il campo mac_address)."""
+        return [p["mac_address"] for p in self.pets.find({"mac_address": {"$nin": [None, ""]}}, {"mac_address": 1, "_id": 0})]
+
     def get_pets_for_user(self, user_id):
         # coerente con l'uso della stringa per owner_id
         return list(self.pets.find({"owner_id": str(user_id)}))
 
     def get_pet_by_id(self, pet_id):
         oid = self._ensure_oid(pet_id)
-        return self.pets.find_one({"_id": oid})
+        return self.cached(("pet", str(oid)), lambda: self.pets.find_one({"_id": oid}))
+
+    def get_pets_by_ids(self, pet_ids):
+        """pet_id (stringa) -> documento pet, con una sola query; gli id non validi vengono ignorati."""
+        oids = []
+        for pet_id in pet_ids:
+            try:
+                oids.append(self._ensure_oid(pet_id))
+            except Exception:
+                continue
+        if not oids:
+            return {}
+        return {str(p["_id"]): p for p in self.pets.find({"_id": {"$in": oids}})}
+
+    def get_pet_by_mac(self, mac_address, owner_id=None):
+        query = {"mac_address": mac_address}
+        if owner_id is not None:
+            query["owner_id"] = str(owner_id)
+        return self.pets.find_one(query)
+
+    def get_pet_by_bt_name(self, bt_name, ignore_case=False):
+        if ignore_case:
+            return self.pets.find_one({"bt_name": {"$regex": f"^{re.escape(bt_name)}$", "$options": "i"}})
+        return self.pets.find_one({"bt_name": bt_name})
 
     def update_pet(self, pet_id, name=None, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
         update_fields = {}
@@ -140,52 +364,56 @@ class PetTrackerDB:
         if update_fields:
             oid = self._ensure_oid(pet_id)
             self.pets.update_one({"_id": oid}, {"$set": update_fields})
+            self.invalidate_cache(("pet", str(oid)))
 
     def delete_pet(self, pet_id):
         oid = self._ensure_oid(pet_id)
         self.pets.delete_one({"_id": oid})
+        self.invalidate_cache(("pet", str(oid)))
 
     # --- ROOMS (globali, per configurazione area/stanze) ---
     def get_rooms(self):
         """Restituisce tutte le stanze (ancore BT)."""
-        return list(self.rooms.find({}))
+        return self.cached(("rooms",), lambda: list(self.rooms.find({})))
 
     def add_room(self, name, mac_address, allowed):
-        return self.rooms.insert_one({
+        room_id = self.rooms.insert_one({
             "name": name,
             "mac_address": mac_address,
             "allowed": allowed
         }).inserted_id
+        self.invalidate_cache(("rooms",))
+        return room_id
 
     def get_room_by_id(self, room_id):
         oid = self._ensure_oid(room_id)
-        return self.rooms.find_one({"_id": oid})
+        return self.cached(("room", str(oid)), lambda: self.rooms.find_one({"_id": oid}))
+
+    def get_room_by_name(self, name):
+        return self.rooms.find_one({"name": name})
+
+    def get_room_by_mac(self, mac_address):
+        return self.rooms.find_one({"mac_address": mac_address})
 
     def update_room(self, room_id, name, mac_address, allowed):
         oid = self._ensure_oid(room_id)
         update_data = {"name": name, "mac_address": mac_address, "allowed": allowed}
         self.rooms.update_one({"_id": oid}, {"$set": update_data})
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
 
     def delete_room(self, room_id):
         oid = self._ensure_oid(room_id)
         self.rooms.delete_one({"_id": oid})
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
 
     def update_room_access(self, room_id, allowed):
         oid = self._ensure_oid(room_id)
         self.rooms.update_one({"_id": oid}, {"$set": {"allowed": allowed}})
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
 
     # --- PERIMETRO (globale per tutti i pet) ---
-    def get_perimeter_center(self):
-        perim = self.perimeters.find_one({"key": "global"})
-        if perim and "center" in perim:
-            return tuple(perim["center"])
-        return None
-
-    def get_perimeter_radius(self):
-        perim = self.perimeters.find_one({"key": "global"})
-        if perim and "radius" in perim:
-            return perim["radius"]
-        return None
+    def _global_perimeter(self):
+        return self.cached(("perimeter",), lambda: self.perimeters.find_one({"key": "global"}))
 
     def save_perimeter(self, center, radius):
         self.perimeters.update_one(
@@ -193,6 +421,91 @@ class PetTrackerDB:
             {"$set": {"center": center, "radius": radius}},
             upsert=True
         )
+        self.invalidate_cache(("perimeter",))
+
+    # --- REGOLE D'ALLARME PERSONALIZZATE (pet_id "*" = tutti i pet) ---
+    def get_alert_rules(self, pet_id):
+        return list(self.alert_rules.find({"pet_id": str(pet_id)}))
+
+    def list_alert_rules(self):
+        return list(self.alert_rules.find().sort("pet_id", ASCENDING))
+
+    def add_alert_rule(self, rule):
+        return self.alert_rules.insert_one(dict(rule)).inserted_id
+
+    def delete_alert_rule(self, rule_id):
+        oid = self._ensure_oid(rule_id)
+        return self.alert_rules.find_one_and_delete({"_id": oid})
+
+    # --- OUTBOX NOTIFICHE ---
+    def enqueue_notification(self, dedupe_key, text, chat_ids=None, key=None):
+        """
+        Registra una notifica da consegnare (chat_ids=None: tutte le chat iscritte).
+        Ritorna False se una notifica con la stessa dedupe_key è già stata registrata.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            self.notification_outbox.insert_one({
+                "dedupe_key": dedupe_key,
+                "key": key,
+                "text": text,
+                "chat_ids": [str(c) for c in chat_ids] if chat_ids is not None else None,
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+                "available_at": now,
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def claim_notifications(self, worker_id, limit=50, lease_sec=300, exclude=()):
+        """
+        Prende in carico fino a `limit` notifiche in attesa, o prese in carico da un worker la cui lease è
+        scaduta (es. processo terminato a metà consegna). La presa in carico è atomica: ogni notifica
+        viene assegnata a un solo worker. `exclude`: notifiche che il worker sta ancora consegnando.
+        """
+        now = datetime.now(timezone.utc)
+        claimable = {"status": {"$in": ["pending", "claimed"]}, "available_at": {"$lte": now}}
+        if exclude:
+            claimable["_id"] = {"$nin": list(exclude)}
+        ids = [d["_id"] for d in self.notification_outbox.find(claimable, {"_id": 1})
+               .sort("available_at", ASCENDING).limit(limit)]
+        if not ids:
+            return []
+        token = f"{worker_id}:{ObjectId()}"
+        self.notification_outbox.update_many(
+            {**claimable, "_id": {"$in": ids}},
+            {"$set": {"status": "claimed", "claim": token,
+                      "available_at": datetime.fromtimestamp(now.timestamp() + lease_sec, timezone.utc)},
+             "$inc": {"attempts": 1}}
+        )
+        claimed = list(self.notification_outbox.find({"claim": token}))
+        claimed.sort(key=lambda d: d["created_at"])
+        return claimed
+
+    def renew_notification_leases(self, worker_id, ids, lease_sec=300):
+        lease_until = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() + lease_sec, timezone.utc)
+        return self.notification_outbox.update_many(
+            {"_id": {"$in": list(ids)}, "status": "claimed", "claim": {"$regex": f"^{re.escape(worker_id)}:"}},
+            {"$set": {"available_at": lease_until}}
+        ).modified_count
+
+    def mark_notifications_delivered(self, ids, failed_chats=None):
+        update = {"status": "delivered", "delivered_at": datetime.now(timezone.utc)}
+        if failed_chats:
+            update["failed_chats"] = sorted(failed_chats)
+        return self.notification_outbox.update_many(
+            {"_id": {"$in": list(ids)}}, {"$set": update, "$unset": {"claim": ""}}
+        ).modified_count
+
+    def release_notifications(self, ids, retry_in_sec=0):
+        """Rimette in attesa notifiche prese in carico ma non consegnate."""
+        available = datetime.fromtimestamp(datetime.now(timezone.utc).timestamp() + retry_in_sec, timezone.utc)
+        return self.notification_outbox.update_many(
+            {"_id": {"$in": list(ids)}, "status": "claimed"},
+            {"$set": {"status": "pending", "available_at": available}, "$unset": {"claim": ""}}
+        ).modified_count
 
     def set_pet_allowed_rooms(self, pet_id, room_ids):
         oid = self._ensure_oid(pet_id)
@@ -200,12 +513,13 @@ class PetTrackerDB:
             {"_id": oid},
             {"$set": {"allowed_rooms": [str(r) for r in room_ids]}}
         )
+        self.invalidate_cache(("pet", str(oid)))
 
     # --- POSIZIONI ---
     def save_pet_position(self, pet_id, lat, lon, timestamp=None):
         if not timestamp:
             timestamp = datetime.now(timezone.utc)
-        self.positions.insert_one({
+        self._insert_telemetry("positions", self._positions_ingest, {
             "pet_id": str(pet_id),
             "lat": lat,
             "lon": lon,
@@ -225,8 +539,10 @@ class PetTrackerDB:
         print("=== SALVATAGGIO POSIZIONE ===")
         print(record)
         try:
-            self.positions.insert_one(record)
-            print("=== SALVATAGGIO OK ===")
+            collection = self._positions_rssi if kwargs.get("source") == "ble" else self._positions_ingest
+            self._insert_telemetry("positions", collection, record)
+            # con lo spool attivo il record è solo accodato: l'esito su Mongo lo riporta l'inserter ([SPOOL])
+            print("=== SALVATAGGIO IN CODA ===" if self.spool is not None else "=== SALVATAGGIO OK ===")
         except Exception as e:
             print("ERRORE SALVATAGGIO:", e)
 
@@ -236,14 +552,283 @@ class PetTrackerDB:
             sort=[("timestamp", DESCENDING)]
         )
 
-    def get_positions(self, pet_id, limit=50):
-        return list(self.positions.find({"pet_id": str(pet_id)}).sort("timestamp", DESCENDING).limit(limit))
+    def latest_positions(self, pet_ids, sources=("ble", "gps")):
+        """
+        Ultima posizione di ciascun pet per sorgente con una sola aggregazione
+        ($match, $sort, $group/$first sull'indice (pet_id, source, timestamp)).
+        Ritorna {pet_id: {sorgente: documento}}.
+        """
+        pet_ids = [str(p) for p in pet_ids]
+        if not pet_ids:
+            return {}
+        pipeline = [
+            {"$match": {"pet_id": {"$in": pet_ids}, "source": {"$in": list(sources)}}},
+            {"$sort": {"pet_id": ASCENDING, "source": ASCENDING, "timestamp": DESCENDING}},
+            {"$group": {
+                "_id": {"pet_id": "$pet_id", "source": "$source"},
+                "timestamp": {"$first": "$timestamp"},
+                "room": {"$first": "$room"},
+                "lat": {"$first": "$lat"},
+                "lon": {"$first": "$lon"},
+            }},
+        ]
+        result = {}
+        for doc in self.positions.aggregate(pipeline):
+            key = doc.pop("_id")
+            result.setdefault(key["pet_id"], {})[key["source"]] = doc
+        return result
+
+    def get_positions(self, pet_id, limit=50, fields=None):
+        return list(self.positions.find({"pet_id": str(pet_id)}, self._projection(fields))
+                    .sort("timestamp", DESCENDING).limit(limit))
+
+    def iter_positions(self, pet_id, start, end, fields=None, batch_size=1000):
+        """
+        Itera le posizioni del pet nell'intervallo [start, end] in ordine di timestamp crescente,
+        unendo le posizioni grezze ai segmenti compattati (restituiti con "timestamp"=start,
+        "end" e "count"). Se `fields` è indicato proietta solo quei campi.
+        """
+        projection = None
+        if fields:
+            projection = {f: 1 for f in fields}
+            projection["_id"] = 0
+        raw = self.positions.find(
+            {"pet_id": str(pet_id), "timestamp": {"$gte": start, "$lte": end}},
+            projection
+        ).sort("timestamp", ASCENDING).batch_size(batch_size)
+        segments = self.position_segments.find(
+            {"pet_id": str(pet_id), "start": {"$gte": start, "$lte": end}}
+        ).sort("start", ASCENDING).batch_size(batch_size)
+        return heapq.merge(raw, (segment_as_position(s, fields) for s in segments),
+                           key=lambda p: p["timestamp"])
+
+    def iter_position_records(self, pet_id, start, end, batch_size=1000):
+        """
+        Come iter_positions(fields=TIMELINE_FIELDS) ma in PositionRecord: solo i campi della timeline letti
+        da Mongo, timestamp normalizzati una volta alla decodifica e nessun dizionario per riga.
+        """
+        raw = self._positions_aware.find(
+            {"pet_id": str(pet_id), "timestamp": {"$gte": start, "$lte": end}},
+            {**{f: 1 for f in TIMELINE_FIELDS}, "_id": 0}
+        ).sort("timestamp", ASCENDING).batch_size(batch_size)
+        segments = self._segments_aware.find(
+            {"pet_id": str(pet_id), "start": {"$gte": start, "$lte": end}},
+            {"_id": 0, "start": 1, "end": 1, "count": 1, "source": 1, "entry_type": 1, "room": 1}
+        ).sort("start", ASCENDING).batch_size(batch_size)
+        return heapq.merge(map(PositionRecord.from_doc, raw), map(PositionRecord.from_segment, segments),
+                           key=attrgetter("timestamp"))
+
+    # --- COMPATTAZIONE (vedi compaction.py) ---
+    def compaction_pet_ids(self, cutoff):
+        return self.positions.distinct("pet_id", {"source": "ble", "timestamp": {"$lt": cutoff}})
+
+    def iter_compactable_positions(self, pet_id, cutoff):
+        return self.positions.find(
+            {"pet_id": pet_id, "timestamp": {"$lt": cutoff}},
+            {"_id": 1, "timestamp": 1, "source": 1, "entry_type": 1, "room": 1, "rssi": 1}
+        ).sort("timestamp", ASCENDING)
+
+    def store_segments(self, segments):
+        """Scrive i segmenti e verifica che ci siano tutti con il conteggio atteso; altrimenti li rimuove."""
+        self.position_segments.bulk_write(
+            [ReplaceOne({"_id": s["_id"]}, s, upsert=True) for s in segments],
+            ordered=False
+        )
+        expected = {s["_id"]: s["count"] for s in segments}
+        stored = {
+            d["_id"]: d.get("count")
+            for d in self.position_segments.find({"_id": {"$in": list(expected)}}, {"count": 1})
+        }
+        if stored != expected:
+            # le posizioni grezze restano la fonte di verità: niente doppi conteggi in lettura
+            self.position_segments.delete_many({"_id": {"$in": list(expected)}})
+            print(f"[COMPACT] Verifica fallita ({len(stored)}/{len(expected)} segmenti), posizioni grezze mantenute")
+            return False
+        return True
+
+    def delete_positions(self, ids):
+        return self.positions.delete_many({"_id": {"$in": list(ids)}}).deleted_count
+
+    # --- STORICO (paginazione keyset su (timestamp, _id), niente skip) ---
+    @staticmethod
+    def _projection(fields):
+        if not fields:
+            return None
+        projection = {f: 1 for f in fields}
+        projection["timestamp"] = 1
+        return projection
+
+    @staticmethod
+    def _keyset_after(ts_field, ts, last_id):
+        return {"$or": [{ts_field: {"$gt": ts}}, {ts_field: ts, "_id": {"$gt": last_id}}]}
+
+    def page_positions(self, pet_id, start, end, after=None, limit=500, fields=None):
+        """
+        Una pagina di storico posizioni (grezze + segmenti compattati) ordinata per (timestamp, tipo, _id).
+        `after` è la chiave dell'ultimo elemento della pagina precedente: (timestamp, rank, _id) con
+        rank 0 = posizione grezza, 1 = segmento. Ritorna (elementi, chiave_successiva o None);
+        ogni elemento è (rank, documento).
+        """
+        raw_q = [{"pet_id": str(pet_id), "timestamp": {"$gte": start, "$lte": end}}]
+        seg_q = [{"pet_id": str(pet_id), "start": {"$gte": start, "$lte": end}}]
+        if after:
+            ts, rank, last_id = after
+            if rank == 0:
+                raw_q.append(self._keyset_after("timestamp", ts, self._ensure_oid(last_id)))
+                seg_q.append({"start": {"$gte": ts}})
+            else:
+                raw_q.append({"timestamp": {"$gt": ts}})
+                seg_q.append(self._keyset_after("start", ts, str(last_id)))
+
+        raw = self.positions.find({"$and": raw_q}, self._projection(fields)) \
+            .sort([("timestamp", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+        segs = self.position_segments.find({"$and": seg_q}) \
+            .sort([("start", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+
+        def with_seg_id(seg):
+            doc = segment_as_position(seg, fields)
+            doc["_id"] = seg["_id"]
+            return doc
+
+        merged = heapq.merge(
+            ((0, d) for d in raw),
+            ((1, with_seg_id(s)) for s in segs),
+            key=lambda item: (item[1]["timestamp"], item[0], str(item[1]["_id"]))
+        )
+        items = [item for _, item in zip(range(limit), merged)]
+        next_after = None
+        if len(items) == limit:
+            rank, doc = items[-1]
+            next_after = (doc["timestamp"], rank, str(doc["_id"]))
+        return items, next_after
+
+    def page_env(self, key, start, end, after=None, limit=500, fields=None):
+        """
+        Una pagina di letture ambientali per la chiave indicata (stesso schema keyset di page_positions).
+        Senza `fields` si leggono solo ENV_FIELDS, con timestamp già aware dalla decodifica.
+        """
+        query = [{"pet_id": key, "timestamp": {"$gte": start, "$lte": end}}]
+        if after:
+            ts, _, last_id = after
+            query.append(self._keyset_after("timestamp", ts, self._ensure_oid(last_id)))
+        docs = list(self._envdata_aware.find({"$and": query}, self._projection(fields or ENV_FIELDS))
+                    .sort([("timestamp", ASCENDING), ("_id", ASCENDING)]).limit(limit))
+        next_after = None
+        if len(docs) == limit:
+            next_after = (docs[-1]["timestamp"], 0, str(docs[-1]["_id"]))
+        return [(0, d) for d in docs], next_after
+
+    # --- SERIE AMBIENTALI (grafici) ---
+    def env_buckets(self, key, start, end, bucket_sec):
+        """min/max/media di temperatura e umidità per intervalli di `bucket_sec` secondi, calcolati in Mongo."""
+        bucket_ms = int(bucket_sec * 1000)
+        ts_ms = {"$toLong": "$timestamp"}
+        pipeline = [
+            {"$match": {"pet_id": key, "timestamp": {"$gte": start, "$lte": end}}},
+            {"$group": {
+                "_id": {"$subtract": [ts_ms, {"$mod": [ts_ms, bucket_ms]}]},
+                "temp_min": {"$min": "$temp"},
+                "temp_max": {"$max": "$temp"},
+                "temp_avg": {"$avg": "$temp"},
+                "hum_min": {"$min": "$hum"},
+                "hum_max": {"$max": "$hum"},
+                "hum_avg": {"$avg": "$hum"},
+                "n": {"$sum": 1},
+            }},
+            {"$sort": {"_id": 1}},
+        ]
+        return list(self.envdata.aggregate(pipeline))
+
+    def iter_env_series(self, key, start, end, metric):
+        """Ritorna (numero_punti, iteratore di (epoch_sec, valore)) ordinato per timestamp, solo il campo richiesto."""
+        query = {
+            "pet_id": key,
+            "timestamp": {"$gte": start, "$lte": end},
+            metric: {"$type": "number"},
+        }
+        n = self.envdata.count_documents(query)
+        cursor = self.envdata.find(query, {"_id": 0, "timestamp": 1, metric: 1}) \
+            .sort("timestamp", ASCENDING).batch_size(5000)
+        series = ((normalize_timestamp(d["timestamp"]).timestamp(), d[metric]) for d in cursor)
+        return n, series
+
+    # --- RIEPILOGHI TIMELINE (giorni conclusi, immutabili) ---
+    def get_timeline_days(self, pet_id, dates, version):
+        """Ritorna {data_iso: riepilogo} per i giorni richiesti già salvati."""
+        cursor = self.timeline_days.find(
+            {"pet_id": str(pet_id), "date": {"$in": list(dates)}, "version": version},
+            {"_id": 0, "date": 1, "summary": 1}
+        )
+        return {d["date"]: d["summary"] for d in cursor}
 
+    def save_timeline_day(self, pet_id, date, version, summary):
+        self.timeline_days.update_one(
+            {"pet_id": str(pet_id), "date": date, "version": version},
+            {"$set": {"summary": summary, "computed_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def delete_timeline_days(self, pet_id, dates=None):
+        query = {"pet_id": str(pet_id)}
+        if dates:
+            query["date"] = {"$in": list(dates)}
+        self.timeline_days.delete_many(query)
+
+    # --- HEATMAP GPS (celle di griglia per giorno) ---
+    def aggregate_gps_cells(self, pet_id, start, end, precision, tz_name):
+        """
+        Conta le posizioni con coordinate per (giorno locale, cella) direttamente in Mongo.
+        La cella è (floor(lat * 10^precision), floor(lon * 10^precision)).
+        Ritorna {data_iso: [[y, x, conteggio], ...]}.
+        """
+        scale = 10 ** precision
+        pipeline = [
+            {"$match": {
+                "pet_id": str(pet_id),
+                "timestamp": {"$gte": start, "$lt": end},
+                "lat": {"$type": "number"},
+                "lon": {"$type": "number"},
+            }},
+            {"$group": {
+                "_id": {
+                    "d": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp", "timezone": tz_name}},
+                    "y": {"$floor": {"$multiply": ["$lat", scale]}},
+                    "x": {"$floor": {"$multiply": ["$lon", scale]}},
+                },
+                "n": {"$sum": 1},
+            }},
+        ]
+        by_day = {}
+        for row in self.positions.aggregate(pipeline):
+            key = row["_id"]
+            by_day.setdefault(key["d"], []).append([int(key["y"]), int(key["x"]), row["n"]])
+        return by_day
+
+    def get_heatmap_days(self, pet_id, dates, precision):
+        cursor = self.heatmap_days.find(
+            {"pet_id": str(pet_id), "date": {"$in": list(dates)}, "precision": precision},
+            {"_id": 0, "date": 1, "cells": 1}
+        )
+        return {d["date"]: d["cells"] for d in cursor}
+
+    def save_heatmap_day(self, pet_id, date, precision, cells):
+        self.heatmap_days.update_one(
+            {"pet_id": str(pet_id), "date": date, "precision": precision},
+            {"$set": {"cells": cells, "computed_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def delete_heatmap_days(self, pet_id, dates=None):
+        query = {"pet_id": str(pet_id)}
+        if dates:
+            query["date"] = {"$in": list(dates)}
+        self.heatmap_days.delete_many(query)
 
     # --- ENV DATA ---
     def save_env_data(self, pet_id, temp, hum, timestamp):
-        self.db.envdata.insert_one({
-            "pet_id": str(pet_id) if pet_id else "global",
+        # le letture si salvano sempre con la chiave canonica (vedi canonical_env_key)
+        self._insert_telemetry("envdata", self._envdata_ingest, {
+            "pet_id": canonical_env_key(pet_id),
             "temp": temp,
             "hum": hum,
             "timestamp": timestamp
@@ -251,21 +836,27 @@ class PetTrackerDB:
 
     def get_latest_env(self, pet_id=None):
         # se pet_id non è passato o è "global", prendiamo il dato globale
-        key = str(pet_id) if pet_id else "global"
-        return self.db.envdata.find_one({"pet_id": key}, sort=[("timestamp", -1)])
+        key = canonical_env_key(pet_id)
+        return self.envdata.find_one({"pet_id": key}, sort=[("timestamp", -1)])
+
+    def latest_env_many(self, keys):
+        """Ultima lettura ambientale per ciascuna chiave, con una sola aggregazione: chiave -> documento."""
+        keys = [str(k) for k in keys]
+        if not keys:
+            return {}
+        pipeline = [
+            {"$match": {"pet_id": {"$in": keys}}},
+            {"$sort": {"pet_id": ASCENDING, "timestamp": DESCENDING}},
+            {"$group": {
+                "_id": "$pet_id",
+                "temp": {"$first": "$temp"},
+                "hum": {"$first": "$hum"},
+                "timestamp": {"$first": "$timestamp"},
+            }},
+        ]
+        return {doc.pop("_id"): doc for doc in self.envdata.aggregate(pipeline)}
 
 
-    @staticmethod
-    def is_inside_perimeter(lat, lon, area):
-        try:
-            from shapely.geometry import Point, Polygon
-            point = Point(lon, lat)
-            polygon = Polygon([(lng, lt) for lt, lng in area])  # area = [(lat, lon), ...]
-            return polygon.contains(point)
-        except ImportError:
-            print("Installa shapely per usare questa funzione!")
-            return False
-
     # --- Migrazione  ---
     def migrate_password_field(self):
         """
@@ -288,4 +879,93 @@ class PetTrackerDB:
             except Exception as e:
                 print(f"Errore migrazione user {d['_id']}: {e}")
         print(f"Migrate: rinominati {count} documenti 'password' -> 'password_hash'")
-        return count
\ No newline at end of file
+        return count
+
+    def migrate_env_keys(self):
+        """
+        Riscrive le chiavi di envdata nella forma canonica: MAC senza ":" o minuscoli -> AA:BB:CC:DD:EE:FF,
+        pet_id di pet con collare -> MAC del collare. Idempotente: può essere rilanciata senza effetti.
+        Ritorna {collezione: {vecchia_chiave: (nuova_chiave, documenti_aggiornati)}}.
+        """
+        pet_macs = {
+            str(p["_id"]): canonical_env_key(p["mac_address"])
+            for p in self.pets.find({"mac_address": {"$nin": [None, ""]}}, {"mac_address": 1})
+        }
+        names = ["envdata"]
+        existing = set(self.db.list_collection_names())
+        if TIMESERIES_COLLECTIONS["envdata"] in existing:
+            names.append(TIMESERIES_COLLECTIONS["envdata"])
+
+        report = {}
+        for name in names:
+            coll = self.db[name]
+            changes = {}
+            for key in coll.distinct("pet_id"):
+                new_key = pet_macs.get(str(key)) or canonical_env_key(key)
+                if new_key == key:
+                    continue
+                # solo il metaField: aggiornamento ammesso anche sulle collezioni time-series
+                res = coll.update_many({"pet_id": key}, {"$set": {"pet_id": new_key}})
+                changes[key] = (new_key, res.modified_count)
+                print(f"[MIGRAZIONE] {name}: {key!r} -> {new_key!r} ({res.modified_count} documenti)")
+            report[name] = changes
+        return report
+
+    def migrate_to_timeseries(self, batch_size=5000):
+        """
+        Copia positions ed envdata nelle collezioni time-series (positions_ts, envdata_ts) a blocchi
+        ordinati per _id. Il punto di ripresa è salvato in 'migrations', quindi il comando può essere
+        interrotto e rilanciato: riparte dall'ultimo blocco completato.
+        Per il passaggio definitivo: fermare l'app, rilanciare la migrazione (copia la coda) e
+        avviare con MONGODB_TIMESERIES=1.
+        """
+        totals = {}
+        for src_name, dst_name in TIMESERIES_COLLECTIONS.items():
+            self._ensure_timeseries_collection(dst_name)
+            totals[src_name] = self._copy_to_timeseries(src_name, dst_name, batch_size)
+        return totals
+
+    def _copy_to_timeseries(self, src_name, dst_name, batch_size):
+        src = self.db[src_name]
+        dst = self.db[dst_name]
+        state_id = f"timeseries:{src_name}"
+        state = self.db.migrations.find_one({"_id": state_id}) or {}
+        last_id = state.get("last_id")
+
+        # blocco interrotto a metà: rimuovi le copie parziali prima di ripartire
+        inflight = state.get("inflight_last_id")
+        if inflight is not None:
+            range_q = {"$lte": inflight}
+            if last_id is not None:
+                range_q["$gt"] = last_id
+            dst.delete_many({"_id": range_q})
+
+        copied = state.get("copied", 0)
+        skipped = state.get("skipped", 0)
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            batch = list(src.find(query).sort("_id", ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            docs = []
+            for d in batch:
+                ts = normalize_timestamp(d.get("timestamp"))
+                if ts is None:
+                    skipped += 1  # il timeField è obbligatorio nelle collezioni time-series
+                    continue
+                d["timestamp"] = ts
+                docs.append(d)
+
+            self.db.migrations.update_one(
+                {"_id": state_id}, {"$set": {"inflight_last_id": batch[-1]["_id"]}}, upsert=True
+            )
+            if docs:
+                dst.insert_many(docs, ordered=False)
+            copied += len(docs)
+            last_id = batch[-1]["_id"]
+            self.db.migrations.update_one(
+                {"_id": state_id},
+                {"$set": {"last_id": last_id, "inflight_last_id": None, "copied": copied, "skipped": skipped}}
+            )
+            print(f"[MIGRAZIONE] {src_name} -> {dst_name}: {copied} copiati, {skipped} scartati")
+        return copied
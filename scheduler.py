@@ -0,0 +1,67 @@
+import heapq
+import threading
+import time
+
+
+class KeyedScheduler:
+    """
+    Un solo thread che esegue callback(chiave) alla scadenza di ciascuna chiave. Riprogrammare una chiave
+    già in attesa ne sposta solo la scadenza (debounce): nessun thread o timer per evento, e l'heap
+    contiene al più una voce per chiave.
+    """
+
+    def __init__(self, callback, name="scheduler"):
+        self.callback = callback
+        self.name = name
+        self._cond = threading.Condition()
+        self._heap = []   # (scadenza, chiave), può precedere la scadenza reale
+        self._due = {}    # chiave -> scadenza reale
+        self._thread = None
+
+    def schedule(self, key, delay):
+        due = time.monotonic() + delay
+        with self._cond:
+            if key not in self._due:
+                heapq.heappush(self._heap, (due, key))
+                self._cond.notify()
+            self._due[key] = due
+            self._ensure_thread()
+
+    def cancel(self, key):
+        with self._cond:
+            self._due.pop(key, None)
+
+    def pending(self):
+        with self._cond:
+            return len(self._due)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, key = self._heap[0]
+                    now = time.monotonic()
+                    if due > now:
+                        self._cond.wait(due - now)
+                        continue
+                    heapq.heappop(self._heap)
+                    real_due = self._due.get(key)
+                    if real_due is None:
+                        continue  # annullata
+                    if real_due > now:
+                        heapq.heappush(self._heap, (real_due, key))  # rinviata nel frattempo
+                        continue
+                    del self._due[key]
+                    break
+            try:
+                self.callback(key)
+            except Exception as e:
+                print(f"[{self.name.upper()}] Errore callback per {key}: {e}")
@@ -0,0 +1,1044 @@
+import atexit
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from heapq import merge
+from operator import attrgetter
+from zoneinfo import ZoneInfo
+
+import bcrypt
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from pymongo.errors import DuplicateKeyError
+
+from storage import ENV_FIELDS, StorageBackend, canonical_env_key, segment_as_position
+from timeline import PositionRecord, normalize_timestamp
+
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "pettracker.db")
+SQLITE_BATCH_SIZE = int(os.getenv("SQLITE_BATCH_SIZE", "200"))          # righe di telemetria per transazione
+SQLITE_FLUSH_SEC = float(os.getenv("SQLITE_FLUSH_SEC", "0.2"))          # attesa massima prima del commit
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "16"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "64"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_US = timedelta(microseconds=1)
+_CODEC = CodecOptions(tz_aware=True)
+
+# campi delle posizioni con una colonna propria; gli altri finiscono in `extra` (BSON)
+POSITION_COLUMNS = ("source", "entry_type", "room", "lat", "lon", "rssi", "pet_mac", "pet_name")
+SEGMENT_COLUMNS = ("state", "source", "entry_type", "room", "count", "rssi_min", "rssi_max")
+ENV_METRICS = ("temp", "hum")
+
+# le colonne numeriche delle letture (coordinate, rssi, temperatura, soglie) non hanno tipo dichiarato: con
+# affinità REAL un intero tornerebbe float (-60 -> -60.0), con NUMERIC un float intero tornerebbe int;
+# senza tipo il valore resta quello salvato, come in Mongo
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password_hash BLOB,
+    is_active INTEGER,
+    created_at INTEGER,
+    last_login INTEGER
+);
+CREATE TABLE IF NOT EXISTS pets (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    owner_id TEXT,
+    mac_address TEXT UNIQUE,
+    bt_name TEXT,
+    temp_min,
+    temp_max,
+    allowed_rooms BLOB,
+    created_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS pets_owner ON pets(owner_id);
+CREATE INDEX IF NOT EXISTS pets_bt_name ON pets(bt_name);
+CREATE TABLE IF NOT EXISTS rooms (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    mac_address TEXT,
+    allowed INTEGER
+);
+CREATE INDEX IF NOT EXISTS rooms_name ON rooms(name);
+CREATE INDEX IF NOT EXISTS rooms_mac ON rooms(mac_address);
+CREATE TABLE IF NOT EXISTS perimeters (
+    key TEXT PRIMARY KEY,
+    center_lat,
+    center_lon,
+    radius
+);
+CREATE TABLE IF NOT EXISTS positions (
+    id TEXT PRIMARY KEY,
+    pet_id TEXT,
+    ts INTEGER NOT NULL,
+    source TEXT,
+    entry_type TEXT,
+    room TEXT,
+    lat,
+    lon,
+    rssi,
+    pet_mac TEXT,
+    pet_name TEXT,
+    extra BLOB
+);
+-- indici coprenti: storico e timeline leggono solo dall'indice, senza passare dalla tabella
+CREATE INDEX IF NOT EXISTS positions_pet_ts ON positions(pet_id, ts, id, source, entry_type, room);
+CREATE INDEX IF NOT EXISTS positions_pet_source_ts ON positions(pet_id, source, ts, room, lat, lon);
+CREATE TABLE IF NOT EXISTS position_segments (
+    id TEXT PRIMARY KEY,
+    pet_id TEXT,
+    start INTEGER NOT NULL,
+    "end" INTEGER NOT NULL,
+    state TEXT,
+    source TEXT,
+    entry_type TEXT,
+    room TEXT,
+    count INTEGER,
+    rssi_min,
+    rssi_max
+);
+CREATE INDEX IF NOT EXISTS segments_pet_start ON position_segments(pet_id, start, id);
+CREATE TABLE IF NOT EXISTS envdata (
+    id TEXT PRIMARY KEY,
+    pet_id TEXT,
+    ts INTEGER NOT NULL,
+    temp,
+    hum
+);
+CREATE INDEX IF NOT EXISTS envdata_pet_ts ON envdata(pet_id, ts, id, temp, hum);
+CREATE TABLE IF NOT EXISTS alert_rules (
+    id TEXT PRIMARY KEY,
+    pet_id TEXT,
+    doc BLOB
+);
+CREATE INDEX IF NOT EXISTS alert_rules_pet ON alert_rules(pet_id);
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id TEXT PRIMARY KEY,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    key TEXT,
+    text TEXT,
+    chat_ids BLOB,
+    status TEXT,
+    attempts INTEGER,
+    created_at INTEGER,
+    available_at INTEGER,
+    claim TEXT,
+    delivered_at INTEGER,
+    failed_chats BLOB
+);
+CREATE INDEX IF NOT EXISTS outbox_status_available ON notification_outbox(status, available_at);
+CREATE INDEX IF NOT EXISTS outbox_claim ON notification_outbox(claim);
+CREATE TABLE IF NOT EXISTS timeline_days (
+    pet_id TEXT,
+    date TEXT,
+    version INTEGER,
+    summary BLOB,
+    computed_at INTEGER,
+    PRIMARY KEY (pet_id, date, version)
+);
+CREATE TABLE IF NOT EXISTS heatmap_days (
+    pet_id TEXT,
+    date TEXT,
+    precision INTEGER,
+    cells BLOB,
+    computed_at INTEGER,
+    PRIMARY KEY (pet_id, date, precision)
+);
+"""
+
+
+def to_us(ts):
+    """datetime (aware, naive UTC o stringa ISO) -> microsecondi dall'epoca UTC."""
+    return (normalize_timestamp(ts) - _EPOCH) // _US
+
+
+def from_us(value):
+    return _EPOCH + timedelta(microseconds=value) if value is not None else None
+
+
+def _pack(value):
+    return bson.encode({"v": value}) if value is not None else None
+
+
+def _unpack(blob):
+    return bson.decode(blob, codec_options=_CODEC)["v"] if blob is not None else None
+
+
+def _bindable(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+def _chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _now_us():
+    return to_us(datetime.now(timezone.utc))
+
+
+class SQLiteDB(StorageBackend):
+    """
+    Livello dati su SQLite per le installazioni su un solo dispositivo (es. Raspberry accanto alle ancore),
+    senza un server Mongo: PETTRACKER_DB_BACKEND=sqlite, file in SQLITE_DB_PATH.
+
+    Il database è in modalità WAL: le letture (una connessione per thread) non si bloccano durante le
+    scritture, che passano da un'unica connessione. La telemetria (posizioni, letture ambientali) viene
+    accumulata e scritta a lotti con executemany in una sola transazione, ogni SQLITE_BATCH_SIZE righe o
+    SQLITE_FLUSH_SEC secondi; le letture dello storico scrivono prima i lotti in sospeso. Le query hanno
+    testo costante, così sqlite3 riusa gli statement preparati. Timestamp in microsecondi UTC (INTEGER),
+    restituiti come datetime UTC aware; documenti annidati in BSON.
+    """
+
+    def __init__(self, path=None, read_cache=None, batch_size=SQLITE_BATCH_SIZE, flush_sec=SQLITE_FLUSH_SEC):
+        super().__init__(read_cache)
+        self.path = path or SQLITE_DB_PATH
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._buffer_lock = threading.Lock()
+        self._pending_positions = []
+        self._pending_env = []
+        self._unflushed = 0
+        self._flush_wake = threading.Event()
+        self._flusher = None
+        try:
+            self._writer = self._connect()
+            mode = self._writer.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            self._writer.executescript(SCHEMA)
+            print(f"✅ Database SQLite pronto ({self.path}, journal {mode})")
+        except Exception as e:
+            print(f"❌ Apertura database SQLite fallita: {e}")
+            raise
+        atexit.register(self.flush)
+
+    # --- connessioni ---
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous=NORMAL")   # in WAL: durevole al checkpoint, nessun fsync per commit
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    @property
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Transazione di scrittura (BEGIN IMMEDIATE) sulla connessione condivisa."""
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        return self._reader.execute(sql, params).fetchall()
+
+    def _query_one(self, sql, params=()):
+        return self._reader.execute(sql, params).fetchone()
+
+    # --- scritture a lotti della telemetria ---
+    def _buffer(self, pending, row):
+        with self._buffer_lock:
+            pending.append(row)
+            self._unflushed += 1
+            full = self._unflushed >= self.batch_size
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="sqlite-flush", daemon=True)
+                self._flusher.start()
+        if full:
+            self.flush()
+        else:
+            self._flush_wake.set()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_wake.wait()
+            self._flush_wake.clear()
+            time.sleep(self.flush_sec)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[SQLITE] Errore scrittura lotto telemetria: {e}")
+
+    def flush(self):
+        """Scrive in una transazione la telemetria accumulata."""
+        with self._write_lock:
+            with self._buffer_lock:
+                positions, self._pending_positions = self._pending_positions, []
+                env, self._pending_env = self._pending_env, []
+            if not positions and not env:
+                return
+            try:
+                with self._write() as conn:
+                    if positions:
+                        conn.executemany(
+                            "INSERT OR IGNORE INTO positions (id, pet_id, ts, source, entry_type, room, lat, lon, rssi, "
+                            "pet_mac, pet_name, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", positions)
+                    if env:
+                        conn.executemany(
+                            "INSERT OR IGNORE INTO envdata (id, pet_id, ts, temp, hum) VALUES (?, ?, ?, ?, ?)", env)
+            except Exception:
+                with self._buffer_lock:
+                    # riprova al prossimo giro, nello stesso ordine
+                    self._pending_positions[:0] = positions
+                    self._pending_env[:0] = env
+                raise
+            with self._buffer_lock:
+                self._unflushed -= len(positions) + len(env)
+
+    def _sync(self):
+        # le letture della telemetria vedono anche le righe ancora nel lotto in corso
+        if self._unflushed:
+            self.flush()
+
+    # --- UTENTI ---
+    @staticmethod
+    def _user_doc(row, include_hash=True):
+        if row is None:
+            return None
+        doc = {"_id": ObjectId(row["id"]), "username": row["username"]}
+        if include_hash and row["password_hash"] is not None:
+            doc["password_hash"] = row["password_hash"]
+        if row["is_active"] is not None:
+            doc["is_active"] = bool(row["is_active"])
+        if row["created_at"] is not None:
+            doc["created_at"] = from_us(row["created_at"])
+        if row["last_login"] is not None:
+            doc["last_login"] = from_us(row["last_login"])
+        return doc
+
+    def create_user(self, username, password):
+        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
+        return self.insert_user({
+            "username": username,
+            "password_hash": password_hash,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    def get_user_by_username(self, username):
+        return self.get_user(username)
+
+    def get_user_by_id(self, user_id):
+        oid = self._ensure_oid(user_id)
+        return self._user_doc(self._query_one("SELECT * FROM users WHERE id = ?", (str(oid),)))
+
+    def get_user(self, username, active_only=False, include_hash=True):
+        if active_only:
+            row = self._query_one("SELECT * FROM users WHERE username = ? AND is_active = 1", (username,))
+        else:
+            row = self._query_one("SELECT * FROM users WHERE username = ?", (username,))
+        return self._user_doc(row, include_hash)
+
+    def count_users(self):
+        return self._query_one("SELECT COUNT(*) FROM users")[0]
+
+    @staticmethod
+    def _user_values(fields):
+        values = {}
+        for k, v in fields.items():
+            if k in ("created_at", "last_login"):
+                v = to_us(v) if v is not None else None
+            elif k == "is_active":
+                v = int(bool(v)) if v is not None else None
+            elif k == "password_hash":
+                v = v.encode("utf-8") if isinstance(v, str) else v
+            elif k != "username":
+                raise ValueError(f"campo utente non previsto: {k}")
+            values[k] = v
+        return values
+
+    def insert_user(self, doc):
+        user_id = doc.get("_id") or ObjectId()
+        values = self._user_values({k: v for k, v in doc.items() if k != "_id"})
+        try:
+            with self._write() as conn:
+                conn.execute(
+                    f"INSERT INTO users (id, {', '.join(values)}) VALUES (?{', ?' * len(values)})",
+                    (str(user_id), *values.values())
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+        self.invalidate_cache(("user", doc.get("username")))
+        return user_id
+
+    def update_user(self, user_id, fields):
+        values = self._user_values(fields)
+        if not values:
+            return
+        assignments = ", ".join(f"{k} = ?" for k in values)
+        user_id = str(self._ensure_oid(user_id))
+        try:
+            with self._write() as conn:
+                # vecchio username letto nella stessa transazione: serve per invalidare la cache dopo un rinomino
+                row = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+                conn.execute(f"UPDATE users SET {assignments} WHERE id = ?", (*values.values(), user_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+        if row is not None:
+            self.invalidate_cache(("user", row[0]), ("user", fields.get("username")))
+
+    def delete_user(self, username):
+        with self._write() as conn:
+            deleted = conn.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount == 1
+        self.invalidate_cache(("user", username))
+        return deleted
+
+    # --- PETS ---
+    @staticmethod
+    def _pet_doc(row):
+        if row is None:
+            return None
+        doc = {"_id": ObjectId(row["id"]), "name": row["name"], "owner_id": row["owner_id"]}
+        for k in ("mac_address", "bt_name", "temp_min", "temp_max"):
+            if row[k] is not None:
+                doc[k] = row[k]
+        if row["allowed_rooms"] is not None:
+            doc["allowed_rooms"] = _unpack(row["allowed_rooms"])
+        if row["created_at"] is not None:
+            doc["created_at"] = from_us(row["created_at"])
+        return doc
+
+    def add_pet(self, name, owner_id, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        pet_id = ObjectId()
+        try:
+            with self._write() as conn:
+                conn.execute(
+                    "INSERT INTO pets (id, name, owner_id, mac_address, bt_name, temp_min, temp_max, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(pet_id), name, str(owner_id), mac_address or None, bt_name or None,
+                     temp_min, temp_max, _now_us())
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+        return pet_id
+
+    def get_registered_macs(self):
+        return [r[0] for r in self._query("SELECT mac_address FROM pets WHERE mac_address IS NOT NULL AND mac_address != ''")]
+
+    def get_pets_for_user(self, user_id):
+        return [self._pet_doc(r) for r in self._query("SELECT * FROM pets WHERE owner_id = ?", (str(user_id),))]
+
+    def get_pet_by_id(self, pet_id):
+        oid = self._ensure_oid(pet_id)
+        return self.cached(("pet", str(oid)),
+                           lambda: self._pet_doc(self._query_one("SELECT * FROM pets WHERE id = ?", (str(oid),))))
+
+    def get_pets_by_ids(self, pet_ids):
+        ids = []
+        for pet_id in pet_ids:
+            try:
+                ids.append(str(self._ensure_oid(pet_id)))
+            except Exception:
+                continue
+        out = {}
+        for chunk in _chunks(ids):
+            rows = self._query(f"SELECT * FROM pets WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            out.update((r["id"], self._pet_doc(r)) for r in rows)
+        return out
+
+    def get_pet_by_mac(self, mac_address, owner_id=None):
+        if owner_id is not None:
+            row = self._query_one("SELECT * FROM pets WHERE mac_address = ? AND owner_id = ?",
+                                  (mac_address, str(owner_id)))
+        else:
+            row = self._query_one("SELECT * FROM pets WHERE mac_address = ?", (mac_address,))
+        return self._pet_doc(row)
+
+    def get_pet_by_bt_name(self, bt_name, ignore_case=False):
+        if ignore_case:
+            # COLLATE NOCASE confronta solo ASCII, come basta per i nomi BLE
+            row = self._query_one("SELECT * FROM pets WHERE bt_name = ? COLLATE NOCASE ORDER BY rowid LIMIT 1",
+                                  (bt_name,))
+        else:
+            row = self._query_one("SELECT * FROM pets WHERE bt_name = ? ORDER BY rowid LIMIT 1", (bt_name,))
+        return self._pet_doc(row)
+
+    def update_pet(self, pet_id, name=None, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        update_fields = {}
+        if name is not None:
+            update_fields["name"] = name
+        if mac_address is not None:
+            update_fields["mac_address"] = mac_address
+        if bt_name is not None:
+            update_fields["bt_name"] = bt_name
+        if temp_min is not None:
+            update_fields["temp_min"] = temp_min
+        if temp_max is not None:
+            update_fields["temp_max"] = temp_max
+        if update_fields:
+            oid = self._ensure_oid(pet_id)
+            assignments = ", ".join(f"{k} = ?" for k in update_fields)
+            try:
+                with self._write() as conn:
+                    conn.execute(f"UPDATE pets SET {assignments} WHERE id = ?", (*update_fields.values(), str(oid)))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+            self.invalidate_cache(("pet", str(oid)))
+
+    def delete_pet(self, pet_id):
+        oid = self._ensure_oid(pet_id)
+        with self._write() as conn:
+            conn.execute("DELETE FROM pets WHERE id = ?", (str(oid),))
+        self.invalidate_cache(("pet", str(oid)))
+
+    def set_pet_allowed_rooms(self, pet_id, room_ids):
+        oid = self._ensure_oid(pet_id)
+        with self._write() as conn:
+            conn.execute("UPDATE pets SET allowed_rooms = ? WHERE id = ?",
+                         (_pack([str(r) for r in room_ids]), str(oid)))
+        self.invalidate_cache(("pet", str(oid)))
+
+    # --- ROOMS ---
+    @staticmethod
+    def _room_doc(row):
+        if row is None:
+            return None
+        return {"_id": ObjectId(row["id"]), "name": row["name"], "mac_address": row["mac_address"],
+                "allowed": bool(row["allowed"]) if row["allowed"] is not None else None}
+
+    def get_rooms(self):
+        return self.cached(("rooms",), lambda: [self._room_doc(r) for r in self._query("SELECT * FROM rooms ORDER BY rowid")])
+
+    def add_room(self, name, mac_address, allowed):
+        room_id = ObjectId()
+        with self._write() as conn:
+            conn.execute("INSERT INTO rooms (id, name, mac_address, allowed) VALUES (?, ?, ?, ?)",
+                         (str(room_id), name, mac_address, int(bool(allowed))))
+        self.invalidate_cache(("rooms",))
+        return room_id
+
+    def get_room_by_id(self, room_id):
+        oid = self._ensure_oid(room_id)
+        return self.cached(("room", str(oid)),
+                           lambda: self._room_doc(self._query_one("SELECT * FROM rooms WHERE id = ?", (str(oid),))))
+
+    def get_room_by_name(self, name):
+        return self._room_doc(self._query_one("SELECT * FROM rooms WHERE name = ? ORDER BY rowid LIMIT 1", (name,)))
+
+    def get_room_by_mac(self, mac_address):
+        return self._room_doc(self._query_one("SELECT * FROM rooms WHERE mac_address = ? ORDER BY rowid LIMIT 1",
+                                              (mac_address,)))
+
+    def update_room(self, room_id, name, mac_address, allowed):
+        oid = self._ensure_oid(room_id)
+        with self._write() as conn:
+            conn.execute("UPDATE rooms SET name = ?, mac_address = ?, allowed = ? WHERE id = ?",
+                         (name, mac_address, int(bool(allowed)), str(oid)))
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    def delete_room(self, room_id):
+        oid = self._ensure_oid(room_id)
+        with self._write() as conn:
+            conn.execute("DELETE FROM rooms WHERE id = ?", (str(oid),))
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    def update_room_access(self, room_id, allowed):
+        oid = self._ensure_oid(room_id)
+        with self._write() as conn:
+            conn.execute("UPDATE rooms SET allowed = ? WHERE id = ?", (int(bool(allowed)), str(oid)))
+        self.invalidate_cache(("rooms",), ("room", str(oid)))
+
+    # --- PERIMETRO ---
+    def _global_perimeter(self):
+        def load():
+            row = self._query_one("SELECT * FROM perimeters WHERE key = 'global'")
+            if row is None:
+                return None
+            return {"key": "global", "center": [row["center_lat"], row["center_lon"]], "radius": row["radius"]}
+        return self.cached(("perimeter",), load)
+
+    def save_perimeter(self, center, radius):
+        lat, lon = center
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO perimeters (key, center_lat, center_lon, radius) VALUES ('global', ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET center_lat = excluded.center_lat, "
+                "center_lon = excluded.center_lon, radius = excluded.radius",
+                (lat, lon, radius)
+            )
+        self.invalidate_cache(("perimeter",))
+
+    # --- REGOLE D'ALLARME ---
+    @staticmethod
+    def _rule_doc(row):
+        if row is None:
+            return None
+        doc = _unpack(row["doc"])
+        doc["_id"] = ObjectId(row["id"])
+        return doc
+
+    def get_alert_rules(self, pet_id):
+        return [self._rule_doc(r) for r in self._query("SELECT * FROM alert_rules WHERE pet_id = ? ORDER BY rowid",
+                                                       (str(pet_id),))]
+
+    def list_alert_rules(self):
+        return [self._rule_doc(r) for r in self._query("SELECT * FROM alert_rules ORDER BY pet_id, rowid")]
+
+    def add_alert_rule(self, rule):
+        rule = dict(rule)
+        rule_id = rule.pop("_id", None) or ObjectId()
+        with self._write() as conn:
+            conn.execute("INSERT INTO alert_rules (id, pet_id, doc) VALUES (?, ?, ?)",
+                         (str(rule_id), str(rule.get("pet_id")), _pack(rule)))
+        return rule_id
+
+    def delete_alert_rule(self, rule_id):
+        oid = self._ensure_oid(rule_id)
+        with self._write() as conn:
+            row = conn.execute("SELECT * FROM alert_rules WHERE id = ?", (str(oid),)).fetchone()
+            conn.execute("DELETE FROM alert_rules WHERE id = ?", (str(oid),))
+        return self._rule_doc(row)
+
+    # --- OUTBOX NOTIFICHE ---
+    @staticmethod
+    def _outbox_doc(row):
+        doc = {
+            "_id": ObjectId(row["id"]),
+            "dedupe_key": row["dedupe_key"],
+            "key": row["key"],
+            "text": row["text"],
+            "chat_ids": _unpack(row["chat_ids"]),
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "created_at": from_us(row["created_at"]),
+            "available_at": from_us(row["available_at"]),
+        }
+        if row["claim"] is not None:
+            doc["claim"] = row["claim"]
+        if row["delivered_at"] is not None:
+            doc["delivered_at"] = from_us(row["delivered_at"])
+        if row["failed_chats"] is not None:
+            doc["failed_chats"] = _unpack(row["failed_chats"])
+        return doc
+
+    def enqueue_notification(self, dedupe_key, text, chat_ids=None, key=None):
+        now = _now_us()
+        chats = [str(c) for c in chat_ids] if chat_ids is not None else None
+        with self._write() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO notification_outbox (id, dedupe_key, key, text, chat_ids, status, attempts, "
+                "created_at, available_at) VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?)",
+                (str(ObjectId()), dedupe_key, key, text, _pack(chats), now, now)
+            )
+        return cur.rowcount == 1
+
+    def claim_notifications(self, worker_id, limit=50, lease_sec=300, exclude=()):
+        now = _now_us()
+        token = f"{worker_id}:{ObjectId()}"
+        exclude = [str(i) for i in exclude]
+        with self._write() as conn:
+            # BEGIN IMMEDIATE: selezione e aggiornamento sono atomici anche tra processi
+            conn.execute(
+                "UPDATE notification_outbox SET status = 'claimed', claim = ?, available_at = ?, "
+                "attempts = attempts + 1 WHERE id IN (SELECT id FROM notification_outbox "
+                "WHERE status IN ('pending', 'claimed') AND available_at <= ? "
+                f"AND id NOT IN ({', '.join('?' * len(exclude))}) ORDER BY available_at LIMIT ?)",
+                (token, now + int(lease_sec * 1_000_000), now, *exclude, limit)
+            )
+            rows = conn.execute("SELECT * FROM notification_outbox WHERE claim = ? ORDER BY created_at",
+                                (token,)).fetchall()
+        return [self._outbox_doc(r) for r in rows]
+
+    def renew_notification_leases(self, worker_id, ids, lease_sec=300):
+        lease_until = _now_us() + int(lease_sec * 1_000_000)
+        prefix = f"{worker_id}:"
+        n = 0
+        with self._write() as conn:
+            for chunk in _chunks(str(i) for i in ids):
+                sql = ("UPDATE notification_outbox SET available_at = ? WHERE status = 'claimed' "
+                       f"AND substr(claim, 1, ?) = ? AND id IN ({', '.join('?' * len(chunk))})")
+                n += conn.execute(sql, (lease_until, len(prefix), prefix, *chunk)).rowcount
+        return n
+
+    def mark_notifications_delivered(self, ids, failed_chats=None):
+        failed = _pack(sorted(failed_chats)) if failed_chats else None
+        n = 0
+        with self._write() as conn:
+            for chunk in _chunks(str(i) for i in ids):
+                sql = ("UPDATE notification_outbox SET status = 'delivered', delivered_at = ?, claim = NULL, "
+                       f"failed_chats = COALESCE(?, failed_chats) WHERE id IN ({', '.join('?' * len(chunk))})")
+                n += conn.execute(sql, (_now_us(), failed, *chunk)).rowcount
+        return n
+
+    def release_notifications(self, ids, retry_in_sec=0):
+        available = _now_us() + int(retry_in_sec * 1_000_000)
+        n = 0
+        with self._write() as conn:
+            for chunk in _chunks(str(i) for i in ids):
+                sql = ("UPDATE notification_outbox SET status = 'pending', available_at = ?, claim = NULL "
+                       f"WHERE status = 'claimed' AND id IN ({', '.join('?' * len(chunk))})")
+                n += conn.execute(sql, (available, *chunk)).rowcount
+        return n
+
+    # --- POSIZIONI ---
+    @staticmethod
+    def _position_row(record):
+        extra = {}
+        values = []
+        for col in POSITION_COLUMNS:
+            value = record.get(col)
+            if not _bindable(value):
+                extra[col] = value
+                value = None
+            values.append(value)
+        known = {"_id", "pet_id", "timestamp", *POSITION_COLUMNS}
+        extra.update((k, v) for k, v in record.items() if k not in known)
+        pet_id = record.get("pet_id")
+        return (str(record.get("_id") or ObjectId()), pet_id, to_us(record["timestamp"]), *values,
+                _pack(extra) if extra else None)
+
+    @staticmethod
+    def _position_columns(fields):
+        """Colonne da leggere per i campi richiesti (None = tutte)."""
+        if not fields:
+            return "*"
+        cols = ["id", "ts"] + [f for f in fields if f in POSITION_COLUMNS or f == "pet_id"]
+        if any(f not in POSITION_COLUMNS and f not in ("timestamp", "pet_id", "_id") for f in fields):
+            cols.append("extra")
+        return ", ".join(dict.fromkeys(cols))
+
+    @staticmethod
+    def _position_doc(row, fields=None, with_id=True):
+        keys = row.keys()
+        doc = {}
+        if with_id:
+            doc["_id"] = ObjectId(row["id"])
+        if "pet_id" in keys:
+            doc["pet_id"] = row["pet_id"]
+        doc["timestamp"] = from_us(row["ts"])
+        for col in POSITION_COLUMNS:
+            if col in keys and row[col] is not None:
+                doc[col] = row[col]
+        if "extra" in keys and row["extra"] is not None:
+            doc.update(_unpack(row["extra"]))
+        if fields:
+            keep = set(fields) | {"timestamp", "_id"}
+            doc = {k: v for k, v in doc.items() if k in keep}
+        return doc
+
+    @staticmethod
+    def _segment_doc(row):
+        doc = {"_id": row["id"], "pet_id": row["pet_id"], "start": from_us(row["start"]), "end": from_us(row["end"])}
+        for col in SEGMENT_COLUMNS:
+            doc[col] = row[col]
+        return doc
+
+    def save_pet_position(self, pet_id, lat, lon, timestamp=None):
+        self._buffer(self._pending_positions, self._position_row({
+            "pet_id": str(pet_id),
+            "lat": lat,
+            "lon": lon,
+            "timestamp": timestamp or datetime.now(timezone.utc),
+        }))
+
+    def save_position(self, pet_id, entry_type, timestamp=None, **kwargs):
+        record = {
+            "pet_id": str(pet_id) if pet_id is not None else None,
+            "entry_type": entry_type,
+            "timestamp": timestamp or datetime.now(timezone.utc),
+        }
+        record.update(kwargs)
+        try:
+            self._buffer(self._pending_positions, self._position_row(record))
+        except Exception as e:
+            print("ERRORE SALVATAGGIO:", e)
+
+    def get_last_position(self, pet_id):
+        self._sync()
+        row = self._query_one("SELECT * FROM positions WHERE pet_id = ? ORDER BY ts DESC, id DESC LIMIT 1",
+                              (str(pet_id),))
+        return self._position_doc(row) if row is not None else None
+
+    def latest_positions(self, pet_ids, sources=("ble", "gps")):
+        self._sync()
+        result = {}
+        for pet_id in (str(p) for p in pet_ids):
+            for source in sources:
+                # servita dall'indice coprente (pet_id, source, ts, room, lat, lon)
+                row = self._query_one(
+                    "SELECT ts, room, lat, lon FROM positions WHERE pet_id = ? AND source = ? ORDER BY ts DESC LIMIT 1",
+                    (pet_id, source)
+                )
+                if row is not None:
+                    result.setdefault(pet_id, {})[source] = {
+                        "timestamp": from_us(row["ts"]), "room": row["room"], "lat": row["lat"], "lon": row["lon"]
+                    }
+        return result
+
+    def get_positions(self, pet_id, limit=50, fields=None):
+        self._sync()
+        rows = self._query(
+            f"SELECT {self._position_columns(fields)} FROM positions WHERE pet_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+            (str(pet_id), limit)
+        )
+        return [self._position_doc(r, fields) for r in rows]
+
+    def _iter_rows(self, sql, params, batch_size):
+        cursor = self._reader.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def _segment_rows(self, pet_id, start, end, batch_size=1000):
+        return self._iter_rows(
+            "SELECT * FROM position_segments WHERE pet_id = ? AND start BETWEEN ? AND ? ORDER BY start, id",
+            (str(pet_id), to_us(start), to_us(end)), batch_size
+        )
+
+    def iter_positions(self, pet_id, start, end, fields=None, batch_size=1000):
+        self._sync()
+        raw = self._iter_rows(
+            f"SELECT {self._position_columns(fields)} FROM positions WHERE pet_id = ? AND ts BETWEEN ? AND ? ORDER BY ts, id",
+            (str(pet_id), to_us(start), to_us(end)), batch_size
+        )
+        return merge((self._position_doc(r, fields, with_id=False) for r in raw),
+                     (segment_as_position(self._segment_doc(r), fields) for r in self._segment_rows(pet_id, start, end)),
+                     key=lambda p: p["timestamp"])
+
+    def iter_position_records(self, pet_id, start, end, batch_size=1000):
+        self._sync()
+        # solo colonne dell'indice positions_pet_ts: nessun accesso alla tabella
+        raw = self._iter_rows(
+            "SELECT ts, source, entry_type, room FROM positions WHERE pet_id = ? AND ts BETWEEN ? AND ? ORDER BY ts",
+            (str(pet_id), to_us(start), to_us(end)), batch_size
+        )
+        records = (PositionRecord(from_us(r[0]), r[1], r[2], r[3]) for r in raw)
+        segments = (PositionRecord(from_us(r["start"]), r["source"], r["entry_type"], r["room"],
+                                   from_us(r["end"]), r["count"] or 1)
+                    for r in self._segment_rows(pet_id, start, end))
+        return merge(records, segments, key=attrgetter("timestamp"))
+
+    def page_positions(self, pet_id, start, end, after=None, limit=500, fields=None):
+        self._sync()
+        pet_id, start_us, end_us = str(pet_id), to_us(start), to_us(end)
+        raw_q = ("SELECT {} FROM positions WHERE pet_id = ? AND ts BETWEEN ? AND ? {}"
+                 "ORDER BY ts, id LIMIT ?")
+        seg_q = ("SELECT * FROM position_segments WHERE pet_id = ? AND start BETWEEN ? AND ? {}"
+                 "ORDER BY start, id LIMIT ?")
+        raw_cond, raw_args, seg_cond, seg_args = "", (), "", ()
+        if after:
+            ts, rank, last_id = after
+            ts = to_us(ts)
+            if rank == 0:
+                raw_cond, raw_args = "AND (ts, id) > (?, ?) ", (ts, str(self._ensure_oid(last_id)))
+                seg_cond, seg_args = "AND start >= ? ", (ts,)
+            else:
+                raw_cond, raw_args = "AND ts > ? ", (ts,)
+                seg_cond, seg_args = "AND (start, id) > (?, ?) ", (ts, str(last_id))
+        raw = self._query(raw_q.format(self._position_columns(fields), raw_cond),
+                          (pet_id, start_us, end_us, *raw_args, limit))
+        segs = self._query(seg_q.format(seg_cond), (pet_id, start_us, end_us, *seg_args, limit))
+
+        def with_seg_id(row):
+            doc = segment_as_position(self._segment_doc(row), fields)
+            doc["_id"] = row["id"]
+            return doc
+
+        merged = merge(
+            ((0, self._position_doc(r, fields)) for r in raw),
+            ((1, with_seg_id(s)) for s in segs),
+            key=lambda item: (item[1]["timestamp"], item[0], str(item[1]["_id"]))
+        )
+        items = [item for _, item in zip(range(limit), merged)]
+        next_after = None
+        if len(items) == limit:
+            rank, doc = items[-1]
+            next_after = (doc["timestamp"], rank, str(doc["_id"]))
+        return items, next_after
+
+    # --- COMPATTAZIONE ---
+    def compaction_pet_ids(self, cutoff):
+        self._sync()
+        return [r[0] for r in self._query(
+            "SELECT DISTINCT pet_id FROM positions WHERE source = 'ble' AND ts < ?", (to_us(cutoff),))]
+
+    def iter_compactable_positions(self, pet_id, cutoff):
+        self._sync()
+        rows = self._iter_rows(
+            "SELECT id, ts, source, entry_type, room, rssi FROM positions WHERE pet_id = ? AND ts < ? ORDER BY ts, id",
+            (pet_id, to_us(cutoff)), 1000
+        )
+        return (self._position_doc(r) for r in rows)
+
+    def store_segments(self, segments):
+        rows = [(s["_id"], s["pet_id"], to_us(s["start"]), to_us(s["end"]), *[s.get(c) for c in SEGMENT_COLUMNS])
+                for s in segments]
+        with self._write() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO position_segments (id, pet_id, start, "end", state, source, entry_type, room, '
+                "count, rssi_min, rssi_max) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return True
+
+    def delete_positions(self, ids):
+        self._sync()
+        deleted = 0
+        with self._write() as conn:
+            for chunk in _chunks(str(i) for i in ids):
+                deleted += conn.execute(f"DELETE FROM positions WHERE id IN ({', '.join('?' * len(chunk))})",
+                                        chunk).rowcount
+        return deleted
+
+    # --- STORICO E SERIE AMBIENTALI ---
+    @staticmethod
+    def _env_doc(row, fields=None):
+        doc = {"_id": ObjectId(row["id"]), "pet_id": row["pet_id"], "timestamp": from_us(row["ts"]),
+               "temp": row["temp"], "hum": row["hum"]}
+        if fields:
+            keep = set(fields) | {"timestamp", "_id"}
+            doc = {k: v for k, v in doc.items() if k in keep}
+        return doc
+
+    def page_env(self, key, start, end, after=None, limit=500, fields=None):
+        self._sync()
+        after_key = (to_us(start), "")
+        if after:
+            ts, _, last_id = after
+            after_key = (to_us(ts), str(self._ensure_oid(last_id)))
+        rows = self._query(
+            "SELECT * FROM envdata WHERE pet_id = ? AND ts BETWEEN ? AND ? AND (ts, id) > (?, ?) ORDER BY ts, id LIMIT ?",
+            (key, to_us(start), to_us(end), *after_key, limit)
+        )
+        docs = [self._env_doc(r, fields or ENV_FIELDS) for r in rows]
+        next_after = None
+        if len(docs) == limit:
+            next_after = (docs[-1]["timestamp"], 0, str(docs[-1]["_id"]))
+        return [(0, d) for d in docs], next_after
+
+    def env_buckets(self, key, start, end, bucket_sec):
+        self._sync()
+        bucket_ms = int(bucket_sec * 1000)
+        rows = self._query(
+            "SELECT ts / 1000 - (ts / 1000) % ? AS bucket, MIN(temp), MAX(temp), AVG(temp), MIN(hum), MAX(hum), "
+            "AVG(hum), COUNT(*) FROM envdata WHERE pet_id = ? AND ts BETWEEN ? AND ? GROUP BY bucket ORDER BY bucket",
+            (bucket_ms, key, to_us(start), to_us(end))
+        )
+        names = ("_id", "temp_min", "temp_max", "temp_avg", "hum_min", "hum_max", "hum_avg", "n")
+        return [dict(zip(names, tuple(r))) for r in rows]
+
+    def iter_env_series(self, key, start, end, metric):
+        if metric not in ENV_METRICS:
+            raise ValueError(f"metrica non valida: {metric}")
+        self._sync()
+        params = (key, to_us(start), to_us(end))
+        n = self._query_one(f"SELECT COUNT(*) FROM envdata WHERE pet_id = ? AND ts BETWEEN ? AND ? AND {metric} IS NOT NULL",
+                            params)[0]
+        rows = self._iter_rows(
+            f"SELECT ts, {metric} FROM envdata WHERE pet_id = ? AND ts BETWEEN ? AND ? AND {metric} IS NOT NULL ORDER BY ts",
+            params, 5000
+        )
+        return n, ((r[0] / 1_000_000, r[1]) for r in rows)
+
+    # --- RIEPILOGHI TIMELINE E HEATMAP ---
+    def get_timeline_days(self, pet_id, dates, version):
+        out = {}
+        for chunk in _chunks(dates):
+            rows = self._query(
+                f"SELECT date, summary FROM timeline_days WHERE pet_id = ? AND version = ? "
+                f"AND date IN ({', '.join('?' * len(chunk))})",
+                (str(pet_id), version, *chunk)
+            )
+            out.update((r["date"], _unpack(r["summary"])) for r in rows)
+        return out
+
+    def save_timeline_day(self, pet_id, date, version, summary):
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO timeline_days (pet_id, date, version, summary, computed_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (str(pet_id), date, version, _pack(summary), _now_us()))
+
+    def delete_timeline_days(self, pet_id, dates=None):
+        with self._write() as conn:
+            if not dates:
+                conn.execute("DELETE FROM timeline_days WHERE pet_id = ?", (str(pet_id),))
+                return
+            for chunk in _chunks(dates):
+                conn.execute(f"DELETE FROM timeline_days WHERE pet_id = ? AND date IN ({', '.join('?' * len(chunk))})",
+                             (str(pet_id), *chunk))
+
+    def aggregate_gps_cells(self, pet_id, start, end, precision, tz_name):
+        self._sync()
+        scale = 10 ** precision
+        tz = ZoneInfo(tz_name)
+        # giorno locale calcolato qui: SQLite non conosce i fusi orari IANA
+        rows = self._iter_rows(
+            "SELECT ts, lat, lon FROM positions WHERE pet_id = ? AND ts >= ? AND ts < ? "
+            "AND typeof(lat) IN ('real', 'integer') AND typeof(lon) IN ('real', 'integer')",
+            (str(pet_id), to_us(start), to_us(end)), 5000
+        )
+        counts = {}
+        for ts, lat, lon in rows:
+            key = (from_us(ts).astimezone(tz).strftime("%Y-%m-%d"), math.floor(lat * scale), math.floor(lon * scale))
+            counts[key] = counts.get(key, 0) + 1
+        by_day = {}
+        for (day, y, x), n in counts.items():
+            by_day.setdefault(day, []).append([y, x, n])
+        return by_day
+
+    def get_heatmap_days(self, pet_id, dates, precision):
+        out = {}
+        for chunk in _chunks(dates):
+            rows = self._query(
+                f"SELECT date, cells FROM heatmap_days WHERE pet_id = ? AND precision = ? "
+                f"AND date IN ({', '.join('?' * len(chunk))})",
+                (str(pet_id), precision, *chunk)
+            )
+            out.update((r["date"], _unpack(r["cells"])) for r in rows)
+        return out
+
+    def save_heatmap_day(self, pet_id, date, precision, cells):
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO heatmap_days (pet_id, date, precision, cells, computed_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (str(pet_id), date, precision, _pack(cells), _now_us()))
+
+    def delete_heatmap_days(self, pet_id, dates=None):
+        with self._write() as conn:
+            if not dates:
+                conn.execute("DELETE FROM heatmap_days WHERE pet_id = ?", (str(pet_id),))
+                return
+            for chunk in _chunks(dates):
+                conn.execute(f"DELETE FROM heatmap_days WHERE pet_id = ? AND date IN ({', '.join('?' * len(chunk))})",
+                             (str(pet_id), *chunk))
+
+    # --- ENV DATA ---
+    def save_env_data(self, pet_id, temp, hum, timestamp):
+        self._buffer(self._pending_env, (
+            str(ObjectId()), canonical_env_key(pet_id), to_us(timestamp or datetime.now(timezone.utc)), temp, hum
+        ))
+
+    def get_latest_env(self, pet_id=None):
+        self._sync()
+        row = self._query_one("SELECT * FROM envdata WHERE pet_id = ? ORDER BY ts DESC, id DESC LIMIT 1",
+                              (canonical_env_key(pet_id),))
+        return self._env_doc(row) if row is not None else None
+
+    def latest_env_many(self, keys):
+        self._sync()
+        out = {}
+        for key in (str(k) for k in keys):
+            row = self._query_one("SELECT ts, temp, hum FROM envdata WHERE pet_id = ? ORDER BY ts DESC LIMIT 1", (key,))
+            if row is not None:
+                out[key] = {"temp": row["temp"], "hum": row["hum"], "timestamp": from_us(row["ts"])}
+        return out
@@ -0,0 +1,438 @@
+import copy
+import os
+from abc import ABC, abstractmethod
+
+from bson import ObjectId
+
+from lru import ReadThroughCache
+
+# Motore del livello dati: "mongo" (PetTrackerDB), "sqlite" (SQLiteDB, installazioni su un solo dispositivo)
+# oppure "memory" (MemoryDB, per benchmark e prove locali)
+DB_BACKEND = os.getenv("PETTRACKER_DB_BACKEND", "mongo")
+
+# Cache in memoria (opt-in) di pet, stanze, perimetro e utenti: letti a ogni pagina ed evento di ingest,
+# modificati di rado. Le scritture fatte tramite il backend/AuthManager la invalidano subito; il TTL copre
+# le modifiche fatte da altri processi.
+READ_CACHE_ENABLED = os.getenv("MONGODB_READ_CACHE", "0") == "1"
+READ_CACHE_TTL_SEC = float(os.getenv("MONGODB_READ_CACHE_TTL_SEC", "30"))
+READ_CACHE_SIZE = int(os.getenv("MONGODB_READ_CACHE_SIZE", "2048"))
+
+
+def canonical_env_key(key):
+    """
+    Chiave canonica di un dispositivo in envdata: MAC in formato AA:BB:CC:DD:EE:FF se la chiave è un MAC
+    (accetta minuscolo, senza ":" o con "-" e "."), altrimenti la stringa così com'è (pet_id); vuota -> "global".
+    """
+    if not key:
+        return "global"
+    key = str(key).strip()
+    m = key.upper()
+    for sep in ("-", " ", ":", "."):
+        m = m.replace(sep, "")
+    if len(m) == 12 and all(c in "0123456789ABCDEF" for c in m):
+        return ':'.join(m[i:i+2] for i in range(0, 12, 2))
+    return key
+
+
+# campi di una lettura ambientale restituiti dallo storico (page_env) quando non se ne chiedono altri
+ENV_FIELDS = ("timestamp", "temp", "hum")
+
+
+def env_key_for_pet(pet_id, pet=None):
+    """Chiave con cui sono salvate le letture ambientali di un pet: MAC del collare se presente, altrimenti pet_id."""
+    if pet and pet.get("mac_address"):
+        return canonical_env_key(pet["mac_address"])
+    return canonical_env_key(pet_id)
+
+
+def segment_as_position(seg, fields=None):
+    """Segmento compattato nella forma di una posizione ("timestamp"=start, con "end" e "count")."""
+    doc = {
+        "timestamp": seg["start"],
+        "end": seg["end"],
+        "count": seg.get("count", 1),
+        "source": seg.get("source"),
+        "entry_type": seg.get("entry_type"),
+        "room": seg.get("room"),
+        "rssi_min": seg.get("rssi_min"),
+        "rssi_max": seg.get("rssi_max"),
+    }
+    if fields:
+        keep = set(fields) | {"timestamp", "end", "count"}
+        doc = {k: v for k, v in doc.items() if k in keep}
+    return doc
+
+
+class StorageBackend(ABC):
+    """
+    Interfaccia del livello dati usata da app, AuthManager, compattazione, cache e worker.
+    I documenti sono dizionari con "_id" ObjectId (utenti, pet, stanze, regole, notifiche); i pet_id nelle
+    altre collezioni sono stringhe. Qui le parti comuni (cache di lettura, perimetro, autenticazione);
+    i metodi astratti sono quelli che ogni motore implementa.
+    """
+
+    def __init__(self, read_cache=None):
+        if read_cache is None:
+            read_cache = READ_CACHE_ENABLED
+        self.read_cache = ReadThroughCache(READ_CACHE_SIZE, READ_CACHE_TTL_SEC) if read_cache else None
+        self.spool = None
+
+    # --- Utils ---
+    @staticmethod
+    def _ensure_oid(value):
+        """Restituisce un ObjectId a partire da una stringa o passa attraverso se è già ObjectId."""
+        if isinstance(value, ObjectId):
+            return value
+        return ObjectId(value)
+
+    def cached(self, key, load):
+        """
+        Valore di load() tramite la cache di lettura, se abilitata. Ritorna sempre una copia:
+        chi modifica il documento ricevuto non altera quello in cache.
+        """
+        if self.read_cache is None:
+            return load()
+        return copy.deepcopy(self.read_cache.get_or_load(key, load))
+
+    def invalidate_cache(self, *keys):
+        if self.read_cache is not None:
+            self.read_cache.invalidate(*keys)
+
+    def cache_stats(self):
+        return self.read_cache.stats() if self.read_cache is not None else None
+
+    def start_ingest_spool(self, on_replay=None, **options):
+        """
+        Spool su disco della telemetria: serve solo ai motori con un server remoto. `on_replay(collezione,
+        documenti)` viene chiamata dopo ogni lotto reinserito.
+        """
+        return None
+
+    @staticmethod
+    def is_inside_perimeter(lat, lon, area):
+        try:
+            from shapely.geometry import Point, Polygon
+            point = Point(lon, lat)
+            polygon = Polygon([(lng, lt) for lt, lng in area])  # area = [(lat, lon), ...]
+            return polygon.contains(point)
+        except ImportError:
+            print("Installa shapely per usare questa funzione!")
+            return False
+
+    # --- UTENTI ---
+    @abstractmethod
+    def create_user(self, username, password):
+        ...
+
+    @abstractmethod
+    def get_user_by_username(self, username):
+        ...
+
+    @abstractmethod
+    def get_user_by_id(self, user_id):
+        ...
+
+    @abstractmethod
+    def get_user(self, username, active_only=False, include_hash=True):
+        ...
+
+    @abstractmethod
+    def count_users(self):
+        ...
+
+    @abstractmethod
+    def insert_user(self, doc):
+        ...
+
+    @abstractmethod
+    def update_user(self, user_id, fields):
+        ...
+
+    @abstractmethod
+    def delete_user(self, username):
+        """Ritorna True se l'utente esisteva."""
+
+    def authenticate_user(self, username, password):
+        """
+        Autenticazione utente:
+        - legge preferibilmente 'password_hash'
+        - mantiene retrocompatibilità se dovesse esistere ancora il campo 'password'
+        - accetta sia valori bytes che string memorizzati (se necessario)
+        """
+        import bcrypt
+
+        user = self.get_user_by_username(username)
+        if not user:
+            return None
+
+        # preferisci 'password_hash', fallback a 'password' (per retrocompatibilità)
+        stored = user.get('password_hash') if 'password_hash' in user else user.get('password')
+        if not stored:
+            return None
+
+        # stored può essere bytes oppure string; assicurati di avere bytes per bcrypt
+        if isinstance(stored, str):
+            stored_bytes = stored.encode('utf-8')
+        else:
+            stored_bytes = stored
+
+        try:
+            if bcrypt.checkpw(password.encode('utf-8'), stored_bytes):
+                return user
+        except Exception as e:
+            # in caso di valore non valido per bcrypt, falliamo l'autenticazione
+            print(f"[AUTH] errore verifica password per {username}: {e}")
+        return None
+
+    # --- PETS ---
+    @abstractmethod
+    def add_pet(self, name, owner_id, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        """Il MAC è unico: un duplicato solleva pymongo.errors.DuplicateKeyError."""
+
+    @abstractmethod
+    def get_registered_macs(self):
+        ...
+
+    @abstractmethod
+    def get_pets_for_user(self, user_id):
+        ...
+
+    @abstractmethod
+    def get_pet_by_id(self, pet_id):
+        ...
+
+    @abstractmethod
+    def get_pets_by_ids(self, pet_ids):
+        ...
+
+    @abstractmethod
+    def get_pet_by_mac(self, mac_address, owner_id=None):
+        ...
+
+    @abstractmethod
+    def get_pet_by_bt_name(self, bt_name, ignore_case=False):
+        ...
+
+    @abstractmethod
+    def update_pet(self, pet_id, name=None, mac_address=None, bt_name=None, temp_min=None, temp_max=None):
+        ...
+
+    @abstractmethod
+    def delete_pet(self, pet_id):
+        ...
+
+    @abstractmethod
+    def set_pet_allowed_rooms(self, pet_id, room_ids):
+        ...
+
+    # --- ROOMS ---
+    @abstractmethod
+    def get_rooms(self):
+        ...
+
+    @abstractmethod
+    def add_room(self, name, mac_address, allowed):
+        ...
+
+    @abstractmethod
+    def get_room_by_id(self, room_id):
+        ...
+
+    @abstractmethod
+    def get_room_by_name(self, name):
+        ...
+
+    @abstractmethod
+    def get_room_by_mac(self, mac_address):
+        ...
+
+    @abstractmethod
+    def update_room(self, room_id, name, mac_address, allowed):
+        ...
+
+    @abstractmethod
+    def delete_room(self, room_id):
+        ...
+
+    @abstractmethod
+    def update_room_access(self, room_id, allowed):
+        ...
+
+    # --- PERIMETRO (globale per tutti i pet) ---
+    @abstractmethod
+    def _global_perimeter(self):
+        """Documento del perimetro globale ({"center", "radius"}) o None."""
+
+    def get_perimeter_center(self):
+        perim = self._global_perimeter()
+        if perim and "center" in perim:
+            return tuple(perim["center"])
+        return None
+
+    def get_perimeter_radius(self):
+        perim = self._global_perimeter()
+        if perim and "radius" in perim:
+            return perim["radius"]
+        return None
+
+    @abstractmethod
+    def save_perimeter(self, center, radius):
+        ...
+
+    # --- REGOLE D'ALLARME (pet_id "*" = tutti i pet) ---
+    @abstractmethod
+    def get_alert_rules(self, pet_id):
+        ...
+
+    @abstractmethod
+    def list_alert_rules(self):
+        ...
+
+    @abstractmethod
+    def add_alert_rule(self, rule):
+        ...
+
+    @abstractmethod
+    def delete_alert_rule(self, rule_id):
+        """Ritorna la regola eliminata o None."""
+
+    # --- OUTBOX NOTIFICHE ---
+    @abstractmethod
+    def enqueue_notification(self, dedupe_key, text, chat_ids=None, key=None):
+        ...
+
+    @abstractmethod
+    def claim_notifications(self, worker_id, limit=50, lease_sec=300, exclude=()):
+        ...
+
+    @abstractmethod
+    def renew_notification_leases(self, worker_id, ids, lease_sec=300):
+        """Prolunga la lease delle notifiche `ids` ancora prese in carico da `worker_id`."""
+
+    @abstractmethod
+    def mark_notifications_delivered(self, ids, failed_chats=None):
+        ...
+
+    @abstractmethod
+    def release_notifications(self, ids, retry_in_sec=0):
+        ...
+
+    # --- POSIZIONI ---
+    @abstractmethod
+    def save_pet_position(self, pet_id, lat, lon, timestamp=None):
+        ...
+
+    @abstractmethod
+    def save_position(self, pet_id, entry_type, timestamp=None, **kwargs):
+        ...
+
+    @abstractmethod
+    def get_last_position(self, pet_id):
+        ...
+
+    @abstractmethod
+    def latest_positions(self, pet_ids, sources=("ble", "gps")):
+        """{pet_id: {sorgente: {"timestamp", "room", "lat", "lon"}}} con l'ultima posizione per sorgente."""
+
+    @abstractmethod
+    def get_positions(self, pet_id, limit=50, fields=None):
+        ...
+
+    @abstractmethod
+    def iter_positions(self, pet_id, start, end, fields=None, batch_size=1000):
+        """Posizioni grezze e segmenti compattati (segment_as_position) in [start, end], per timestamp."""
+
+    @abstractmethod
+    def iter_position_records(self, pet_id, start, end, batch_size=1000):
+        ...
+
+    @abstractmethod
+    def page_positions(self, pet_id, start, end, after=None, limit=500, fields=None):
+        """Pagina keyset ((rank, documento), chiave_successiva): vedi PetTrackerDB.page_positions."""
+
+    # --- COMPATTAZIONE ---
+    @abstractmethod
+    def compaction_pet_ids(self, cutoff):
+        """pet_id con posizioni BLE più vecchie di cutoff."""
+
+    @abstractmethod
+    def iter_compactable_positions(self, pet_id, cutoff):
+        """Posizioni del pet con timestamp < cutoff per timestamp crescente (_id, timestamp, source, entry_type, room, rssi)."""
+
+    @abstractmethod
+    def store_segments(self, segments):
+        """Salva (sovrascrive per _id) i segmenti e verifica i conteggi; se la verifica fallisce li rimuove e ritorna False."""
+
+    @abstractmethod
+    def delete_positions(self, ids):
+        ...
+
+    # --- STORICO E SERIE AMBIENTALI ---
+    @abstractmethod
+    def page_env(self, key, start, end, after=None, limit=500, fields=None):
+        """Come page_positions; senza `fields` i documenti hanno solo _id e ENV_FIELDS."""
+
+    @abstractmethod
+    def env_buckets(self, key, start, end, bucket_sec):
+        """[{"_id": inizio_bucket_ms, "temp_min", "temp_max", "temp_avg", "hum_min", "hum_max", "hum_avg", "n"}]"""
+
+    @abstractmethod
+    def iter_env_series(self, key, start, end, metric):
+        ...
+
+    # --- RIEPILOGHI TIMELINE E HEATMAP ---
+    @abstractmethod
+    def get_timeline_days(self, pet_id, dates, version):
+        ...
+
+    @abstractmethod
+    def save_timeline_day(self, pet_id, date, version, summary):
+        ...
+
+    @abstractmethod
+    def delete_timeline_days(self, pet_id, dates=None):
+        ...
+
+    @abstractmethod
+    def aggregate_gps_cells(self, pet_id, start, end, precision, tz_name):
+        ...
+
+    @abstractmethod
+    def get_heatmap_days(self, pet_id, dates, precision):
+        ...
+
+    @abstractmethod
+    def save_heatmap_day(self, pet_id, date, precision, cells):
+        ...
+
+    @abstractmethod
+    def delete_heatmap_days(self, pet_id, dates=None):
+        ...
+
+    # --- ENV DATA ---
+    @abstractmethod
+    def save_env_data(self, pet_id, temp, hum, timestamp):
+        ...
+
+    @abstractmethod
+    def get_latest_env(self, pet_id=None):
+        ...
+
+    @abstractmethod
+    def latest_env_many(self, keys):
+        ...
+
+
+def open_database(backend=None, **kwargs):
+    """Istanza del livello dati per il motore indicato (default: PETTRACKER_DB_BACKEND)."""
+    backend = (backend or DB_BACKEND).lower()
+    if backend == "mongo":
+        from pettracker_db import PetTrackerDB
+        return PetTrackerDB(**kwargs)
+    if backend == "sqlite":
+        from sqlite_db import SQLiteDB
+        return SQLiteDB(**kwargs)
+    if backend == "memory":
+        from memory_db import MemoryDB
+        return MemoryDB(**kwargs)
+    raise ValueError(f"motore del database sconosciuto: {backend}")
@@ -1,54 +1,65 @@
-import requests
+import hashlib
 import threading
 import time
-import json
 import os
 
+from scheduler import KeyedScheduler
+from telegram_dispatcher import ChatRegistry, TelegramDispatcher
+
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 CHAT_IDS_FILE = "chat_ids.json"
 
 NOTIFICATION_COOLDOWN_SEC = int(os.getenv("NOTIFICATION_COOLDOWN_SEC", "60")) # per evitare spam
 DEBOUNCE_SEC = float(os.getenv("NOTIFY_DEBOUNCE_SEC", "3.0"))
+# con eventi continui (es. temperatura fuori soglia a ogni lettura) il debounce non rinvia oltre questo limite
+DEBOUNCE_MAX_DELAY_SEC = float(os.getenv("NOTIFY_DEBOUNCE_MAX_DELAY_SEC", "30"))
 
 _pending_lock = threading.Lock()
 pending_notifications = {}
-pending_timers = {}
+pending_since = {}
 last_notification_time_by_key = {}
 
+chat_registry = ChatRegistry(CHAT_IDS_FILE)
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_outbox = None   # OutboxWorker: se impostato le notifiche passano dalla collezione outbox
+
+
+def get_dispatcher():
+    """Dispatcher unico, avviato al primo invio (il token può arrivare da .env dopo l'import)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            token = os.environ.get("TELEGRAM_BOT_TOKEN") or TELEGRAM_BOT_TOKEN
+            if not token:
+                return None
+            _dispatcher = TelegramDispatcher(token).start()
+        return _dispatcher
+
+
+def set_outbox(outbox):
+    global _outbox
+    _outbox = outbox
+
 
 def load_chat_ids():
-    try:
-        with open(CHAT_IDS_FILE, "r") as f:
-            ids = set(json.load(f))
-            return ids
-    except Exception:
-        return set()
+    return chat_registry.all()
 
 
 def save_chat_id(chat_id):
-    chat_ids = load_chat_ids()
-    chat_ids.add(str(chat_id))
     try:
-        with open(CHAT_IDS_FILE, "w") as f:
-            json.dump(list(chat_ids), f)
-        print(f"[TELEGRAM] Chat_id registrato: {chat_id}")
+        if chat_registry.add(chat_id):
+            print(f"[TELEGRAM] Chat_id registrato: {chat_id}")
     except Exception as e:
         print(f"[TELEGRAM] Errore salvataggio chat_ids: {e}")
 
 
-def send_telegram_message(message, chat_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": str(chat_id),
-        "text": message,
-        "parse_mode": "HTML"
-    }
-    try:
-        r = requests.post(url, data=data, timeout=10)
-        if r.status_code != 200:
-            print(f"[BOT] Errore invio messaggio a {chat_id}: {r.status_code} {r.text}")
-    except Exception as e:
-        print(f"[BOT] Telegram message error: {e}")
+def send_telegram_message(message, chat_id, parse_mode="HTML"):
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        print("[BOT] TELEGRAM_BOT_TOKEN non configurato, skip invio")
+        return
+    dispatcher.send(message, [chat_id], parse_mode=parse_mode)
 
 
 def send_to_all_chats(msg):
@@ -56,11 +67,12 @@ def send_to_all_chats(msg):
     if not chat_ids:
         print("[TELEGRAM] Nessun chat_id registrato, skip invio")
         return
-    for chat_id in chat_ids:
-        try:
-            send_telegram_message(msg, chat_id)
-        except Exception as e:
-            print(f"[BOT] Errore invio a {chat_id}: {e}")
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        print("[BOT] TELEGRAM_BOT_TOKEN non configurato, skip invio")
+        return
+    # non bloccante: l'invio alle singole chat avviene in parallelo nel dispatcher
+    dispatcher.send(msg, chat_ids)
 
 
 def _merge_pending(existing, new):
@@ -145,7 +157,7 @@ def _build_message_from_payload(payload):
 def _send_aggregated_notification(key):
     with _pending_lock:
         payload = pending_notifications.pop(key, None)
-        pending_timers.pop(key, None)
+        pending_since.pop(key, None)
     if not payload:
         return
 
@@ -157,12 +169,32 @@ def _send_aggregated_notification(key):
         return
     if now - last >= NOTIFICATION_COOLDOWN_SEC:
         print(f"[TELEGRAM] Invio notifica aggregata per {key}: {payload}")
-        threading.Thread(target=send_to_all_chats, args=(msg,), daemon=True).start()
+        _deliver(key, msg, now)
         last_notification_time_by_key[key] = now
     else:
         print(f"[TELEGRAM] Notifica per {key} ignorata per cooldown")
 
 
+def _deliver(key, msg, now):
+    if _outbox is None:
+        send_to_all_chats(msg)
+        return
+    # stesso messaggio per la stessa chiave nella stessa finestra di cooldown: registrato una sola volta,
+    # anche se il cooldown in memoria è andato perso con un riavvio
+    digest = hashlib.sha1(msg.encode("utf-8")).hexdigest()[:16]
+    dedupe_key = f"{key}:{digest}:{int(now // max(NOTIFICATION_COOLDOWN_SEC, 1))}"
+    try:
+        if not _outbox.enqueue(dedupe_key, msg, key=key):
+            print(f"[TELEGRAM] Notifica per {key} già registrata, skip")
+    except Exception as e:
+        print(f"[TELEGRAM] Outbox non disponibile ({e}), invio diretto")
+        send_to_all_chats(msg)
+
+
+# un solo thread per tutte le chiavi al posto di un threading.Timer per evento
+_debounce = KeyedScheduler(_send_aggregated_notification, name="notify-debounce")
+
+
 def notify_events(
     is_outside,
     temp_high,
@@ -208,16 +240,11 @@ def notify_events(
         else:
             pending_notifications[key] = payload
 
-        timer = pending_timers.get(key)
-        if timer and timer.is_alive():
-            try:
-                timer.cancel()
-            except Exception:
-                pass
-        new_timer = threading.Timer(DEBOUNCE_SEC, _send_aggregated_notification, args=(key,))
-        pending_timers[key] = new_timer
-        new_timer.daemon = True
-        new_timer.start()
+        # debounce: ogni evento sposta l'invio di DEBOUNCE_SEC, entro DEBOUNCE_MAX_DELAY_SEC dal primo
+        now = time.monotonic()
+        first = pending_since.setdefault(key, now)
+        delay = min(DEBOUNCE_SEC, max(first + DEBOUNCE_MAX_DELAY_SEC - now, 0))
+        _debounce.schedule(key, delay)
 
 
-__all__ = ["notify_events", "save_chat_id"]
+__all__ = ["notify_events", "save_chat_id", "send_telegram_message", "set_outbox"]
@@ -0,0 +1,266 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Limiti Telegram: ~30 messaggi/s in totale, 1 messaggio/s per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1.0"))
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", "4"))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", "8"))
+TELEGRAM_RETRY_FILE = os.getenv("TELEGRAM_RETRY_FILE", "telegram_retry.json")
+
+
+def _write_json_atomic(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class ChatRegistry:
+    """Chat_id iscritti alle notifiche: letti dal file una volta, poi tenuti in memoria."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = None
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return set(str(c) for c in json.load(f))
+        except Exception:
+            return set()
+
+    def all(self):
+        with self._lock:
+            if self._ids is None:
+                self._ids = self._load()
+            return set(self._ids)
+
+    def add(self, chat_id):
+        with self._lock:
+            if self._ids is None:
+                self._ids = self._load()
+            chat_id = str(chat_id)
+            if chat_id in self._ids:
+                return False
+            self._ids.add(chat_id)
+            _write_json_atomic(self.path, sorted(self._ids))
+            return True
+
+
+class TelegramDispatcher:
+    """
+    Invio dei messaggi Telegram da un unico thread di smistamento: una sessione HTTP con connessioni
+    keep-alive condivisa da un piccolo pool di worker, limite globale (token bucket) e per chat, coda di
+    ritentativi per 429/5xx/errori di rete salvata su file e ricaricata all'avvio.
+    `api_base` permette di puntare a un server HTTP locale al posto di api.telegram.org.
+    """
+
+    def __init__(self, token, api_base=None, retry_file=TELEGRAM_RETRY_FILE, workers=TELEGRAM_WORKERS,
+                 global_rate=TELEGRAM_GLOBAL_RATE, per_chat_interval=TELEGRAM_PER_CHAT_INTERVAL,
+                 max_attempts=TELEGRAM_MAX_ATTEMPTS):
+        api_base = api_base or os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+        self.url = f"{api_base.rstrip('/')}/bot{token}/sendMessage"
+        self.retry_file = retry_file
+        self.workers = workers
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._cond = threading.Condition()
+        self._heap = []                 # (pronto_da, seq, job)
+        self._seq = itertools.count()
+        self._inflight = set()          # chat con un invio in corso (un messaggio alla volta per chat)
+        self._next_ok = {}              # chat_id -> primo istante utile per il prossimo invio
+        self._tokens = global_rate
+        self._tokens_ts = time.time()
+        self._retry_lock = threading.Lock()
+        self._retry = {}                # job_id -> job, persistiti su retry_file
+        self._callbacks = {}            # job_id -> on_done(chat_id, ok), non persistiti
+        self._thread = None
+        self._executor = None
+        self._stopping = False
+        self.sent = 0
+        self.failed = 0
+
+    # --- API pubblica ---
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="telegram")
+        for job in self._load_retry():
+            self._push(job, job.get("not_before", 0))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        self._thread = None
+
+    def send(self, text, chat_ids, parse_mode="HTML", on_done=None, persist=True):
+        """
+        Accoda `text` per ciascuna chat; ritorna subito. on_done(chat_id, ok) viene chiamata all'esito
+        definitivo di ogni invio. persist=False se il chiamante ha già una coda durevole (es. outbox).
+        """
+        now = time.time()
+        for chat_id in chat_ids:
+            job = {"id": uuid.uuid4().hex, "chat_id": str(chat_id), "text": text,
+                   "parse_mode": parse_mode, "attempts": 0, "persist": persist}
+            if on_done is not None:
+                self._callbacks[job["id"]] = on_done
+            self._push(job, now)
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap) + len(self._inflight)
+
+    # --- smistamento ---
+    def _push(self, job, ready_at):
+        with self._cond:
+            heapq.heappush(self._heap, (ready_at, next(self._seq), job))
+            self._cond.notify()
+
+    def _take_token(self, now):
+        self._tokens = min(self.global_rate, self._tokens + (now - self._tokens_ts) * self.global_rate)
+        self._tokens_ts = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.global_rate
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                ready_at, _, job = self._heap[0]
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+                chat_id = job["chat_id"]
+                chat_ready = self._next_ok.get(chat_id, 0)
+                if chat_id in self._inflight or chat_ready > now:
+                    # la chat è occupata o nel suo intervallo minimo: riprova più tardi
+                    heapq.heapreplace(self._heap, (max(chat_ready, now + self.per_chat_interval / 4),
+                                                   next(self._seq), job))
+                    continue
+                wait = self._take_token(now)
+                if wait:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                self._inflight.add(chat_id)
+            self._executor.submit(self._deliver, job)
+
+    def _deliver(self, job):
+        chat_id = job["chat_id"]
+        retry_after = None
+        try:
+            data = {"chat_id": chat_id, "text": job["text"]}
+            if job.get("parse_mode"):
+                data["parse_mode"] = job["parse_mode"]
+            r = self.session.post(self.url, data=data, timeout=10)
+            status = r.status_code
+            if status == 429:
+                try:
+                    retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+                except Exception:
+                    retry_after = 1.0
+            elif status != 200:
+                print(f"[BOT] Errore invio messaggio a {chat_id}: {status} {r.text[:200]}")
+        except Exception as e:
+            status = None
+            print(f"[BOT] Telegram message error ({chat_id}): {e}")
+
+        now = time.time()
+        with self._cond:
+            self._inflight.discard(chat_id)
+            self._next_ok[chat_id] = now + max(self.per_chat_interval, retry_after or 0)
+            self._cond.notify()
+
+        if status == 200:
+            self.sent += 1
+            self._finish(job, True)
+        elif status is None or status == 429 or status >= 500:
+            self._schedule_retry(job, now, retry_after)
+        else:
+            # errore definitivo (400, 403 bot bloccato, ...): non ritentare
+            self.failed += 1
+            self._finish(job, False)
+
+    def _finish(self, job, ok):
+        self._forget(job)
+        on_done = self._callbacks.pop(job["id"], None)
+        if on_done is not None:
+            try:
+                on_done(job["chat_id"], ok)
+            except Exception as e:
+                print(f"[BOT] Errore callback invio: {e}")
+
+    # --- coda di ritentativi persistente ---
+    def _schedule_retry(self, job, now, retry_after=None):
+        job["attempts"] += 1
+        if job["attempts"] >= self.max_attempts:
+            print(f"[BOT] Messaggio per {job['chat_id']} scartato dopo {job['attempts']} tentativi")
+            self.failed += 1
+            self._finish(job, False)
+            return
+        delay = retry_after if retry_after else min(2 ** job["attempts"], 300)
+        job["not_before"] = now + delay
+        if job.get("persist", True):
+            with self._retry_lock:
+                self._retry[job["id"]] = job
+                self._persist_retry()
+        self._push(job, job["not_before"])
+
+    def _forget(self, job):
+        with self._retry_lock:
+            if self._retry.pop(job["id"], None) is not None:
+                self._persist_retry()
+
+    def _persist_retry(self):
+        try:
+            _write_json_atomic(self.retry_file, list(self._retry.values()))
+        except Exception as e:
+            print(f"[BOT] Errore salvataggio coda ritentativi: {e}")
+
+    def _load_retry(self):
+        try:
+            with open(self.retry_file, "r") as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            print(f"[BOT] Coda ritentativi illeggibile: {e}")
+            return []
+        with self._retry_lock:
+            self._retry = {job["id"]: job for job in jobs}
+        if jobs:
+            print(f"[BOT] Ripresi {len(jobs)} messaggi dalla coda ritentativi")
+        return jobs
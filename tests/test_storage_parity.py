@@ -0,0 +1,177 @@
+"""
+Parità tra i motori del livello dati: gli stessi dati caricati in MemoryDB, SQLiteDB e (se configurato)
+PetTrackerDB devono dare gli stessi risultati per ingest, paginazione, compattazione ed env_buckets.
+
+    python -m unittest discover -s tests
+
+Mongo entra nel confronto solo con PETTRACKER_TEST_MONGODB_URI: il database PetTracker di quel server
+viene svuotato, va usato solo un server di prova.
+"""
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compaction import compact_positions  # noqa: E402
+from storage import open_database  # noqa: E402
+from timeline import normalize_timestamp  # noqa: E402
+
+MONGODB_URI = os.getenv("PETTRACKER_TEST_MONGODB_URI")
+ENV_KEY = "AA:BB:CC:DD:EE:01"
+T0 = datetime(2024, 3, 1, tzinfo=timezone.utc)
+START, END = T0 + timedelta(hours=3), T0 + timedelta(hours=20)
+
+
+def _events(n=3000, seed=1):
+    """Eventi BLE, GPS e ambientali in ordine di arrivo casuale."""
+    rnd = random.Random(seed)
+    events = []
+    for i in range(n):
+        ts = T0 + timedelta(seconds=i * 37 + rnd.randint(0, 5))
+        k = rnd.random()
+        if k < .5:
+            events.append(("ble", ts, rnd.choice(["Cucina", "Sala"])))
+        elif k < .8:
+            events.append(("gps", ts, (45 + rnd.random() / 100, 9 + rnd.random() / 100)))
+        elif k < .95:
+            events.append(("env", ts, (20 + rnd.random() * 5, 40 + rnd.random() * 20)))
+        else:
+            # letture intere (sensori senza decimali): devono tornare int da tutti i motori
+            events.append(("env", ts, (rnd.randint(18, 26), rnd.randint(40, 60))))
+    rnd.shuffle(events)
+    return events
+
+
+def _norm(value):
+    """
+    Toglie _id e campi che dipendono dal motore (id generati, istanti di scrittura). I numeri portano il loro
+    tipo: -60 e -60.0 sono uguali per assertEqual ma non nel JSON delle API.
+    """
+    if isinstance(value, datetime):
+        return normalize_timestamp(value)
+    if isinstance(value, dict):
+        return {k: _norm(v) for k, v in value.items() if k not in ("_id", "pet_id", "created_at", "computed_at")}
+    if isinstance(value, (list, tuple)):
+        return [_norm(v) for v in value]
+    if isinstance(value, float):
+        return float, round(value, 9)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return int, value
+    return value
+
+
+def _all_pages(page, *args, limit):
+    items, after = [], None
+    while True:
+        batch, after = page(*args, after=after, limit=limit)
+        items.extend(batch)
+        if not after:
+            return items
+
+
+class StorageParityTest(unittest.TestCase):
+    """Ogni test carica gli stessi eventi in motori nuovi (la compattazione modifica i dati)."""
+
+    events = _events()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.backends = {
+            "memory": open_database("memory"),
+            "sqlite": open_database("sqlite", path=os.path.join(self.tmp, "parity.db")),
+        }
+        if MONGODB_URI:
+            mongo = open_database("mongo", connection_string=MONGODB_URI)
+            for name in mongo.db.list_collection_names():
+                if not name.startswith("system."):
+                    mongo.db[name].delete_many({})
+            self.backends["mongo"] = mongo
+        self.pets = {}
+        for name, db in self.backends.items():
+            uid = db.create_user("u", "secret1")
+            self.pets[name] = str(db.add_pet("Fido", uid, mac_address=ENV_KEY, bt_name="Collare1"))
+            for kind, ts, v in self.events:
+                if kind == "ble":
+                    db.save_position(self.pets[name], "room", timestamp=ts, source="ble", room=v, rssi=-60)
+                elif kind == "gps":
+                    db.save_position(self.pets[name], "gps", timestamp=ts, source="gps", lat=v[0], lon=v[1])
+                else:
+                    # chiave non canonica: il motore la normalizza in ingest
+                    db.save_env_data("aa-bb-cc-dd-ee-01", v[0], v[1], ts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def assertSameAcrossBackends(self, query):
+        results = {name: _norm(query(name, db)) for name, db in self.backends.items()}
+        reference = results.pop("memory")
+        for name, result in results.items():
+            with self.subTest(backend=name):
+                self.assertEqual(result, reference)
+        return reference
+
+    def _positions_snapshot(self, name, db):
+        pet_id = self.pets[name]
+        return {
+            "last": db.get_last_position(pet_id),
+            "pages": _all_pages(db.page_positions, pet_id, START, END, limit=97),
+            "records": [(r.timestamp, r.source, r.room, r.count) for r in db.iter_position_records(pet_id, START, END)],
+        }
+
+    def test_ingest(self):
+        ref = self.assertSameAcrossBackends(lambda name, db: {
+            "last": db.get_last_position(self.pets[name]),
+            "latest_env": db.get_latest_env(ENV_KEY),
+            "recent": db.get_positions(self.pets[name], limit=7, fields=["room"]),
+        })
+        last_env = max((e for e in self.events if e[0] == "env"), key=lambda e: e[1])
+        self.assertEqual(ref["latest_env"]["timestamp"], last_env[1])
+        self.assertEqual(ref["last"]["timestamp"], max(e[1] for e in self.events if e[0] != "env"))
+
+    def test_paging(self):
+        ref = self.assertSameAcrossBackends(lambda name, db: {
+            "positions": _all_pages(db.page_positions, self.pets[name], START, END, limit=97),
+            "env": _all_pages(db.page_env, ENV_KEY, START, END, limit=50),
+        })
+        in_range = [kind for kind, ts, _ in self.events if START <= ts <= END]
+        self.assertEqual(len(ref["positions"]), sum(1 for kind in in_range if kind != "env"))
+        self.assertEqual(len(ref["env"]), in_range.count("env"))
+        # nessun record ripetuto o perso tra una pagina e l'altra
+        times = [doc["timestamp"] for _, doc in ref["positions"]]
+        self.assertEqual(times, sorted(times))
+
+    def test_env_buckets(self):
+        self.assertSameAcrossBackends(lambda name, db: db.env_buckets(ENV_KEY, START, END, 3600))
+        # riferimento calcolato a mano
+        ref = self.backends["memory"].env_buckets(ENV_KEY, START, END, 3600)
+        buckets = {}
+        for kind, ts, (temp, hum) in ((k, t, v) for k, t, v in self.events if k == "env"):
+            if START <= ts <= END:
+                ms = int(ts.timestamp() * 1000)
+                buckets.setdefault(ms - ms % 3_600_000, []).append((temp, hum))
+        self.assertEqual(len(ref), len(buckets))
+        for row, (_, values) in zip(ref, sorted(buckets.items())):
+            self.assertEqual(row["n"], len(values))
+            self.assertTrue(math.isclose(row["temp_max"], max(t for t, _ in values), rel_tol=1e-9))
+            self.assertTrue(math.isclose(row["hum_avg"], sum(h for _, h in values) / len(values), rel_tol=1e-9))
+
+    def test_compaction(self):
+        before = {name: self._positions_snapshot(name, db) for name, db in self.backends.items()}
+        for db in self.backends.values():
+            compact_positions(db, older_than_days=0)
+        self.assertSameAcrossBackends(self._positions_snapshot)
+        # i record GPS non vengono compattati: stessi punti prima e dopo
+        for name, db in self.backends.items():
+            with self.subTest(backend=name):
+                gps = lambda snap: [r for r in snap["records"] if r[1] == "gps"]
+                self.assertEqual(gps(_norm(self._positions_snapshot(name, db))), gps(_norm(before[name])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,330 @@
+from collections import defaultdict
+from datetime import timedelta, timezone
+from dateutil.parser import isoparse
+
+# Campi minimi necessari per costruire timeline e statistiche
+TIMELINE_FIELDS = ("timestamp", "source", "entry_type", "room")
+
+# Da incrementare quando cambia il formato dei riepiloghi giornalieri (invalida la cache persistita)
+TIMELINE_SCHEMA_VERSION = 1
+
+COLORS = {
+    "ble_allowed":  "#49c24b",
+    "ble_blocked":  "#e65c5c",
+    "gps_allowed":  "#53c7c3",
+    "gps_blocked":  "#ffa500",
+    "no_data":      "#e9ecef",
+}
+
+RESTRICTED_ENTRY_TYPES = ("zona_esterna_non_accessibile", "restricted", "stanza_non_accessibile")
+
+
+def state_of(p):
+    src = p.get("source")
+    et = p.get("entry_type")
+    if src == "ble":
+        if et in ("stanza_accessibile", "normal"):
+            return "ble_allowed"
+        if et in ("stanza_non_accessibile", "restricted"):
+            return "ble_blocked"
+    if src == "gps":
+        if et == "zona_esterna_accessibile":
+            return "gps_allowed"
+        if et == "zona_esterna_non_accessibile":
+            return "gps_blocked"
+    return "no_data"
+
+
+def normalize_timestamp(ts):
+    """Converte stringhe ISO e datetime naive (UTC) in datetime aware."""
+    if isinstance(ts, str):
+        ts = isoparse(ts)
+    if ts and ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+
+class PositionRecord:
+    """
+    Posizione (o segmento compattato) ridotta ai campi di TIMELINE_FIELDS, con timestamp già normalizzato:
+    al posto del documento BSON completo per le letture dello storico. `get` la rende compatibile con i
+    consumatori di documenti (state_of).
+    """
+
+    __slots__ = ("timestamp", "source", "entry_type", "room", "end", "count")
+
+    def __init__(self, timestamp, source=None, entry_type=None, room=None, end=None, count=1):
+        self.timestamp = timestamp
+        self.source = source
+        self.entry_type = entry_type
+        self.room = room
+        self.end = end
+        self.count = count
+
+    @classmethod
+    def from_doc(cls, doc):
+        end = doc.get("end")
+        return cls(normalize_timestamp(doc.get("timestamp")), doc.get("source"), doc.get("entry_type"),
+                   doc.get("room"), normalize_timestamp(end) if end else None, doc.get("count") or 1)
+
+    @classmethod
+    def from_segment(cls, seg):
+        return cls(normalize_timestamp(seg["start"]), seg.get("source"), seg.get("entry_type"),
+                   seg.get("room"), normalize_timestamp(seg["end"]), seg.get("count", 1))
+
+    def get(self, name, default=None):
+        value = getattr(self, name, default)
+        return default if value is None else value
+
+
+def timeline_days(period, start, end):
+    if period in ("week", "month"):
+        return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    return [start]
+
+
+
+class _DayCounters:
+    """Contatori di un giorno, combinabili con quelli dei giorni adiacenti (vedi merge_summaries)."""
+
+    def __init__(self):
+        self.n_positions = 0
+        self.movements = 0
+        self.first_key = None
+        self.last_key = None
+        self.first_ts = None
+        self.last_ts = None
+        self.last_room = None
+        self.room_times = defaultdict(float)
+        self.restricted_entries = 0
+
+    def observe(self, ts, room, entry_type):
+        key = [room, entry_type]
+        if self.n_positions == 0:
+            self.first_key = key
+            self.first_ts = ts
+            self.movements = 1
+        else:
+            if key != self.last_key:
+                self.movements += 1
+            if self.last_room:
+                self.room_times[self.last_room] += max((ts - self.last_ts).total_seconds(), 0)
+        self.n_positions += 1
+        self.last_key = key
+        self.last_ts = ts
+        self.last_room = room
+        if entry_type in RESTRICTED_ENTRY_TYPES:
+            self.restricted_entries += 1
+
+    def observe_run(self, end_ts, extra_count, entry_type):
+        """Campioni successivi di un segmento compattato (stesso stato del primo, fino a end_ts)."""
+        if self.last_room:
+            self.room_times[self.last_room] += max((end_ts - self.last_ts).total_seconds(), 0)
+        self.n_positions += extra_count
+        self.last_ts = end_ts
+        if entry_type in RESTRICTED_ENTRY_TYPES:
+            self.restricted_entries += extra_count
+
+    def to_dict(self):
+        return {
+            "n_positions": self.n_positions,
+            "movements": self.movements,
+            "first_key": self.first_key,
+            "last_key": self.last_key,
+            "first_ts": self.first_ts,
+            "last_ts": self.last_ts,
+            "last_room": self.last_room,
+            # lista di coppie: i nomi stanza non sono chiavi valide per Mongo
+            "room_times": [[r, s] for r, s in self.room_times.items()],
+            "restricted_entries": self.restricted_entries,
+        }
+
+
+class _DayTimeline:
+    """Segmenti di un singolo giorno, costruiti man mano che arrivano le posizioni."""
+
+    def __init__(self, day, max_gap_seconds):
+        self.day = day
+        self.midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.next_midnight = self.midnight + timedelta(days=1)
+        self.max_gap_seconds = max_gap_seconds
+        self.counters = _DayCounters()
+        self.segments = []
+        self.last_seg = None
+        self.cur_t = self.midnight
+
+    def _push_or_extend(self, state, start_dt, end_dt, label=""):
+        last = self.last_seg
+        if last and last["state"] == state and (start_dt - last["end_dt"]).total_seconds() <= 60:
+            last["end_dt"] = end_dt
+        else:
+            self.last_seg = {"state": state, "start_dt": start_dt, "end_dt": end_dt, "label": label}
+            self.segments.append(self.last_seg)
+
+    def add(self, state, start_dt, end_dt, label):
+        # Se c'è un buco tra cur_t e start_dt, metti "nessun dato"
+        if start_dt > self.cur_t:
+            self._push_or_extend("no_data", self.cur_t, start_dt, "Nessun dato")
+
+        # se il gap al prossimo evento (o alla fine della giornata) è troppo grande,
+        # tronca lo stato dopo max_gap_seconds e poi "nessun dato"
+        gap_to_next = (end_dt - start_dt).total_seconds()
+        next_break = min(gap_to_next, self.max_gap_seconds)
+        self._push_or_extend(state, start_dt, start_dt + timedelta(seconds=next_break), label)
+        if gap_to_next > self.max_gap_seconds:
+            nd_start = start_dt + timedelta(seconds=self.max_gap_seconds)
+            self._push_or_extend("no_data", nd_start, end_dt, "Nessun dato")
+        self.cur_t = end_dt
+
+    def cover(self, state, start_dt, end_dt, label):
+        # Segmento compattato: lo stato è continuo fino a end_dt (i gap interni erano < max_gap_seconds)
+        if start_dt > self.cur_t:
+            self._push_or_extend("no_data", self.cur_t, start_dt, "Nessun dato")
+        self._push_or_extend(state, start_dt, end_dt, label)
+        self.cur_t = end_dt
+
+    def close(self):
+        if self.cur_t < self.next_midnight:
+            self._push_or_extend("no_data", self.cur_t, self.next_midnight, "Nessun dato")
+        out = []
+        for s in self.segments:
+            dur_s = (s["end_dt"] - s["start_dt"]).total_seconds()
+            out.append({
+                "colore": COLORS[s["state"]],
+                "start": s["start_dt"].strftime("%H:%M"),
+                "end": s["end_dt"].strftime("%H:%M"),
+                "width_pct": (dur_s / 86400) * 100.0,
+                "label": s["label"],
+            })
+        summary = self.counters.to_dict()
+        summary["date"] = self.day.strftime("%d/%m/%Y")
+        summary["segments"] = out
+        return summary
+
+
+def summarize_days(positions, days, tz, resolve_room=None, max_gap_seconds=1800):
+    """
+    Consuma `positions` (cursore Mongo ordinato per timestamp crescente, o qualunque iterabile
+    di documenti con almeno i campi di TIMELINE_FIELDS) in un solo passaggio e ritorna
+    (summaries, before, after): un riepilogo per ciascun giorno di `days` (segmenti + contatori)
+    e i contatori delle posizioni che cadono prima/dopo i giorni richiesti.
+    Gli elementi con "end" e "count" sono segmenti compattati (vedi compaction.py) e valgono
+    come `count` posizioni consecutive nello stesso stato tra "timestamp" e "end".
+    Con PositionRecord (PetTrackerDB.iter_position_records) i timestamp non vengono riconvertiti.
+    """
+    timelines = [_DayTimeline(d, max_gap_seconds) for d in days]
+    summaries = []
+    before = _DayCounters()
+    after = _DayCounters()
+    day_idx = 0
+    pending = None  # (ts_local, state, label) in attesa della posizione successiva
+    room_names = {}
+
+    def close_current():
+        nonlocal day_idx, pending
+        cur = timelines[day_idx]
+        if pending:
+            cur.add(pending[1], pending[0], cur.next_midnight, pending[2])
+            pending = None
+        summaries.append(cur.close())
+        day_idx += 1
+
+    for p in positions:
+        if type(p) is not PositionRecord:
+            p = PositionRecord.from_doc(p)
+        ts = p.timestamp
+        if ts is None:
+            continue
+        ts_local = ts.astimezone(tz)
+
+        # Risolvi room -> nome leggibile (una sola volta per stanza distinta)
+        room = p.room
+        if room and resolve_room:
+            if room not in room_names:
+                try:
+                    room_names[room] = resolve_room(room) or room
+                except Exception:
+                    room_names[room] = room
+            room = room_names[room]
+        entry_type = p.entry_type
+        end_ts = p.end
+        extra = p.count - 1
+
+        while day_idx < len(timelines) and ts_local >= timelines[day_idx].next_midnight:
+            close_current()
+        in_days = day_idx < len(timelines) and ts_local >= timelines[day_idx].midnight
+        if in_days:
+            counters = timelines[day_idx].counters
+        else:
+            counters = after if day_idx >= len(timelines) else before
+        counters.observe(ts, room, entry_type)
+        if end_ts:
+            counters.observe_run(end_ts, extra, entry_type)
+        if not in_days:
+            continue
+
+        cur = timelines[day_idx]
+        state = state_of(p)
+        label = room or entry_type or ""
+        if pending:
+            cur.add(pending[1], pending[0], ts_local, pending[2])
+        if end_ts:
+            end_local = end_ts.astimezone(tz)
+            cur.cover(state, ts_local, end_local, label)
+            pending = (end_local, state, label)
+        else:
+            pending = (ts_local, state, label)
+
+    while day_idx < len(timelines):
+        close_current()
+
+    return summaries, before.to_dict(), after.to_dict()
+
+
+def merge_summaries(summaries, tz):
+    """Combina i contatori di giorni consecutivi nelle statistiche mostrate in stats.html."""
+    n_positions = 0
+    total_movements = 0
+    restricted_entries = 0
+    room_times = defaultdict(float)
+    prev = None
+    for s in summaries:
+        if not s.get("n_positions"):
+            continue
+        first_ts = normalize_timestamp(s["first_ts"])
+        n_positions += s["n_positions"]
+        total_movements += s["movements"]
+        if prev:
+            # lo stesso stato a cavallo della mezzanotte non è un nuovo movimento
+            if list(s["first_key"]) == list(prev["last_key"]):
+                total_movements -= 1
+            if prev["last_room"]:
+                gap = (first_ts - normalize_timestamp(prev["last_ts"])).total_seconds()
+                room_times[prev["last_room"]] += max(gap, 0)
+        for room, secs in s["room_times"]:
+            room_times[room] += secs
+        restricted_entries += s["restricted_entries"]
+        prev = s
+
+    last_ts = normalize_timestamp(prev["last_ts"]) if prev else None
+    return {
+        "n_points": total_movements if n_positions else 0,
+        "top_room": max(room_times.items(), key=lambda x: x[1])[0] if room_times else "None",
+        "last_movement": last_ts.astimezone(tz).strftime("%H:%M") if last_ts else "-",
+        "restricted_entries": restricted_entries,
+    }
+
+
+def build_timeline(positions, period, start, end, tz=None, resolve_room=None, max_gap_seconds=1800):
+    """
+    Costruisce in un solo passaggio la timeline di tutti i giorni del periodo e le statistiche
+    (movimenti, stanza più frequentata, ultimo movimento, ingressi vietati).
+    Ritorna (timeline_by_day, calendar_hours, stats).
+    """
+    tz = tz or start.tzinfo
+    summaries, before, after = summarize_days(
+        positions, timeline_days(period, start, end), tz, resolve_room, max_gap_seconds
+    )
+    timeline_by_day = {s["date"]: s["segments"] for s in summaries}
+    stats = merge_summaries([before] + summaries + [after], tz)
+    return timeline_by_day, [f"{h:02d}" for h in range(25)], stats
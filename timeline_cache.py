@@ -0,0 +1,127 @@
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+
+from lru import LRUCache
+from timeline import TIMELINE_SCHEMA_VERSION, normalize_timestamp, summarize_days
+
+
+class DayTimelineCache:
+    """
+    Cache dei riepiloghi giornalieri (segmenti timeline + contatori) per (pet, data locale, versione schema).
+    I giorni già conclusi (mezzanotte Europe/Rome passata) sono immutabili: vengono tenuti in memoria
+    con eviction LRU e persistiti su Mongo; il giorno corrente (e i futuri) viene sempre ricalcolato.
+    """
+
+    def __init__(self, db, tz, resolve_room=None, max_entries=2048):
+        self.db = db
+        self.tz = tz
+        self.resolve_room = resolve_room
+        self._entries = LRUCache(max_entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _date_key(day):
+        return day.strftime("%Y-%m-%d")
+
+    def _key(self, pet_id, day):
+        return (str(pet_id), self._date_key(day), TIMELINE_SCHEMA_VERSION)
+
+    def invalidate(self, pet_id, day=None):
+        """Scarta i riepiloghi di un pet (tutti o solo quello di `day`) da memoria e DB."""
+        pet_id = str(pet_id)
+        date_key = self._date_key(day) if day is not None else None
+        self._entries.discard_where(lambda key: key[0] == pet_id and (date_key is None or key[1] == date_key))
+        try:
+            self.db.delete_timeline_days(pet_id, [date_key] if date_key else None)
+        except Exception as e:
+            print("[TIMELINE CACHE] Errore invalidazione:", e)
+
+    def _is_immutable(self, day, now_local):
+        midnight = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        return midnight + timedelta(days=1) <= now_local
+
+    def get_summaries(self, pet_id, days):
+        """Ritorna un riepilogo per ciascun giorno di `days` (ordinati e consecutivi)."""
+        now_local = datetime.now(self.tz)
+        result = [None] * len(days)
+        immutable = [self._is_immutable(d, now_local) for d in days]
+
+        # 1) memoria
+        to_load = []
+        for i, day in enumerate(days):
+            if immutable[i]:
+                summary = self._entries.get(self._key(pet_id, day))
+                if summary is not None:
+                    result[i] = summary
+                    continue
+                to_load.append(i)
+
+        # 2) Mongo (una sola query per tutti i giorni mancanti)
+        if to_load:
+            try:
+                stored = self.db.get_timeline_days(
+                    pet_id, [self._date_key(days[i]) for i in to_load], TIMELINE_SCHEMA_VERSION
+                )
+            except Exception as e:
+                print("[TIMELINE CACHE] Errore lettura riepiloghi:", e)
+                stored = {}
+            for i in to_load:
+                summary = stored.get(self._date_key(days[i]))
+                if summary is not None:
+                    result[i] = summary
+                    self._entries.put(self._key(pet_id, days[i]), summary)
+
+        with self._lock:
+            self.hits += sum(1 for i, s in enumerate(result) if s is not None)
+            self.misses += sum(1 for s in result if s is None)
+
+        # 3) ricalcolo dalle posizioni, un passaggio per ogni sequenza contigua di giorni mancanti
+        i = 0
+        while i < len(days):
+            if result[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j + 1 < len(days) and result[j + 1] is None:
+                j += 1
+            self._compute_run(pet_id, days, i, j, result, immutable)
+            i = j + 1
+        return result
+
+    def _compute_run(self, pet_id, days, first, last, result, immutable):
+        start_local = days[first].replace(hour=0, minute=0, second=0, microsecond=0)
+        end_local = days[last].replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        cursor = self.db.iter_position_records(
+            pet_id,
+            start_local.astimezone(timezone.utc),
+            end_local.astimezone(timezone.utc) - timedelta(microseconds=1)
+        )
+        summaries, _, _ = summarize_days(cursor, days[first:last + 1], self.tz, self.resolve_room)
+        for offset, summary in enumerate(summaries):
+            idx = first + offset
+            result[idx] = summary
+            if immutable[idx]:
+                self._entries.put(self._key(pet_id, days[idx]), summary)
+                try:
+                    self.db.save_timeline_day(pet_id, self._date_key(days[idx]), TIMELINE_SCHEMA_VERSION, summary)
+                except Exception as e:
+                    print("[TIMELINE CACHE] Errore salvataggio riepilogo:", e)
+
+
+def summaries_etag(summaries, *parts):
+    """ETag calcolato dall'impronta dei riepiloghi (conteggio e ultimo timestamp per giorno)."""
+    h = hashlib.sha1(str(TIMELINE_SCHEMA_VERSION).encode())
+    for p in parts:
+        h.update(b"|" + str(p).encode())
+    for s in summaries:
+        last_ts = normalize_timestamp(s.get("last_ts"))
+        h.update(f"|{s['date']}:{s.get('n_positions', 0)}:{last_ts.isoformat() if last_ts else ''}".encode())
+    return h.hexdigest()
+
+
+def summaries_last_modified(summaries, default):
+    last = [normalize_timestamp(s["last_ts"]) for s in summaries if s.get("last_ts")]
+    return max(last) if last else default